@@ -0,0 +1,397 @@
+#!/usr/bin/python
+
+# Hardware-free benchmarks for the receive, decode and dispatch paths
+#
+# A socketpair stands in for the controller: BluetoothHCI and its poller thread run unmodified on one
+# end, and a 'controller' thread on the other end plays a synthetic, deterministic packet stream
+# (and answers commands / ACL data where the scenario needs it).
+#
+# For every scenario the packet rate, the process CPU time per packet and the traced memory per packet
+# are reported. The CPU time includes the stand-in controller thread, which does the same work for
+# every hcipy version, so the numbers are comparable between versions (on the same machine).
+#
+# Usage:
+#   python -m benchmarks.bench_hci                              # run all scenarios, print a table
+#   python -m benchmarks.bench_hci -o before.json               # ... and save the results
+#   python -m benchmarks.bench_hci --compare before.json        # ... and compare with saved results,
+#                                                               # exits with 1 on a regression
+
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+
+from hcipy import *
+
+
+BENCHMARK_FORMAT = 1        # bump when the scenarios change in a way that makes old results incomparable
+SEED = 0x5eed
+SOCKET_BUFFER_SIZE = 1024 * 1024
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+# -------------------------------------------------
+# Synthetic packets
+
+def adv_report_packet(rng, num_reports):
+    params = bytearray([EVT_LE_ADVERTISING_REPORT, num_reports])
+    for _ in range(num_reports):
+        data = bytearray(rng.getrandbits(8) for _ in range(rng.randint(3, 31)))
+        params += struct.pack('<BB6sB', ADV_IND, LE_RANDOM_ADDRESS,
+                              struct.pack('<Q', rng.getrandbits(48))[:6], len(data))
+        params += data
+        params += struct.pack('<b', rng.randint(-100, -30))
+    return struct.pack('<BBB', HCI_EVENT_PKT, EVT_LE_META_EVENT, len(params)) + bytes(params)
+
+
+def cmd_complete_packet(opcode, ncmd=1, status=HCI_SUCCESS):
+    return struct.pack('<BBBBHB', HCI_EVENT_PKT, EVT_CMD_COMPLETE, 4, ncmd, opcode, status)
+
+
+def num_comp_pkts_packet(handle, count):
+    return struct.pack('<BBBBHH', HCI_EVENT_PKT, EVT_NUM_COMP_PKTS, 5, 1, handle, count)
+
+
+def acl_packet(handle, flags, data):
+    return struct.pack('<BHH', HCI_ACLDATA_PKT, acl_handle_pack(handle, flags), len(data)) + data
+
+
+def acl_fragments(handle, payload, max_data_length, cid=ATT_CID):
+    frame = struct.pack('<HH', len(payload), cid) + payload
+    packets = []
+    for offset in range(0, len(frame), max_data_length):
+        flags = ACL_START if offset == 0 else ACL_CONT
+        packets.append(acl_packet(handle, flags, frame[offset:offset + max_data_length]))
+    return packets
+
+
+# -------------------------------------------------
+# Scenarios
+
+class Scenario(object):
+    # setup() builds the stream, run() plays it and returns once every packet has been handled,
+    # only run() is measured.
+
+    name = None
+    description = None
+
+    def __init__(self, count):
+        self.count = count
+        self.rng = random.Random(SEED)
+        self.done = threading.Event()
+        self.handled = 0
+
+    def setup(self):
+        self.controller, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        for sock in (self.controller, host):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        self.provider = BluetoothHCISocketProvider(sock=host)
+        self.hci = BluetoothHCI(provider=self.provider, auto_start=False)
+
+    def run(self):
+        raise NotImplementedError
+
+    def teardown(self):
+        self.hci.stop()
+        self.controller.close()
+
+    def _play(self, packets):
+        send = self.controller.send
+        for packet in packets:
+            send(packet)
+
+    def _wait(self, timeout=60):
+        if not self.done.wait(timeout):
+            raise RuntimeError("{}: only {} of {} packets handled".format(self.name, self.handled, self.count))
+
+
+class AdvertisingFloodBatch(Scenario):
+
+    name = 'adv_flood_batch'
+    description = 'LE advertising reports, on_data_batch into an AdvertisingReportBatch'
+
+    def setup(self):
+        super(AdvertisingFloodBatch, self).setup()
+        self.packets = [adv_report_packet(self.rng, self.rng.randint(1, 3)) for _ in range(self.count)]
+        self.reports = AdvertisingReportBatch()
+        self.hci.on_data_batch(self.on_data_batch)
+        self.hci.start()
+
+    def on_data_batch(self, batch):
+        reports = self.reports
+        reports.clear()
+        reports.add_events(batch)
+        self.handled += len(batch)
+        if self.handled >= self.count:
+            self.done.set()
+
+    def run(self):
+        self._play(self.packets)
+        self._wait()
+
+
+class AdvertisingFloodBatchMetrics(AdvertisingFloodBatch):
+
+    name = 'adv_flood_metrics'
+    description = 'adv_flood_batch with BluetoothHCI metrics enabled'
+
+    def setup(self):
+        super(AdvertisingFloodBatchMetrics, self).setup()
+        self.hci.enable_metrics()
+
+
+class AdvertisingFlood(Scenario):
+
+    name = 'adv_flood'
+    description = 'LE advertising reports, on_data and decode_event per packet'
+
+    def setup(self):
+        super(AdvertisingFlood, self).setup()
+        self.packets = [adv_report_packet(self.rng, self.rng.randint(1, 3)) for _ in range(self.count)]
+        self.hci.on_data(self.on_data)
+        self.hci.start()
+
+    def on_data(self, data):
+        decode_event(data)
+        self.handled += 1
+        if self.handled >= self.count:
+            self.done.set()
+
+    def run(self):
+        self._play(self.packets)
+        self._wait()
+
+
+class CommandStorm(Scenario):
+
+    name = 'command_storm'
+    description = 'send_command round trips, the controller answers with 4 command credits'
+
+    def setup(self):
+        super(CommandStorm, self).setup()
+        self.hci.start()
+        self.responder = threading.Thread(target=self._respond, name='BenchController')
+        self.responder.setDaemon(True)
+
+    def _respond(self):
+        controller = self.controller
+        for _ in range(self.count):
+            packet = controller.recv(HCI_MAX_PACKET_SIZE)
+            opcode = packet[1] | (packet[2] << 8)
+            controller.send(cmd_complete_packet(opcode, ncmd=4))
+
+    def run(self):
+        self.responder.start()
+        send_command = self.hci.send_command
+        futures = [send_command(LE_SET_SCAN_ENABLE_CMD, b'\x00\x00', timeout=60) for _ in range(self.count)]
+        for future in futures:
+            future.result()
+        self.handled = len(futures)
+        self.responder.join()
+
+
+class ACLReceiveBurst(Scenario):
+
+    name = 'acl_rx_burst'
+    description = 'ACL fragments reassembled into L2CAP frames by ACLManager, 4 handles interleaved'
+
+    def setup(self):
+        super(ACLReceiveBurst, self).setup()
+        self.acl = ACLManager(self.hci)
+        self.acl.on_frame(self.on_frame)
+        self.hci.start()
+
+        # frames of 3 fragments of up to 27 bytes, interleaved round-robin across the handles
+        frames = self.count // 3
+        self.count = frames * 3
+        self.frames = frames
+        self.packets = []
+        for group in range(0, frames, 4):
+            fragments = [acl_fragments(0x40 + n % 4, bytes(bytearray(self.rng.getrandbits(8) for _ in range(60))), 27)
+                         for n in range(group, min(group + 4, frames))]
+            for fragment in range(3):
+                for frame in fragments:
+                    self.packets.append(frame[fragment])
+
+    def on_frame(self, handle, cid, payload):
+        self.handled += 1
+        if self.handled >= self.frames:
+            self.done.set()
+
+    def run(self):
+        self._play(self.packets)
+        self._wait()
+
+
+class ACLTransmitBurst(Scenario):
+
+    name = 'acl_tx_burst'
+    description = 'ACLManager fragmentation with buffer credits, the controller completes every fragment'
+
+    def setup(self):
+        super(ACLTransmitBurst, self).setup()
+        self.acl = ACLManager(self.hci)
+        self.acl.set_buffer_size(27, 8)
+        self.hci.start()
+        self.frames = self.count // 3
+        self.count = self.frames * 3
+        self.payloads = [bytes(bytearray(self.rng.getrandbits(8) for _ in range(60))) for _ in range(self.frames)]
+        self.responder = threading.Thread(target=self._respond, name='BenchController')
+        self.responder.setDaemon(True)
+
+    def _respond(self):
+        controller = self.controller
+        for _ in range(self.count):
+            packet = controller.recv(HCI_MAX_PACKET_SIZE)
+            handle = (packet[1] | (packet[2] << 8)) & 0x0fff
+            controller.send(num_comp_pkts_packet(handle, 1))
+
+    def run(self):
+        self.responder.start()
+        send = self.acl.send
+        for n, payload in enumerate(self.payloads):
+            send(0x40 + n % 4, payload)
+        self.responder.join(60)
+        self.handled = self.count
+
+    def teardown(self):
+        self.acl.close()
+        super(ACLTransmitBurst, self).teardown()
+
+
+SCENARIOS = [AdvertisingFloodBatch, AdvertisingFloodBatchMetrics, AdvertisingFlood, CommandStorm, ACLReceiveBurst, ACLTransmitBurst]
+
+
+# -------------------------------------------------
+# Measurement
+
+def measure(scenario_class, count, repeat=5):
+    # Best of 'repeat' timed runs, then one run under tracemalloc for the memory figures
+    best = None
+    for _ in range(repeat):
+        scenario = scenario_class(count)
+        scenario.setup()
+        try:
+            wall_start, cpu_start = _clock(), time.process_time()
+            scenario.run()
+            wall, cpu = _clock() - wall_start, time.process_time() - cpu_start
+        finally:
+            scenario.teardown()
+        if best is None or wall < best[1]:
+            best = (scenario.count, wall, cpu)
+
+    scenario = scenario_class(count)
+    scenario.setup()
+    try:
+        tracemalloc.start()
+        try:
+            scenario.run()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    finally:
+        scenario.teardown()
+
+    packets, wall, cpu = best
+    return {
+        'packets': packets,
+        'packets_per_sec': packets / wall,
+        'cpu_us_per_packet': cpu * 1e6 / packets,
+        'peak_bytes_per_packet': float(peak) / packets,
+        'retained_bytes_per_packet': float(current) / packets,
+    }
+
+
+def run_benchmarks(count=20000, repeat=5, names=None, log=None):
+    results = {}
+    for scenario_class in SCENARIOS:
+        if names and scenario_class.name not in names:
+            continue
+        results[scenario_class.name] = measure(scenario_class, count, repeat)
+        if log:
+            log(format_result(scenario_class.name, results[scenario_class.name]))
+    return {
+        'format': BENCHMARK_FORMAT,
+        'count': count,
+        'repeat': repeat,
+        'python': platform.python_implementation() + ' ' + platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+
+# -------------------------------------------------
+# Reporting
+
+COLUMNS = ('packets_per_sec', 'cpu_us_per_packet', 'peak_bytes_per_packet', 'retained_bytes_per_packet')
+HEADER = '{:<18} {:>14} {:>14} {:>14} {:>14}'.format('scenario', 'packets/s', 'cpu us/packet',
+                                                   'peak B/packet', 'kept B/packet')
+
+
+def format_result(name, result):
+    return '{:<18} {:>14.0f} {:>14.2f} {:>14.1f} {:>14.1f}'.format(name, *[result[column] for column in COLUMNS])
+
+
+def compare(baseline, current, threshold=0.1):
+    # Returns (report lines, regressions), a regression is a packet rate or CPU time that got more than
+    # 'threshold' (a fraction) worse than the baseline
+    lines = []
+    regressions = []
+    if baseline.get('format') != current.get('format'):
+        return ["Baseline format {} differs from {}, not comparable".format(baseline.get('format'),
+                                                                            current.get('format'))], regressions
+
+    for name, result in sorted(current['results'].items()):
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        rate = result['packets_per_sec'] / old['packets_per_sec'] - 1
+        cpu = result['cpu_us_per_packet'] / old['cpu_us_per_packet'] - 1
+        lines.append('{:<18} packets/s {:+7.1%}   cpu/packet {:+7.1%}'.format(name, rate, cpu))
+        if rate < -threshold or cpu > threshold:
+            regressions.append(name)
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='hcipy receive, decode and dispatch benchmarks')
+    parser.add_argument('-n', '--count', type=int, default=20000, help='packets per scenario')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='timed runs per scenario, the best is kept')
+    parser.add_argument('-s', '--scenario', action='append', help='only run this scenario (repeatable)')
+    parser.add_argument('-o', '--output', help='save the results as JSON')
+    parser.add_argument('--compare', help='JSON results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='regression threshold, default 0.1 (10%%)')
+    args = parser.parse_args(argv)
+
+    print(HEADER)
+    results = run_benchmarks(args.count, args.repeat, args.scenario, log=print)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        lines, regressions = compare(baseline, results, args.threshold)
+        print()
+        for line in lines:
+            print(line)
+        if regressions:
+            print("Regressions: {}".format(', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,5 +4,31 @@
 # email:   wayne@thebubbleworks.com
 # Twitter: https://twitter.com/wkeenan
 
+import sys as _sys
 
+# the GATT procedures (and asyncio support) use Python 3 syntax, fail clearly rather than with a SyntaxError
+if _sys.version_info < (3, 5):
+    raise ImportError("hcipy requires Python 3.5 or later")
+
+from .address import *
+from .advdata import *
 from .hci import *
+from .uart import *
+from .decoder import *
+from .filter import *
+from .router import *
+from .metrics import *
+from .dispatch import *
+from .commands import *
+from .builders import *
+from .advertising import *
+from .extended import *
+from .acl import *
+from .connections import *
+from .gatt import *
+from .gattserver import *
+from .btsnoop import *
+from .dedup import *
+from .devices import *
+from .manager import *
+from .aio import *
@@ -0,0 +1,261 @@
+#!/usr/bin/python
+
+# ACL data path
+#
+# Outgoing L2CAP frames are split into fragments no larger than the controller's LE ACL buffers and
+# only sent while the controller has free buffers (credits), as reported by LE_Read_Buffer_Size and
+# returned by EVT_NUM_COMP_PKTS. Fragments are scheduled round-robin across connection handles so
+# one busy connection can't starve the others.
+# Incoming fragments are reassembled into per-handle preallocated buffers.
+#
+# See: Bluetooth Core Specification, Vol 4, Part E, 4.1 Host to Controller Data Flow Control
+
+import struct
+import threading
+from collections import deque
+
+from .constants import *
+from .decoder import decode_event
+
+
+# indicator, handle & flags, dlen
+_hci_acl_hdr = struct.Struct('<BHH')
+HCI_ACL_HDR_SIZE = _hci_acl_hdr.size
+
+# L2CAP basic header: length, cid
+_l2cap_hdr = struct.Struct('<HH')
+L2CAP_HDR_SIZE = _l2cap_hdr.size
+
+_le_read_buffer_size_rp = struct.Struct('<BHB')         # status, le_acl_data_packet_length, total_num_le_acl_data_packets
+_read_buffer_size_rp = struct.Struct('<BHBHH')          # status, acl_mtu, sco_mtu, acl_max_pkt, sco_max_pkt
+
+
+def acl_handle_pack(handle, flags):
+    return (handle & 0x0fff) | (flags << 12)
+
+
+class _Reassembly(object):
+    __slots__ = ('buffer', 'view', 'length', 'expected')
+
+    def __init__(self, size):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+        self.expected = 0       # complete L2CAP frame size incl. header, 0 when idle
+
+
+class ACLManager(object):
+
+    # packets needed by the ACL layer, see HCIFilter
+    INTERESTS = ((HCI_ACLDATA_PKT,), (HCI_EVENT_PKT, EVT_NUM_COMP_PKTS), (HCI_EVENT_PKT, EVT_DISCONN_COMPLETE))
+
+    def __init__(self, hci, max_frame_size=1024):
+        # hci: a BluetoothHCI, max_frame_size: initial size of the per-handle reassembly buffers
+        self.hci = hci
+        self.max_frame_size = max_frame_size
+        self.max_data_length = 27           # LE default until the buffer size has been read
+        self.total_packets = 1
+        self.credits = 1
+        self.dropped_fragments = 0
+        self._lock = threading.Lock()
+        self._tx_queues = {}                # handle -> deque of [frame, offset]
+        self._tx_ready = deque()            # round-robin order of handles with queued data
+        self._tx_in_flight = {}             # handle -> packets sent but not yet completed
+        self._tx_buffer = bytearray(HCI_ACL_HDR_SIZE + 0xffff)
+        self._rx = {}                       # handle -> _Reassembly
+        self._sent = threading.Condition(self._lock)    # frames left a transmit queue
+        self._frame_listeners = []
+        self._on_frame_user_callback = None
+        hci.add_listener(self._on_packet, self.INTERESTS)
+
+    def close(self):
+        self.hci.remove_listener(self._on_packet)
+
+    # -------------------------------------------------
+    # Controller buffers
+
+    def read_buffer_size(self, timeout=2.0):
+        # Blocks for the command responses, so must not be called from the receive thread (i.e. a callback).
+        event = self.hci.send_command(LE_READ_BUFFER_SIZE_CMD, timeout=timeout).result(timeout)
+        _, length, count = _le_read_buffer_size_rp.unpack_from(event.return_parameters)
+        if not length:
+            # LE and BR/EDR share the ACL buffers
+            event = self.hci.send_command(READ_BUFFER_SIZE_CMD, timeout=timeout).result(timeout)
+            _, length, _, count, _ = _read_buffer_size_rp.unpack_from(event.return_parameters)
+        self.set_buffer_size(length, count)
+        return length, count
+
+    def set_buffer_size(self, max_data_length, total_packets):
+        with self._lock:
+            in_flight = sum(self._tx_in_flight.values())
+            self.max_data_length = max_data_length
+            self.total_packets = total_packets
+            self.credits = max(total_packets - in_flight, 0)
+            self._schedule()
+
+    # -------------------------------------------------
+    # Transmit
+
+    def send(self, handle, payload, cid=ATT_CID):
+        # Queue an L2CAP basic frame (header added here) for the connection handle
+        frame = bytearray(L2CAP_HDR_SIZE + len(payload))
+        _l2cap_hdr.pack_into(frame, 0, len(payload), cid)
+        frame[L2CAP_HDR_SIZE:] = payload
+        with self._lock:
+            queue = self._tx_queues.get(handle)
+            if queue is None:
+                queue = self._tx_queues[handle] = deque()
+            if not queue:
+                self._tx_ready.append(handle)
+            queue.append([frame, 0])
+            self._schedule()
+
+    def pending(self, handle=None):
+        # number of frames not yet fully handed to the controller
+        with self._lock:
+            if handle is not None:
+                return len(self._tx_queues.get(handle, ()))
+            return sum(len(queue) for queue in self._tx_queues.values())
+
+    def wait_pending(self, handle, below, timeout=None):
+        # Block until fewer than below frames are queued for the handle, False on timeout. Used to stream
+        # frames without queueing more than the controller can take next.
+        with self._sent:
+            queues = self._tx_queues
+            return self._sent.wait_for(lambda: len(queues.get(handle, ())) < below, timeout)
+
+    def _schedule(self):
+        # send one fragment per handle in turn while the controller has free buffers, must hold the lock
+        ready = self._tx_ready
+        tx_buffer = self._tx_buffer
+        write = self.hci.write
+        max_data_length = self.max_data_length
+        while self.credits > 0 and ready:
+            handle = ready.popleft()
+            queue = self._tx_queues[handle]
+            entry = queue[0]
+            frame, offset = entry
+            fragment_length = min(len(frame) - offset, max_data_length)
+
+            flags = ACL_START_NO_FLUSH if offset == 0 else ACL_CONT
+            _hci_acl_hdr.pack_into(tx_buffer, 0, HCI_ACLDATA_PKT, acl_handle_pack(handle, flags), fragment_length)
+            tx_buffer[HCI_ACL_HDR_SIZE:HCI_ACL_HDR_SIZE + fragment_length] = frame[offset:offset + fragment_length]
+            write(memoryview(tx_buffer)[:HCI_ACL_HDR_SIZE + fragment_length])
+
+            self.credits -= 1
+            self._tx_in_flight[handle] = self._tx_in_flight.get(handle, 0) + 1
+
+            offset += fragment_length
+            if offset < len(frame):
+                entry[1] = offset
+            else:
+                queue.popleft()
+                self._sent.notify_all()
+            if queue:
+                ready.append(handle)
+
+    # -------------------------------------------------
+    # Receive
+
+    def on_frame(self, callback):
+        # callback(handle, cid, payload), payload is a memoryview only valid during the callback
+        self._on_frame_user_callback = callback
+
+    def add_frame_listener(self, callback):
+        # Internal frame listeners (e.g. the GATT client), called as on_frame callbacks, before it
+        self._frame_listeners = self._frame_listeners + [callback]     # copy on write
+
+    def remove_frame_listener(self, callback):
+        self._frame_listeners = [listener for listener in self._frame_listeners if listener != callback]
+
+    def _on_packet(self, packet):
+        packet_type = packet[0]
+        if packet_type == HCI_ACLDATA_PKT:
+            self._on_acl_data(packet)
+        elif packet_type == HCI_EVENT_PKT:
+            evt = packet[1]
+            if evt == EVT_NUM_COMP_PKTS:
+                self._on_num_comp_pkts(decode_event(packet))
+            elif evt == EVT_DISCONN_COMPLETE:
+                event = decode_event(packet)
+                if event.status == HCI_SUCCESS:
+                    self._on_disconnect(event.handle)
+
+    def _on_num_comp_pkts(self, event):
+        with self._lock:
+            in_flight = self._tx_in_flight
+            for handle, count in zip(event.handles, event.counts):
+                outstanding = in_flight.get(handle, 0)
+                count = min(count, outstanding)
+                if outstanding - count:
+                    in_flight[handle] = outstanding - count
+                else:
+                    in_flight.pop(handle, None)
+                self.credits += count
+            self._schedule()
+
+    def _on_disconnect(self, handle):
+        # the controller frees the buffers of a disconnected handle without reporting them
+        with self._lock:
+            self.credits += self._tx_in_flight.pop(handle, 0)
+            self._tx_queues.pop(handle, None)
+            if handle in self._tx_ready:
+                self._tx_ready.remove(handle)
+            self._rx.pop(handle, None)
+            self._sent.notify_all()
+            self._schedule()
+
+    def _on_acl_data(self, packet):
+        if len(packet) < HCI_ACL_HDR_SIZE:
+            self.dropped_fragments += 1
+            return
+        _, handle_flags, dlen = _hci_acl_hdr.unpack_from(packet)
+        handle = handle_flags & 0x0fff
+        flags = (handle_flags >> 12) & 0x03
+        fragment = packet[HCI_ACL_HDR_SIZE:HCI_ACL_HDR_SIZE + dlen]
+
+        rx = self._rx.get(handle)
+        if len(fragment) != dlen:
+            # truncated packet, the frame it belongs to can't complete either
+            if rx is not None:
+                rx.expected = 0
+            self.dropped_fragments += 1
+            return
+        if rx is None:
+            rx = self._rx[handle] = _Reassembly(self.max_frame_size)
+
+        if flags != ACL_CONT:
+            if rx.expected:
+                self.dropped_fragments += 1          # previous frame never completed
+            if dlen < L2CAP_HDR_SIZE:
+                rx.expected = 0
+                self.dropped_fragments += 1
+                return
+            rx.expected = L2CAP_HDR_SIZE + _l2cap_hdr.unpack_from(fragment)[0]
+            rx.length = 0
+            if rx.expected > len(rx.buffer):
+                rx.buffer = bytearray(rx.expected)
+                rx.view = memoryview(rx.buffer)
+        elif not rx.expected:
+            self.dropped_fragments += 1              # continuation without a start
+            return
+
+        end = rx.length + dlen
+        if end > rx.expected:
+            rx.expected = 0
+            self.dropped_fragments += 1
+            return
+        rx.view[rx.length:end] = fragment
+        rx.length = end
+
+        if end == rx.expected:
+            rx.expected = 0
+            listeners = self._frame_listeners
+            callback = self._on_frame_user_callback
+            if listeners or callback:
+                cid = _l2cap_hdr.unpack_from(rx.buffer, 0)[1]
+                payload = rx.view[L2CAP_HDR_SIZE:end]
+                for listener in listeners:
+                    listener(handle, cid, payload)
+                if callback:
+                    callback(handle, cid, payload)
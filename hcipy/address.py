@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+# Bluetooth device address
+#
+# A BDAddress is a 48-bit int plus the address type (LE_PUBLIC_ADDRESS / LE_RANDOM_ADDRESS), so building
+# one from a received packet, hashing and comparing never involves strings. The canonical
+# 'AA:BB:CC:DD:EE:FF' form is only built when first asked for, and then cached.
+#
+# Decoded events and AdvertisingReportBatch keep addresses as plain 48-bit ints for speed,
+# BDAddress(value, address_type) wraps one when needed.
+
+import struct
+from functools import lru_cache
+
+from .constants import *
+
+
+_bd_addr = struct.Struct('<HI')         # 6 bytes, little endian as in HCI packets
+
+# Random address sub-types, from the two most significant bits
+RANDOM_ADDRESS_NON_RESOLVABLE = 0x0
+RANDOM_ADDRESS_RESOLVABLE = 0x1
+RANDOM_ADDRESS_STATIC = 0x3
+
+
+@lru_cache(maxsize=1024)
+def _parse_address(text):
+    # 'AA:BB:CC:DD:EE:FF', also accepts '-' separators and unpadded / 0x prefixed parts ('0xf5:0x3a:...')
+    parts = text.replace('-', ':').split(':')
+    if len(parts) != 6:
+        raise ValueError("Invalid Bluetooth device address: {!r}".format(text))
+    value = 0
+    for part in parts:
+        octet = int(part, 16)
+        if not 0 <= octet <= 0xff:
+            raise ValueError("Invalid Bluetooth device address: {!r}".format(text))
+        value = (value << 8) | octet
+    return value
+
+
+class BDAddress(object):
+    __slots__ = ('value', 'type', '_text')
+
+    def __init__(self, value, address_type=LE_PUBLIC_ADDRESS):
+        self.value = value                  # 48-bit int, most significant byte first when formatted
+        self.type = address_type
+        self._text = None
+
+    @classmethod
+    def from_bytes(cls, data, address_type=LE_PUBLIC_ADDRESS, offset=0):
+        # data: 6 bytes in HCI (little endian) order, e.g. a slice of a received packet
+        lo, hi = _bd_addr.unpack_from(data, offset)
+        return cls(lo | (hi << 16), address_type)
+
+    @classmethod
+    def parse(cls, text, address_type=LE_PUBLIC_ADDRESS):
+        return cls(_parse_address(text), address_type)
+
+    def to_bytes(self):
+        # 6 bytes in HCI (little endian) order
+        return _bd_addr.pack(self.value & 0xffff, self.value >> 16)
+
+    @property
+    def is_random(self):
+        return self.type == LE_RANDOM_ADDRESS
+
+    @property
+    def random_type(self):
+        # RANDOM_ADDRESS_*, None for public addresses
+        if self.type != LE_RANDOM_ADDRESS:
+            return None
+        return self.value >> 46
+
+    def __str__(self):
+        text = self._text
+        if text is None:
+            value = self.value
+            text = self._text = '{:02X}:{:02X}:{:02X}:{:02X}:{:02X}:{:02X}'.format(
+                (value >> 40) & 0xff, (value >> 32) & 0xff, (value >> 24) & 0xff,
+                (value >> 16) & 0xff, (value >> 8) & 0xff, value & 0xff)
+        return text
+
+    def __repr__(self):
+        return "BDAddress('{}', {})".format(self, 'random' if self.type == LE_RANDOM_ADDRESS else 'public')
+
+    def __int__(self):
+        return self.value
+
+    __index__ = __int__
+
+    def __hash__(self):
+        return hash((self.value, self.type))
+
+    def __eq__(self, other):
+        if not isinstance(other, BDAddress):
+            return NotImplemented
+        return self.value == other.value and self.type == other.type
+
+    def __ne__(self, other):
+        if not isinstance(other, BDAddress):
+            return NotImplemented
+        return self.value != other.value or self.type != other.type
+
+    def __lt__(self, other):
+        return (self.value, self.type) < (other.value, other.type)
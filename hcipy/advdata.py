@@ -0,0 +1,217 @@
+#!/usr/bin/python
+
+# Advertising / EIR data parser
+#
+# AD data is a sequence of length, type, value structures. AdvertisingData scans it once over a
+# memoryview, the first time a field is asked for, and only records where each value is: nothing is
+# copied or decoded until a field is actually used. A scanner filtering on one company ID or service
+# UUID therefore never touches (or allocates for) the rest of the payload.
+#
+#   ad = report.ad
+#   if ad.manufacturer_id == 0x004c:
+#       ...
+#   if ad.has_service_uuid(0xfeaa):
+#       url_frame = ad.service_data(0xfeaa)
+#
+# Malformed data (a structure running past the end) ends the scan, the structures before it are kept.
+# Spec: Bluetooth Core Specification Supplement, Part A
+
+import struct
+import uuid
+
+from .constants import *
+
+
+_uint16 = struct.Struct('<H')
+_uint32 = struct.Struct('<I')
+
+_UUID16_TYPES = (AD_TYPE_INCOMPLETE_16BIT_UUIDS, AD_TYPE_COMPLETE_16BIT_UUIDS)
+_UUID32_TYPES = (AD_TYPE_INCOMPLETE_32BIT_UUIDS, AD_TYPE_COMPLETE_32BIT_UUIDS)
+_UUID128_TYPES = (AD_TYPE_INCOMPLETE_128BIT_UUIDS, AD_TYPE_COMPLETE_128BIT_UUIDS)
+
+
+def _uuid128(value):
+    # 128-bit UUIDs are little endian in AD data
+    return uuid.UUID(bytes=bytes(value[::-1]))
+
+
+class AdvertisingData(object):
+    __slots__ = ('data', '_index')
+
+    def __init__(self, data):
+        # data: the AD structures, e.g. AdvertisingReport.data. Values are memoryviews into it.
+        self.data = data if isinstance(data, memoryview) else memoryview(data)
+        self._index = None              # AD type -> [(start, end), ...] of the values, built on first use
+
+    def _scan(self):
+        index = {}
+        data = self.data
+        end = len(data)
+        offset = 0
+        while offset < end:
+            length = data[offset]
+            if length == 0:             # early terminator / padding
+                break
+            value_end = offset + 1 + length
+            if value_end > end:
+                break
+            location = (offset + 2, value_end)
+            locations = index.get(data[offset + 1])
+            if locations is None:
+                index[data[offset + 1]] = [location]
+            else:
+                locations.append(location)
+            offset = value_end
+        self._index = index
+        return index
+
+    # -------------------------------------------------
+    # Raw access
+
+    def __contains__(self, ad_type):
+        index = self._index if self._index is not None else self._scan()
+        return ad_type in index
+
+    def __iter__(self):
+        # (ad_type, value) for every structure, in index order (not payload order)
+        index = self._index if self._index is not None else self._scan()
+        data = self.data
+        for ad_type, locations in index.items():
+            for start, end in locations:
+                yield ad_type, data[start:end]
+
+    def types(self):
+        index = self._index if self._index is not None else self._scan()
+        return list(index)
+
+    def get(self, ad_type, default=None):
+        # value (memoryview) of the first structure of the type
+        index = self._index if self._index is not None else self._scan()
+        locations = index.get(ad_type)
+        if locations is None:
+            return default
+        start, end = locations[0]
+        return self.data[start:end]
+
+    def get_all(self, ad_type):
+        index = self._index if self._index is not None else self._scan()
+        data = self.data
+        return [data[start:end] for start, end in index.get(ad_type, ())]
+
+    # -------------------------------------------------
+    # Fields
+
+    @property
+    def flags(self):
+        value = self.get(AD_TYPE_FLAGS)
+        return value[0] if value is not None and len(value) else None
+
+    @property
+    def local_name(self):
+        # the complete name, else the shortened one, None if neither is present
+        value = self.get(AD_TYPE_COMPLETE_LOCAL_NAME)
+        if value is None:
+            value = self.get(AD_TYPE_SHORT_LOCAL_NAME)
+            if value is None:
+                return None
+        return bytes(value).decode('utf-8', 'replace')
+
+    @property
+    def tx_power(self):
+        # dBm
+        value = self.get(AD_TYPE_TX_POWER_LEVEL)
+        if value is None or not len(value):
+            return None
+        tx_power = value[0]
+        return tx_power - 256 if tx_power > 127 else tx_power
+
+    @property
+    def appearance(self):
+        value = self.get(AD_TYPE_APPEARANCE)
+        if value is None or len(value) < 2:
+            return None
+        return _uint16.unpack_from(value)[0]
+
+    @property
+    def service_uuids(self):
+        # 16 and 32-bit UUIDs as ints, 128-bit ones as uuid.UUID
+        uuids = []
+        for value in self.get_all(AD_TYPE_INCOMPLETE_16BIT_UUIDS) + self.get_all(AD_TYPE_COMPLETE_16BIT_UUIDS):
+            uuids.extend(_uint16.unpack_from(value, offset)[0] for offset in range(0, len(value) - 1, 2))
+        for value in self.get_all(AD_TYPE_INCOMPLETE_32BIT_UUIDS) + self.get_all(AD_TYPE_COMPLETE_32BIT_UUIDS):
+            uuids.extend(_uint32.unpack_from(value, offset)[0] for offset in range(0, len(value) - 3, 4))
+        for value in self.get_all(AD_TYPE_INCOMPLETE_128BIT_UUIDS) + self.get_all(AD_TYPE_COMPLETE_128BIT_UUIDS):
+            uuids.extend(_uuid128(value[offset:offset + 16]) for offset in range(0, len(value) - 15, 16))
+        return uuids
+
+    def has_service_uuid(self, service_uuid):
+        # service_uuid: a 16 or 32-bit int, or a uuid.UUID. Looks in the UUID lists and the service data,
+        # comparing raw bytes, so nothing is decoded.
+        if isinstance(service_uuid, uuid.UUID):
+            size, target = 16, service_uuid.bytes[::-1]
+            list_types, service_data_type = _UUID128_TYPES, AD_TYPE_SERVICE_DATA_128BIT
+        elif service_uuid <= 0xffff:
+            size, target = 2, _uint16.pack(service_uuid)
+            list_types, service_data_type = _UUID16_TYPES, AD_TYPE_SERVICE_DATA_16BIT
+        else:
+            size, target = 4, _uint32.pack(service_uuid)
+            list_types, service_data_type = _UUID32_TYPES, AD_TYPE_SERVICE_DATA_32BIT
+
+        index = self._index if self._index is not None else self._scan()
+        data = self.data
+        for ad_type in list_types:
+            for start, end in index.get(ad_type, ()):
+                for offset in range(start, end - size + 1, size):
+                    if data[offset:offset + size] == target:
+                        return True
+        for start, end in index.get(service_data_type, ()):
+            if end - start >= size and data[start:start + size] == target:
+                return True
+        return False
+
+    def service_data(self, service_uuid=None):
+        # The data (after the UUID) for one service UUID (int or uuid.UUID), None if not present.
+        # Without a UUID: a list of (uuid, data) for all the service data.
+        if service_uuid is None:
+            items = []
+            for ad_type, size in ((AD_TYPE_SERVICE_DATA_16BIT, 2), (AD_TYPE_SERVICE_DATA_32BIT, 4),
+                                  (AD_TYPE_SERVICE_DATA_128BIT, 16)):
+                for value in self.get_all(ad_type):
+                    if len(value) < size:
+                        continue
+                    if size == 16:
+                        items.append((_uuid128(value[:16]), value[16:]))
+                    else:
+                        items.append(((_uint16 if size == 2 else _uint32).unpack_from(value)[0], value[size:]))
+            return items
+
+        if isinstance(service_uuid, uuid.UUID):
+            ad_type, size, target = AD_TYPE_SERVICE_DATA_128BIT, 16, service_uuid.bytes[::-1]
+        elif service_uuid <= 0xffff:
+            ad_type, size, target = AD_TYPE_SERVICE_DATA_16BIT, 2, _uint16.pack(service_uuid)
+        else:
+            ad_type, size, target = AD_TYPE_SERVICE_DATA_32BIT, 4, _uint32.pack(service_uuid)
+        for value in self.get_all(ad_type):
+            if value[:size] == target:
+                return value[size:]
+        return None
+
+    @property
+    def manufacturer_id(self):
+        # Company identifier of the (first) manufacturer specific data, None if there isn't any
+        value = self.get(AD_TYPE_MANUFACTURER_DATA)
+        if value is None or len(value) < 2:
+            return None
+        return value[0] | (value[1] << 8)
+
+    @property
+    def manufacturer_data(self):
+        # (company_id, data) of the first manufacturer specific data, None if there isn't any
+        value = self.get(AD_TYPE_MANUFACTURER_DATA)
+        if value is None or len(value) < 2:
+            return None
+        return value[0] | (value[1] << 8), value[2:]
+
+    def __repr__(self):
+        return 'AdvertisingData({})'.format(', '.join('0x{:02x}={}'.format(ad_type, bytes(value).hex())
+                                                      for ad_type, value in self))
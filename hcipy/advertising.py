@@ -0,0 +1,309 @@
+#!/usr/bin/python
+
+# Advertising rotation
+#
+# Serves many advertising payloads (Eddystone, iBeacon, custom) from one controller by switching
+# between them in fixed time slots. Everything a slot needs is encoded once, when it's added, into
+# complete command packets, and the scheduler remembers what the controller currently has: moving to
+# the next slot only sends the commands whose packet actually differs. Slots sharing the advertising
+# parameters just replace the data while advertising stays enabled, only a parameter change costs the
+# disable / set parameters / enable sequence.
+#
+# Slots are on an absolute schedule (start + n * period) so timing errors don't accumulate, and when
+# the controller can't keep up slots are skipped (and counted) instead of bursting to catch up.
+# stats() reports the achieved rotation rate next to the requested one.
+#
+#   scheduler = AdvertisingScheduler(hci, rate=20)
+#   scheduler.add(eddystone_url_adv_data('https://www.thebubbleworks.com/'))
+#   scheduler.add(ibeacon_adv_data(beacon_uuid, major=1, minor=2))
+#   scheduler.start()
+
+import concurrent.futures
+import struct
+import threading
+import time
+import traceback
+from functools import lru_cache
+
+from .builders import (LESetAdvertiseEnableCommand, LESetAdvertisingDataCommand, LESetAdvertisingParametersCommand,
+                       LESetScanResponseDataCommand, ADVERTISING_DATA_SIZE)
+from .constants import *
+
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+# -------------------------------------------------
+# Payload encoding
+
+def ad_structure(ad_type, value):
+    # One length, type, value AD structure
+    return bytes(bytearray([len(value) + 1, ad_type])) + bytes(value)
+
+
+# Eddystone-URL, see: https://github.com/google/eddystone/tree/master/eddystone-url
+
+EDDYSTONE_UUID = 0xfeaa
+EDDYSTONE_URL_FRAME = 0x10
+
+EDDYSTONE_URL_SCHEMES = (
+    "http://www.",
+    "https://www.",
+    "http://",
+    "https://",
+)
+
+EDDYSTONE_URL_EXTENSIONS = (
+    ".com/", ".org/", ".edu/", ".net/", ".info/", ".biz/", ".gov/",
+    ".com", ".org", ".edu", ".net", ".info", ".biz", ".gov",
+)
+
+
+@lru_cache(maxsize=256)
+def eddystone_url_encode(url):
+    data = bytearray()
+    for code, scheme in enumerate(EDDYSTONE_URL_SCHEMES):
+        if url.startswith(scheme):
+            data.append(code)
+            i = len(scheme)
+            break
+    else:
+        raise ValueError("Invalid Eddystone URL scheme: {}".format(url))
+
+    while i < len(url):
+        if url[i] == '.':
+            for code, extension in enumerate(EDDYSTONE_URL_EXTENSIONS):
+                if url.startswith(extension, i):
+                    data.append(code)
+                    i += len(extension)
+                    break
+            else:
+                data.append(0x2e)
+                i += 1
+        else:
+            data.append(ord(url[i]))
+            i += 1
+
+    if len(data) > 18:
+        raise ValueError("Encoded Eddystone URL too long (max 18 bytes): {}".format(url))
+    return bytes(data)
+
+
+@lru_cache(maxsize=256)
+def eddystone_url_adv_data(url, tx_power=-19, flags=0x1a):
+    # tx_power: calibrated power at 0m, in dBm
+    uuid = struct.pack('<H', EDDYSTONE_UUID)
+    return (ad_structure(AD_TYPE_FLAGS, bytearray([flags])) +
+            ad_structure(AD_TYPE_COMPLETE_16BIT_UUIDS, uuid) +
+            ad_structure(AD_TYPE_SERVICE_DATA_16BIT, uuid + struct.pack('<Bb', EDDYSTONE_URL_FRAME, tx_power) +
+                         eddystone_url_encode(url)))
+
+
+# iBeacon
+
+IBEACON_COMPANY_ID = 0x004c
+
+
+def ibeacon_adv_data(proximity_uuid, major=0, minor=0, tx_power=-59, flags=0x06):
+    # proximity_uuid: a uuid.UUID, tx_power: measured power at 1m, in dBm
+    return (ad_structure(AD_TYPE_FLAGS, bytearray([flags])) +
+            ad_structure(AD_TYPE_MANUFACTURER_DATA, struct.pack('<HBB', IBEACON_COMPANY_ID, 0x02, 0x15) +
+                         proximity_uuid.bytes + struct.pack('>HHb', major, minor, tx_power)))
+
+
+# -------------------------------------------------
+# Scheduler
+
+class AdvertisingSlot(object):
+    __slots__ = ('name', 'data', 'scan_response', 'parameters', 'parameters_packet', 'data_packet',
+                 'scan_response_packet')
+
+    def __repr__(self):
+        return '<AdvertisingSlot {!r}>'.format(self.name)
+
+
+class AdvertisingScheduler(object):
+
+    def __init__(self, hci, rate=10.0):
+        # hci: a BluetoothHCI, rate: slots per second
+        self.hci = hci
+        self.rate = float(rate)
+        self._slots = []                # replaced (not mutated) on change, the scheduler thread may be iterating
+        self._position = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+
+        # the encoded command packets, shared between slots with the same content
+        self._parameters_builder = LESetAdvertisingParametersCommand()
+        self._data_builder = LESetAdvertisingDataCommand()
+        self._scan_response_builder = LESetScanResponseDataCommand()
+        self._packets = {}
+        self._enable = LESetAdvertiseEnableCommand()
+
+        # what the controller currently has, opcode -> packet
+        self._sent = {}
+        self._advertising = False
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self._slots)
+
+    def add(self, data, scan_response=b'', name=None, **parameters):
+        # parameters: see LESetAdvertisingParametersCommand.build(), by default non-connectable
+        # advertising every 100ms
+        for payload in (data, scan_response):
+            if len(payload) > ADVERTISING_DATA_SIZE:
+                raise ValueError("Advertising data is limited to {} bytes, got {}".format(ADVERTISING_DATA_SIZE,
+                                                                                          len(payload)))
+        parameters.setdefault('advertising_type', ADV_NONCONN_IND)
+        slot = AdvertisingSlot()
+        slot.name = name
+        slot.data = bytes(data)
+        slot.scan_response = bytes(scan_response)
+        slot.parameters = tuple(sorted(parameters.items()))
+        with self._lock:
+            slot.parameters_packet = self._packet((LE_SET_ADVERTISING_PARAMETERS_CMD, slot.parameters),
+                                                  self._parameters_builder.build, **parameters)
+            slot.data_packet = self._packet((LE_SET_ADVERTISING_DATA_CMD, slot.data),
+                                            self._data_builder.build, slot.data)
+            slot.scan_response_packet = self._packet((LE_SET_SCAN_RESPONSE_DATA_CMD, slot.scan_response),
+                                                     self._scan_response_builder.build, slot.scan_response)
+            self._slots = self._slots + [slot]
+        return slot
+
+    def remove(self, slot):
+        with self._lock:
+            self._slots = [other for other in self._slots if other is not slot]
+            used = set()
+            for other in self._slots:
+                used.update(((LE_SET_ADVERTISING_PARAMETERS_CMD, other.parameters),
+                             (LE_SET_ADVERTISING_DATA_CMD, other.data),
+                             (LE_SET_SCAN_RESPONSE_DATA_CMD, other.scan_response)))
+            self._packets = dict((key, packet) for key, packet in self._packets.items() if key in used)
+
+    def _packet(self, key, build, *args, **kwargs):
+        # must hold the lock. The packets are compared by identity in step(), so equal content is one object.
+        packet = self._packets.get(key)
+        if packet is None:
+            packet = self._packets[key] = bytes(build(*args, **kwargs))
+        return packet
+
+    def reset_stats(self):
+        self.rotations = 0              # slots started
+        self.completed = 0              # slots whose commands all succeeded within the slot
+        self.commands_sent = 0
+        self.commands_skipped = 0       # not sent as the controller already had the content
+        self.missed = 0                 # slots skipped as the scheduler was late
+        self.overruns = 0               # slots whose commands were still pending at the end of the slot
+        self.errors = 0
+        self._started = None
+        self._stopped = None
+
+    def stats(self):
+        elapsed = 0.0
+        if self._started is not None:
+            elapsed = (self._stopped or _clock()) - self._started
+        return dict(requested_rate=self.rate, achieved_rate=self.completed / elapsed if elapsed > 0 else 0.0,
+                    rotations=self.rotations, completed=self.completed, commands_sent=self.commands_sent,
+                    commands_skipped=self.commands_skipped, missed=self.missed, overruns=self.overruns,
+                    errors=self.errors, slots=len(self._slots), elapsed=elapsed)
+
+    # -------------------------------------------------
+    # Rotation
+
+    def step(self):
+        # Move to the next slot now, returns the futures of the commands sent
+        slots = self._slots
+        if not slots:
+            return []
+        slot = slots[self._position % len(slots)]
+        self._position += 1
+        self.rotations += 1
+        if self._started is None:
+            self._started = _clock()
+
+        sent = self._sent
+        packets = []
+        parameters_changed = sent.get(LE_SET_ADVERTISING_PARAMETERS_CMD) is not slot.parameters_packet
+        if parameters_changed:
+            # the parameters can't be changed while advertising
+            if self._advertising:
+                packets.append(self._enable.build(False))
+            packets.append(slot.parameters_packet)
+        for opcode, packet in ((LE_SET_ADVERTISING_DATA_CMD, slot.data_packet),
+                               (LE_SET_SCAN_RESPONSE_DATA_CMD, slot.scan_response_packet)):
+            if sent.get(opcode) is not packet:
+                packets.append(packet)
+                sent[opcode] = packet
+            else:
+                self.commands_skipped += 1
+        if parameters_changed or not self._advertising:
+            packets.append(self._enable.build(True))
+        else:
+            self.commands_skipped += 2
+        sent[LE_SET_ADVERTISING_PARAMETERS_CMD] = slot.parameters_packet
+        self._advertising = True
+
+        self.commands_sent += len(packets)
+        return [self.hci.send_command_packet(packet) for packet in packets]
+
+    def _finish(self, futures, timeout):
+        # Wait for the slot's commands until its end, returns False if they aren't all done and successful
+        if futures:
+            done, pending = concurrent.futures.wait(futures, timeout)
+            if pending:
+                self.overruns += 1
+                return False
+            if any(future.exception() is not None for future in done):
+                self.errors += 1
+                # the controller state is unknown, send everything again for the next slot
+                self._sent = {}
+                self._advertising = True
+                return False
+        self.completed += 1
+        return True
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.reset_stats()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='HCIAdvertising')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self, disable=True, timeout=1.0):
+        # Stop rotating, and advertising unless disable is False
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+            self._stopped = _clock()
+        if disable and self._advertising:
+            self._advertising = False
+            try:
+                self.hci.send_command_packet(self._enable.build(False)).result(timeout)
+            except Exception:
+                self._sent = {}
+
+    def _run(self):
+        period = 1.0 / self.rate
+        next_slot = self._started = _clock()
+        while not self._stopping.is_set():
+            next_slot += period
+            try:
+                futures = self.step()
+            except Exception:
+                traceback.print_exc()
+                futures = []
+                self.errors += 1
+            self._finish(futures, max(0.0, next_slot - _clock()))
+
+            now = _clock()
+            if now > next_slot:
+                # late, skip whole slots rather than burst
+                late = int((now - next_slot) / period)
+                self.missed += late
+                next_slot += late * period
+            self._stopping.wait(max(0.0, next_slot - now))
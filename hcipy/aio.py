@@ -0,0 +1,270 @@
+#!/usr/bin/python
+
+# asyncio HCI transport
+#
+# The HCI socket is registered with the event loop (loop.add_reader), so packets are received and
+# delivered on the loop thread itself, there is no poller thread and no call_soon_threadsafe hop.
+
+import asyncio
+import collections
+import fcntl
+import socket
+import struct
+
+from .constants import *
+from .hci import HCI_MAX_PACKET_SIZE
+
+
+# -------------------------------------------------
+# Transport / Protocol
+
+class HCIProtocol(object):
+
+    def connection_made(self, transport):
+        pass
+
+    def packets_received(self, batch):
+        # batch of memoryviews, only valid during the call
+        for packet in batch:
+            self.packet_received(bytearray(packet))
+
+    def packet_received(self, data):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+
+class HCISocketTransport(object):
+
+    def __init__(self, loop, sock, protocol, buffer_pool_size=64 * HCI_MAX_PACKET_SIZE):
+        self._loop = loop
+        self._socket = sock
+        self._protocol = protocol
+        self._buffer_pool = bytearray(max(buffer_pool_size, HCI_MAX_PACKET_SIZE))
+        self._buffer_pool_view = memoryview(self._buffer_pool)
+        self._write_buffer = collections.deque()
+        self._closing = False
+
+        sock.setblocking(False)
+        loop.add_reader(sock.fileno(), self._read_ready)
+        protocol.connection_made(self)
+
+    def _read_ready(self):
+        sock = self._socket
+        pool = self._buffer_pool_view
+        last_offset = len(pool) - HCI_MAX_PACKET_SIZE
+        batch = []
+        offset = 0
+        eof = False
+
+        while offset <= last_offset:
+            try:
+                nbytes = sock.recv_into(pool[offset:offset + HCI_MAX_PACKET_SIZE])
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as exc:
+                self._fatal_error(exc)
+                return
+            if not nbytes:
+                # end of the stream (the peer went away), not an empty packet
+                eof = True
+                break
+            batch.append(pool[offset:offset + nbytes])
+            offset += nbytes
+
+        if batch:
+            self._protocol.packets_received(batch)
+        if eof:
+            self._close(None)
+
+    def write(self, data):
+        if self._closing:
+            raise ConnectionError("HCI transport is closed")
+
+        if not self._write_buffer:
+            try:
+                self._socket.send(data)
+                return
+            except (BlockingIOError, InterruptedError):
+                self._loop.add_writer(self._socket.fileno(), self._write_ready)
+            except OSError as exc:
+                self._fatal_error(exc)
+                return
+
+        # HCI sockets are datagram based, keep packet boundaries
+        self._write_buffer.append(bytes(data))
+
+    def _write_ready(self):
+        while self._write_buffer:
+            try:
+                self._socket.send(self._write_buffer[0])
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:
+                self._fatal_error(exc)
+                return
+            self._write_buffer.popleft()
+
+        self._loop.remove_writer(self._socket.fileno())
+
+    def set_filter(self, data):
+        self._socket.setsockopt(socket.SOL_HCI, socket.HCI_FILTER, data)
+
+    def ioctl(self, cmd, arg):
+        return fcntl.ioctl(self._socket.fileno(), cmd, arg)
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        self._close(None)
+
+    def _fatal_error(self, exc):
+        self._close(exc)
+
+    def _close(self, exc):
+        if self._closing:
+            return
+        self._closing = True
+        fd = self._socket.fileno()
+        self._loop.remove_reader(fd)
+        if self._write_buffer:
+            self._loop.remove_writer(fd)
+            self._write_buffer.clear()
+        self._socket.close()
+        self._loop.call_soon(self._protocol.connection_lost, exc)
+
+
+async def create_hci_transport(protocol_factory, device_id=0, sock=None, loop=None):
+    # sock: an already bound socket to use instead of a new HCI socket (e.g. a socketpair for testing)
+    loop = loop or asyncio.get_event_loop()
+    if sock is None:
+        sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW, socket.BTPROTO_HCI)
+        sock.bind((device_id,))
+    protocol = protocol_factory()
+    transport = HCISocketTransport(loop, sock, protocol)
+    return transport, protocol
+
+
+# -------------------------------------------------
+# asyncio flavour of BluetoothHCI
+
+class AsyncBluetoothHCI(HCIProtocol):
+
+    def __init__(self, device_id=0, sock=None, loop=None, max_queued_events=1024):
+        self.device_id = device_id
+        self.transport = None
+        self.dropped_events = 0
+        self._sock = sock
+        self._loop = loop
+        self._on_data_user_callback = None
+        self._pending_commands = collections.defaultdict(collections.deque)
+        self._max_queued_events = max_queued_events
+        self._events = None
+
+    async def start(self):
+        self._loop = self._loop or asyncio.get_event_loop()
+        await create_hci_transport(lambda: self, self.device_id, self._sock, self._loop)
+
+    def stop(self):
+        if self.transport:
+            self.transport.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.stop()
+
+    # -------------------------------------------------
+    # Protocol callbacks
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        for futures in self._pending_commands.values():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(exc or ConnectionError("HCI transport closed"))
+        self._pending_commands.clear()
+        if self._events is not None:
+            self._events.put_nowait(None)
+
+    def packet_received(self, data):
+        if data[0] == HCI_EVENT_PKT and data[1] in (EVT_CMD_COMPLETE, EVT_CMD_STATUS):
+            self._command_response(data)
+
+        if self._on_data_user_callback:
+            self._on_data_user_callback(data)
+
+        events = self._events
+        if events is not None:
+            if events.full():
+                # favour fresh events, the consumer has fallen behind
+                events.get_nowait()
+                self.dropped_events += 1
+            events.put_nowait(data)
+
+    def _command_response(self, data):
+        # EVT_CMD_COMPLETE: evt, plen, ncmd, opcode  EVT_CMD_STATUS: evt, plen, status, ncmd, opcode
+        offset = 4 if data[1] == EVT_CMD_COMPLETE else 5
+        if len(data) < offset + 2:
+            return
+        opcode = data[offset] | (data[offset + 1] << 8)
+        futures = self._pending_commands.get(opcode)
+        while futures:
+            future = futures.popleft()
+            if not future.done():
+                future.set_result(data)
+                break
+
+    # -------------------------------------------------
+    # Public HCI API
+
+    def on_data(self, callback):
+        self._on_data_user_callback = callback
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def set_filter(self, data):
+        self.transport.set_filter(data)
+
+    async def send_command(self, opcode, params=b'', timeout=2.0):
+        # Returns the EVT_CMD_COMPLETE (or EVT_CMD_STATUS) packet answering the command
+        future = self._loop.create_future()
+        futures = self._pending_commands[opcode]
+        futures.append(future)
+        self.write(struct.pack(HCIPY_HCI_CMD_STRUCT_HEADER, HCI_COMMAND_PKT, opcode, len(params)) + bytes(params))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if future in futures:
+                futures.remove(future)
+
+    async def send_cmd_value(self, cmd, value):
+        # ioctls can block in the kernel (e.g. HCIDEVUP), keep them off the loop thread
+        await self._loop.run_in_executor(None, self.transport.ioctl, cmd, value)
+
+    async def device_up(self):
+        await self.send_cmd_value(HCIDEVUP, self.device_id)
+
+    async def device_down(self):
+        await self.send_cmd_value(HCIDEVDOWN, self.device_id)
+
+    # -------------------------------------------------
+    # async iteration over received packets, e.g. async for data in hci: ...
+
+    def __aiter__(self):
+        if self._events is None:
+            self._events = asyncio.Queue(self._max_queued_events)
+        return self
+
+    async def __anext__(self):
+        data = await self._events.get()
+        if data is None:
+            raise StopAsyncIteration
+        return data
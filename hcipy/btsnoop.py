@@ -0,0 +1,202 @@
+#!/usr/bin/python
+
+# btsnoop capture files
+#
+# BTSnoopWriter records HCI traffic (see BluetoothHCI.capture) with very little overhead on the
+# receive/write paths: records are appended to an in-memory buffer and a background thread writes
+# them out, so the poller never blocks on disk I/O. If the writer falls too far behind records are
+# dropped (and counted in the btsnoop cumulative drops field) rather than stalling the poller.
+#
+# BTSnoopReader memory-maps a capture and replays it at the original timing, scaled, or full speed.
+#
+# Format: https://tools.ietf.org/html/rfc1761 and https://fte.com/webhelpII/hsu/Content/Technical_Information/BT_Snoop_File_Format.htm
+
+import mmap
+import struct
+import threading
+import time
+
+from .constants import *
+
+
+BTSNOOP_MAGIC = b'btsnoop\0'
+BTSNOOP_VERSION = 1
+BTSNOOP_DATALINK_HCI = 1001         # packets without the H4 packet indicator
+BTSNOOP_DATALINK_H4 = 1002          # packets with the H4 packet indicator, as delivered to on_data
+
+BTSNOOP_FLAG_RECEIVED = 0x01        # controller to host, otherwise host to controller
+BTSNOOP_FLAG_COMMAND_EVENT = 0x02   # command or event, otherwise data
+
+# microseconds between 0000-01-01 and the Unix epoch
+BTSNOOP_EPOCH_DELTA = 0x00dcddb30f2f8000
+
+_btsnoop_header = struct.Struct('>8sII')             # magic, version, datalink type
+_btsnoop_record = struct.Struct('>IIIIq')            # original length, included length, flags, drops, timestamp
+
+
+def _btsnoop_timestamp():
+    return int(time.time() * 1000000) + BTSNOOP_EPOCH_DELTA
+
+
+class BTSnoopWriter(object):
+
+    def __init__(self, path, flush_interval=0.5, max_buffer_size=4 * 1024 * 1024):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_buffer_size = max_buffer_size
+        self.dropped = 0
+        self._file = open(path, 'wb')
+        self._file.write(_btsnoop_header.pack(BTSNOOP_MAGIC, BTSNOOP_VERSION, BTSNOOP_DATALINK_H4))
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()         # held from taking the buffer to writing it, keeps records in order
+        self._flush_event = threading.Event()
+        self._keep_running = True
+        self._flush_thread = threading.Thread(target=self._flusher, name='BTSnoopWriter')
+        self._flush_thread.setDaemon(True)
+        self._flush_thread.start()
+
+    def write_packet(self, data, received, timestamp=None):
+        # data: a packet including the H4 packet indicator
+        length = len(data)
+        packet_type = data[0]
+        flags = BTSNOOP_FLAG_RECEIVED if received else 0
+        if packet_type == HCI_COMMAND_PKT or packet_type == HCI_EVENT_PKT:
+            flags |= BTSNOOP_FLAG_COMMAND_EVENT
+        if timestamp is None:
+            timestamp = _btsnoop_timestamp()
+
+        with self._lock:
+            buf = self._buffer
+            if len(buf) + _btsnoop_record.size + length > self.max_buffer_size:
+                self.dropped += 1
+                return
+            buf += _btsnoop_record.pack(length, length, flags, self.dropped, timestamp)
+            buf += data
+
+    def flush(self):
+        # write out whatever is buffered, from the caller's thread. write_packet() only waits for the swap.
+        with self._write_lock:
+            with self._lock:
+                buf, self._buffer = self._buffer, bytearray()
+            if buf:
+                self._file.write(buf)
+                self._file.flush()
+
+    def close(self):
+        if self._flush_thread is None:
+            return
+        self._keep_running = False
+        self._flush_event.set()
+        self._flush_thread.join()
+        self._flush_thread = None
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _flusher(self):
+        while self._keep_running:
+            self._flush_event.wait(self.flush_interval)
+            self.flush()
+
+
+class BTSnoopRecord(object):
+    __slots__ = ('timestamp', 'flags', 'drops', 'data')
+
+    def __init__(self, timestamp, flags, drops, data):
+        self.timestamp = timestamp      # microseconds since 0000-01-01
+        self.flags = flags
+        self.drops = drops
+        self.data = data                # memoryview into the mapped file, including the H4 packet indicator
+                                        # (for datalink type 1002)
+
+    @property
+    def received(self):
+        return bool(self.flags & BTSNOOP_FLAG_RECEIVED)
+
+
+class BTSnoopReader(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        magic, self.version, self.datalink = _btsnoop_header.unpack_from(self._view)
+        if magic != BTSNOOP_MAGIC:
+            self.close()
+            raise ValueError("Not a btsnoop file: {}".format(path))
+        if self.datalink not in (BTSNOOP_DATALINK_HCI, BTSNOOP_DATALINK_H4):
+            self.close()
+            raise ValueError("Unsupported btsnoop datalink type: {}".format(self.datalink))
+
+    def close(self):
+        # Raises BufferError while records or packets (memoryviews) from this reader are still referenced,
+        # release them and close() again.
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __iter__(self):
+        # Records are zero-copy views into the mapped file, only valid until close()
+        view = self._view
+        end = len(view)
+        offset = _btsnoop_header.size
+        while offset + _btsnoop_record.size <= end:
+            _, included_length, flags, drops, timestamp = _btsnoop_record.unpack_from(view, offset)
+            offset += _btsnoop_record.size
+            if offset + included_length > end:
+                break       # truncated, e.g. the capture is still being written
+            yield BTSnoopRecord(timestamp, flags, drops, view[offset:offset + included_length])
+            offset += included_length
+
+    def packets(self, received_only=True):
+        # Packets as delivered to on_data, i.e. with the H4 packet indicator (added for datalink type 1001)
+        h4 = self.datalink == BTSNOOP_DATALINK_H4
+        for record in self:
+            if received_only and not record.received:
+                continue
+            if h4:
+                yield record.timestamp, record.data
+            else:
+                yield record.timestamp, self._h4_packet(record)
+
+    def replay(self, callback, speed=1.0, received_only=True, copy=True):
+        # speed: 1.0 for the original timing, 2.0 twice as fast, ..., None (or 0) as fast as possible
+        # copy: pass a bytearray as on_data does, otherwise a memoryview into the mapped file
+        # Returns the number of packets replayed.
+        clock = getattr(time, 'monotonic', time.time)
+        first_timestamp = None
+        start = clock()
+        count = 0
+        for timestamp, data in self.packets(received_only):
+            if speed:
+                if first_timestamp is None:
+                    first_timestamp = timestamp
+                delay = start + (timestamp - first_timestamp) / 1000000.0 / speed - clock()
+                if delay > 0:
+                    time.sleep(delay)
+            callback(bytearray(data) if copy else data)
+            count += 1
+        return count
+
+    @staticmethod
+    def _h4_packet(record):
+        if record.flags & BTSNOOP_FLAG_COMMAND_EVENT:
+            packet_type = HCI_EVENT_PKT if record.received else HCI_COMMAND_PKT
+        else:
+            packet_type = HCI_ACLDATA_PKT
+        return bytearray([packet_type]) + record.data
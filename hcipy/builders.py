@@ -0,0 +1,372 @@
+#!/usr/bin/python
+
+# HCI command builders
+#
+# Each builder compiles its parameter layout once and packs into a preallocated packet buffer, so
+# building a command costs one pack_into and no allocation. Commands with only a few possible
+# packets (e.g. scan / advertise enable) are fully prebuilt.
+#
+# build() returns a memoryview of the builder's buffer, only valid until its next build(): pass it
+# straight to BluetoothHCI.write() / send_command_packet() (queued commands are copied), and use one
+# builder per thread.
+#
+#   scan_enable = LESetScanEnableCommand()
+#   hci.write(scan_enable.build(True, filter_duplicates=False))
+
+import struct
+
+from .address import BDAddress
+from .constants import *
+
+
+_hci_command_hdr = struct.Struct(HCIPY_HCI_CMD_STRUCT_HEADER)
+HCI_COMMAND_HDR_SIZE = _hci_command_hdr.size
+
+ADVERTISING_DATA_SIZE = 31
+
+
+def _bd_addr_bytes(address):
+    # a BDAddress, 'AA:BB:CC:DD:EE:FF', a 48-bit int or 6 bytes in HCI (little endian) order
+    if isinstance(address, BDAddress):
+        return address.to_bytes()
+    if isinstance(address, str):
+        return BDAddress.parse(address).to_bytes()
+    if isinstance(address, int):
+        return struct.pack('<Q', address)[:6]
+    if len(address) != 6:
+        raise ValueError("Bluetooth device address must be 6 bytes, got {}".format(len(address)))
+    return bytes(address)
+
+
+def _prebuilt_command(opcode, params=b''):
+    return _hci_command_hdr.pack(HCI_COMMAND_PKT, opcode, len(params)) + bytes(params)
+
+
+class HCICommandBuilder(object):
+    # Subclasses set opcode and the struct format of the parameters, and usually wrap build()
+    # with named, defaulted arguments.
+
+    opcode = None
+    params_format = ''
+
+    def __init__(self):
+        self._params = struct.Struct('<' + self.params_format)
+        self.buffer = bytearray(HCI_COMMAND_HDR_SIZE + self._params.size)
+        self._view = memoryview(self.buffer)
+        _hci_command_hdr.pack_into(self.buffer, 0, HCI_COMMAND_PKT, self.opcode, self._params.size)
+
+    def build(self, *params):
+        self._params.pack_into(self.buffer, HCI_COMMAND_HDR_SIZE, *params)
+        return self._view
+
+
+# -------------------------------------------------
+# Parameterless commands
+
+RESET_PACKET = _prebuilt_command(RESET_CMD)
+READ_BUFFER_SIZE_PACKET = _prebuilt_command(READ_BUFFER_SIZE_CMD)
+LE_READ_BUFFER_SIZE_PACKET = _prebuilt_command(LE_READ_BUFFER_SIZE_CMD)
+
+
+# -------------------------------------------------
+# LE Controller commands
+
+class LESetScanParametersCommand(HCICommandBuilder):
+
+    opcode = LE_SET_SCAN_PARAMETERS_CMD
+    params_format = 'BHHBB'         # type, interval, window, own address type, filter policy
+
+    def build(self, scan_type=SCAN_TYPE_ACTIVE, interval=0x0010, window=0x0010,
+              own_address_type=LE_PUBLIC_ADDRESS, filter_policy=FILTER_POLICY_NO_WHITELIST):
+        # interval and window in units of 0.625ms
+        self._params.pack_into(self.buffer, HCI_COMMAND_HDR_SIZE,
+                               scan_type, interval, window, own_address_type, filter_policy)
+        return self._view
+
+
+class LESetScanEnableCommand(object):
+
+    opcode = LE_SET_SCAN_ENABLE_CMD
+
+    # all four possible packets, toggling scanning is just a lookup
+    _packets = {(enable, duplicates): _prebuilt_command(LE_SET_SCAN_ENABLE_CMD, bytearray([enable, duplicates]))
+                for enable in (0, 1) for duplicates in (0, 1)}
+
+    def build(self, enable, filter_duplicates=False):
+        return self._packets[(1 if enable else 0, 1 if filter_duplicates else 0)]
+
+
+class LESetAdvertisingParametersCommand(HCICommandBuilder):
+
+    opcode = LE_SET_ADVERTISING_PARAMETERS_CMD
+    # min interval, max interval, type, own address type, direct address type, direct address,
+    # channel map, filter policy
+    params_format = 'HHBBB6sBB'
+
+    def build(self, min_interval=0x00a0, max_interval=0x00a0, advertising_type=ADV_IND,
+              own_address_type=LE_PUBLIC_ADDRESS, direct_address_type=LE_PUBLIC_ADDRESS,
+              direct_address=b'\0' * 6, channel_map=0x07, filter_policy=FILTER_POLICY_NO_WHITELIST):
+        # intervals in units of 0.625ms, channel_map: bit 0-2 for channels 37-39
+        self._params.pack_into(self.buffer, HCI_COMMAND_HDR_SIZE,
+                               min_interval, max_interval, advertising_type, own_address_type,
+                               direct_address_type, _bd_addr_bytes(direct_address), channel_map, filter_policy)
+        return self._view
+
+
+class LESetAdvertisingDataCommand(HCICommandBuilder):
+
+    opcode = LE_SET_ADVERTISING_DATA_CMD
+    params_format = 'B{}s'.format(ADVERTISING_DATA_SIZE)        # significant length, data (zero padded)
+
+    _zeros = b'\0' * ADVERTISING_DATA_SIZE
+
+    def build(self, data=b''):
+        # data is copied into the packet, no intermediate padded copy
+        length = len(data)
+        if length > ADVERTISING_DATA_SIZE:
+            raise ValueError("Advertising data is limited to {} bytes, got {}".format(ADVERTISING_DATA_SIZE, length))
+        view = self._view
+        start = HCI_COMMAND_HDR_SIZE + 1
+        view[HCI_COMMAND_HDR_SIZE] = length
+        view[start:start + length] = data
+        view[start + length:] = self._zeros[length:]
+        return view
+
+
+class LESetScanResponseDataCommand(LESetAdvertisingDataCommand):
+
+    opcode = LE_SET_SCAN_RESPONSE_DATA_CMD
+
+
+class LESetAdvertiseEnableCommand(object):
+
+    opcode = LE_SET_ADVERTISE_ENABLE_CMD
+
+    _packets = (_prebuilt_command(LE_SET_ADVERTISE_ENABLE_CMD, b'\x00'),
+                _prebuilt_command(LE_SET_ADVERTISE_ENABLE_CMD, b'\x01'))
+
+    def build(self, enable):
+        return self._packets[1 if enable else 0]
+
+
+class LECreateConnectionCommand(HCICommandBuilder):
+
+    opcode = LE_CREATE_CONN_CMD
+    # scan interval, scan window, initiator filter policy, peer address type, peer address, own address type,
+    # min interval, max interval, latency, supervision timeout, min CE length, max CE length
+    params_format = 'HHBB6sBHHHHHH'
+
+    def build(self, peer_address, peer_address_type=LE_PUBLIC_ADDRESS, scan_interval=0x0060, scan_window=0x0030,
+              initiator_filter=0x00, own_address_type=LE_PUBLIC_ADDRESS, min_interval=0x0028, max_interval=0x0038,
+              latency=0x0000, supervision_timeout=0x002a, min_ce_length=0x0000, max_ce_length=0x0000):
+        # scan interval/window in units of 0.625ms, connection intervals in units of 1.25ms,
+        # supervision timeout in units of 10ms
+        self._params.pack_into(self.buffer, HCI_COMMAND_HDR_SIZE,
+                               scan_interval, scan_window, initiator_filter, peer_address_type,
+                               _bd_addr_bytes(peer_address), own_address_type, min_interval, max_interval,
+                               latency, supervision_timeout, min_ce_length, max_ce_length)
+        return self._view
+
+
+LE_CREATE_CONNECTION_CANCEL_PACKET = _prebuilt_command(LE_CREATE_CONN_CANCEL_CMD)
+
+
+class LEConnectionUpdateCommand(HCICommandBuilder):
+
+    opcode = LE_CONN_UPDATE_CMD
+    # handle, min interval, max interval, latency, supervision timeout, min CE length, max CE length
+    params_format = 'HHHHHHH'
+
+    def build(self, handle, min_interval=0x0028, max_interval=0x0038, latency=0x0000, supervision_timeout=0x002a,
+              min_ce_length=0x0000, max_ce_length=0x0000):
+        # intervals in units of 1.25ms, supervision timeout in units of 10ms
+        self._params.pack_into(self.buffer, HCI_COMMAND_HDR_SIZE, handle, min_interval, max_interval, latency,
+                               supervision_timeout, min_ce_length, max_ce_length)
+        return self._view
+
+
+# -------------------------------------------------
+# Link Control commands
+
+class DisconnectCommand(HCICommandBuilder):
+
+    opcode = DISCONNECT_CMD
+    params_format = 'HB'            # handle, reason
+
+    def build(self, handle, reason=HCI_OE_USER_ENDED_CONNECTION):
+        self._params.pack_into(self.buffer, HCI_COMMAND_HDR_SIZE, handle, reason)
+        return self._view
+
+
+# -------------------------------------------------
+# Bluetooth 5 extended scanning and advertising
+
+EXTENDED_ADVERTISING_DATA_SIZE = 251        # per command, longer data is sent in fragments
+EXTENDED_ADVERTISING_DATA_MAX_SIZE = 1650
+
+
+def _uint24(value):
+    return struct.pack('<I', value)[:3]
+
+
+class LESetExtendedScanParametersCommand(object):
+
+    opcode = LE_SET_EXTENDED_SCAN_PARAMETERS_CMD
+
+    def __init__(self):
+        # own address type, filter policy, scanning PHYs, then type, interval, window for each PHY,
+        # one precompiled layout per number of PHYs
+        self._layouts = {}
+        for count in (1, 2):
+            params = struct.Struct('<BBB' + 'BHH' * count)
+            buffer = bytearray(HCI_COMMAND_HDR_SIZE + params.size)
+            _hci_command_hdr.pack_into(buffer, 0, HCI_COMMAND_PKT, self.opcode, params.size)
+            self._layouts[count] = (params, buffer, memoryview(buffer))
+
+    def build(self, scan_type=SCAN_TYPE_ACTIVE, interval=0x0010, window=0x0010, phys=LE_SCAN_PHY_1M | LE_SCAN_PHY_CODED,
+              own_address_type=LE_PUBLIC_ADDRESS, filter_policy=FILTER_POLICY_NO_WHITELIST):
+        # The same type, interval and window (units of 0.625ms) on each of the phys (LE_SCAN_PHY_* bits).
+        # Scanning the Coded PHY too finds long range devices that legacy scanning can't.
+        count = bin(phys & (LE_SCAN_PHY_1M | LE_SCAN_PHY_CODED)).count('1')
+        if not count or phys & ~(LE_SCAN_PHY_1M | LE_SCAN_PHY_CODED):
+            raise ValueError("Invalid scanning PHYs: 0x{:02x}".format(phys))
+        params, buffer, view = self._layouts[count]
+        params.pack_into(buffer, HCI_COMMAND_HDR_SIZE, own_address_type, filter_policy, phys,
+                         *((scan_type, interval, window) * count))
+        return view
+
+
+class LESetExtendedScanEnableCommand(HCICommandBuilder):
+
+    opcode = LE_SET_EXTENDED_SCAN_ENABLE_CMD
+    params_format = 'BBHH'          # enable, filter duplicates, duration, period
+
+    def build(self, enable, filter_duplicates=False, duration=0, period=0):
+        # duration in units of 10ms, period in units of 1.28s, 0 for continuous scanning
+        self._params.pack_into(self.buffer, HCI_COMMAND_HDR_SIZE, 1 if enable else 0,
+                               1 if filter_duplicates else 0, duration, period)
+        return self._view
+
+
+class LESetExtendedAdvertisingParametersCommand(HCICommandBuilder):
+
+    opcode = LE_SET_EXTENDED_ADVERTISING_PARAMETERS_CMD
+    # handle, event properties, min interval, max interval (24-bit), channel map, own address type,
+    # peer address type, peer address, filter policy, tx power, primary PHY, secondary max skip,
+    # secondary PHY, SID, scan request notifications
+    params_format = 'BH3s3sBBB6sBbBBBBB'
+
+    def build(self, handle=0, properties=ADV_PROP_CONNECTABLE | ADV_PROP_SCANNABLE | ADV_PROP_LEGACY,
+              min_interval=0x0000a0, max_interval=0x0000a0, channel_map=0x07, own_address_type=LE_PUBLIC_ADDRESS,
+              peer_address_type=LE_PUBLIC_ADDRESS, peer_address=b'\0' * 6, filter_policy=FILTER_POLICY_NO_WHITELIST,
+              tx_power=ADV_TX_POWER_NO_PREFERENCE, primary_phy=LE_PHY_1M, secondary_max_skip=0,
+              secondary_phy=LE_PHY_1M, sid=0, scan_request_notifications=False):
+        # properties: ADV_PROP_* bits, intervals in units of 0.625ms, tx_power in dBm
+        self._params.pack_into(self.buffer, HCI_COMMAND_HDR_SIZE,
+                               handle, properties, _uint24(min_interval), _uint24(max_interval), channel_map,
+                               own_address_type, peer_address_type, _bd_addr_bytes(peer_address), filter_policy,
+                               tx_power, primary_phy, secondary_max_skip, secondary_phy, sid,
+                               1 if scan_request_notifications else 0)
+        return self._view
+
+
+class LESetExtendedAdvertisingDataCommand(object):
+
+    opcode = LE_SET_EXTENDED_ADVERTISING_DATA_CMD
+    _params = struct.Struct('<BBBB')    # handle, operation, fragment preference, length
+
+    def __init__(self):
+        self.buffer = bytearray(HCI_COMMAND_HDR_SIZE + self._params.size + EXTENDED_ADVERTISING_DATA_SIZE)
+        self._view = memoryview(self.buffer)
+
+    def build(self, handle, data=b'', operation=ADV_DATA_OP_COMPLETE, fragment_preference=0x01):
+        # One command of at most EXTENDED_ADVERTISING_DATA_SIZE bytes of data, the packet is only as long as needed
+        length = len(data)
+        if length > EXTENDED_ADVERTISING_DATA_SIZE:
+            raise ValueError("Extended advertising data is limited to {} bytes per command, got {}".format(
+                EXTENDED_ADVERTISING_DATA_SIZE, length))
+        start = HCI_COMMAND_HDR_SIZE + self._params.size
+        _hci_command_hdr.pack_into(self.buffer, 0, HCI_COMMAND_PKT, self.opcode, self._params.size + length)
+        self._params.pack_into(self.buffer, HCI_COMMAND_HDR_SIZE, handle, operation, fragment_preference, length)
+        view = self._view
+        view[start:start + length] = data
+        return view[:start + length]
+
+    def fragments(self, handle, data, fragment_preference=0x01):
+        # All the packets (copies) needed to set data of any length up to EXTENDED_ADVERTISING_DATA_MAX_SIZE
+        if len(data) > EXTENDED_ADVERTISING_DATA_MAX_SIZE:
+            raise ValueError("Extended advertising data is limited to {} bytes, got {}".format(
+                EXTENDED_ADVERTISING_DATA_MAX_SIZE, len(data)))
+        if len(data) <= EXTENDED_ADVERTISING_DATA_SIZE:
+            return [bytes(self.build(handle, data, ADV_DATA_OP_COMPLETE, fragment_preference))]
+        data = memoryview(data)
+        packets = []
+        for offset in range(0, len(data), EXTENDED_ADVERTISING_DATA_SIZE):
+            if offset == 0:
+                operation = ADV_DATA_OP_FIRST
+            elif offset + EXTENDED_ADVERTISING_DATA_SIZE >= len(data):
+                operation = ADV_DATA_OP_LAST
+            else:
+                operation = ADV_DATA_OP_INTERMEDIATE
+            packets.append(bytes(self.build(handle, data[offset:offset + EXTENDED_ADVERTISING_DATA_SIZE],
+                                            operation, fragment_preference)))
+        return packets
+
+
+class LESetExtendedScanResponseDataCommand(LESetExtendedAdvertisingDataCommand):
+
+    opcode = LE_SET_EXTENDED_SCAN_RESPONSE_DATA_CMD
+
+
+class LESetExtendedAdvertisingEnableCommand(object):
+
+    opcode = LE_SET_EXTENDED_ADVERTISING_ENABLE_CMD
+    _params = struct.Struct('<BB')      # enable, number of sets
+    _set = struct.Struct('<BHB')        # handle, duration, max extended advertising events
+    MAX_SETS = (255 - 2) // 4           # as many as fit in the parameters of one command
+
+    def __init__(self):
+        self.buffer = bytearray(HCI_COMMAND_HDR_SIZE + self._params.size + self.MAX_SETS * self._set.size)
+        self._view = memoryview(self.buffer)
+
+    def build(self, enable, sets=()):
+        # One command for several sets. sets: handles, or (handle, duration in units of 10ms, max events)
+        # tuples; no sets with enable False disables all of them. The packet is only as long as needed.
+        count = len(sets)
+        if count > self.MAX_SETS:
+            raise ValueError("At most {} advertising sets per command, got {}".format(self.MAX_SETS, count))
+        length = self._params.size + count * self._set.size
+        _hci_command_hdr.pack_into(self.buffer, 0, HCI_COMMAND_PKT, self.opcode, length)
+        self._params.pack_into(self.buffer, HCI_COMMAND_HDR_SIZE, 1 if enable else 0, count)
+        offset = HCI_COMMAND_HDR_SIZE + self._params.size
+        for advertising_set in sets:
+            if isinstance(advertising_set, int):
+                advertising_set = (advertising_set, 0, 0)
+            self._set.pack_into(self.buffer, offset, *advertising_set)
+            offset += self._set.size
+        return self._view[:offset]
+
+
+class LESetAdvertisingSetRandomAddressCommand(HCICommandBuilder):
+
+    opcode = LE_SET_ADVERTISING_SET_RANDOM_ADDRESS_CMD
+    params_format = 'B6s'           # handle, address
+
+    def build(self, handle, address):
+        self._params.pack_into(self.buffer, HCI_COMMAND_HDR_SIZE, handle, _bd_addr_bytes(address))
+        return self._view
+
+
+class LERemoveAdvertisingSetCommand(HCICommandBuilder):
+
+    opcode = LE_REMOVE_ADVERTISING_SET_CMD
+    params_format = 'B'             # handle
+
+    def build(self, handle):
+        self._params.pack_into(self.buffer, HCI_COMMAND_HDR_SIZE, handle)
+        return self._view
+
+
+LE_CLEAR_ADVERTISING_SETS_PACKET = _prebuilt_command(LE_CLEAR_ADVERTISING_SETS_CMD)
+LE_READ_MAXIMUM_ADVERTISING_DATA_LENGTH_PACKET = _prebuilt_command(LE_READ_MAXIMUM_ADVERTISING_DATA_LENGTH_CMD)
+LE_READ_NUMBER_OF_SUPPORTED_ADVERTISING_SETS_PACKET = _prebuilt_command(LE_READ_NUMBER_OF_SUPPORTED_ADVERTISING_SETS_CMD)
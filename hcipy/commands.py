@@ -0,0 +1,168 @@
+#!/usr/bin/python
+
+# HCI command queue with Num_HCI_Command_Packets flow control
+#
+# The controller tells the host, in every EVT_CMD_COMPLETE / EVT_CMD_STATUS, how many commands it
+# can currently accept. Commands are pipelined up to that credit and queued beyond it, and each
+# command gets a Future that resolves with its decoded response (CommandComplete or CommandStatus),
+# so command sequences can run back-to-back without sleeps or guessing which response is whose.
+
+import concurrent.futures
+import struct
+import threading
+import time
+from collections import deque
+
+from .constants import *
+from .decoder import decode_event
+
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class HCICommandError(Exception):
+
+    def __init__(self, event):
+        super(HCICommandError, self).__init__("HCI command 0x{:04x} failed with status 0x{:02x}".format(event.opcode, event.status))
+        self.event = event
+        self.opcode = event.opcode
+        self.status = event.status
+
+
+class HCICommandQueue(object):
+
+    def __init__(self, write, timeout=2.0):
+        # write: callable used to send a complete HCI command packet
+        self.timeout = timeout
+        self.credits = 1            # the host may assume one command credit after power up / reset
+        self.metrics = None         # an HCIMetrics, see BluetoothHCI(metrics=True)
+        self._write = write
+        self._queued = deque()      # [deadline, opcode, packet, future, submitted], not sent yet
+        self._in_flight = deque()   # [deadline, opcode, packet, future, submitted], sent, waiting for a response
+        self._condition = threading.Condition()
+        self._timeout_thread = None
+        self._keep_running = True
+
+    def __len__(self):
+        return len(self._queued) + len(self._in_flight)
+
+    def submit(self, opcode, params=b'', timeout=None):
+        packet = struct.pack(HCIPY_HCI_CMD_STRUCT_HEADER, HCI_COMMAND_PKT, opcode, len(params)) + bytes(params)
+        return self._submit(opcode, packet, timeout)
+
+    def submit_packet(self, packet, timeout=None):
+        # packet: a complete HCI command packet, including the packet indicator
+        opcode = packet[1] | (packet[2] << 8)
+        return self._submit(opcode, packet, timeout)
+
+    def _submit(self, opcode, packet, timeout):
+        future = concurrent.futures.Future()
+        submitted = _clock()
+        deadline = submitted + (self.timeout if timeout is None else timeout)
+        with self._condition:
+            if self._timeout_thread is None:
+                self._start_timeout_thread()
+
+            if self.credits > 0 and not self._queued:
+                self.credits -= 1
+                self._in_flight.append([deadline, opcode, None, future, submitted])
+                self._write(packet)
+                if self.metrics is not None:
+                    self.metrics.command_sent()
+            else:
+                # copy, as the caller may reuse its buffer before the packet is actually sent
+                self._queued.append([deadline, opcode, bytes(packet), future, submitted])
+            self._condition.notify()
+        return future
+
+    def on_event(self, data):
+        # Feed EVT_CMD_COMPLETE / EVT_CMD_STATUS packets, returns the decoded event
+        event = decode_event(data)
+        if event is None:
+            return None
+
+        with self._condition:
+            self.credits = event.ncmd
+            if event.opcode:        # opcode 0x0000 (NOP) only updates the credits
+                for entry in self._in_flight:
+                    if entry[1] == event.opcode:
+                        self._in_flight.remove(entry)
+                        if self.metrics is not None:
+                            # round trip as seen by the caller, i.e. including any time spent queued
+                            self.metrics.command_completed(entry[1], _clock() - entry[4])
+                        self._resolve(entry[3], event)
+                        break
+            self._pump()
+        return event
+
+    def flush(self, exc=None):
+        # Fail every queued and in-flight command, e.g. when the transport is closed
+        with self._condition:
+            exc = exc or IOError("HCI command queue flushed")
+            for entries in (self._queued, self._in_flight):
+                while entries:
+                    future = entries.popleft()[3]
+                    if not future.done():
+                        future.set_exception(exc)
+            self.credits = 1
+
+    def close(self):
+        self.flush()
+        with self._condition:
+            self._keep_running = False
+            self._condition.notify()
+        thread = self._timeout_thread
+        if thread is not None:
+            if thread is not threading.current_thread():     # closed from a timed out command's callback
+                thread.join()
+            self._timeout_thread = None
+
+    def _resolve(self, future, event):
+        if future.done():           # cancelled by the caller
+            return
+        if event.status:
+            future.set_exception(HCICommandError(event))
+        else:
+            future.set_result(event)
+
+    def _pump(self):
+        # send as many queued commands as the controller currently accepts, must hold the lock
+        queued = self._queued
+        while self.credits > 0 and queued:
+            entry = queued.popleft()
+            if entry[3].done():
+                continue
+            self.credits -= 1
+            packet = entry[2]
+            entry[2] = None
+            self._in_flight.append(entry)
+            self._write(packet)
+            if self.metrics is not None:
+                self.metrics.command_sent()
+
+    def _start_timeout_thread(self):
+        self._keep_running = True
+        self._timeout_thread = threading.Thread(target=self._timeout_loop, name='HCICommandTimeout')
+        self._timeout_thread.setDaemon(True)
+        self._timeout_thread.start()
+
+    def _timeout_loop(self):
+        with self._condition:
+            while self._keep_running:
+                now = _clock()
+                next_deadline = None
+                for entries in (self._in_flight, self._queued):
+                    for entry in list(entries):
+                        if entry[0] <= now:
+                            entries.remove(entry)
+                            if entries is self._in_flight:
+                                # assume the controller lost it and give the credit back
+                                self.credits = max(self.credits, 1)
+                            if self.metrics is not None:
+                                self.metrics.command_timed_out(entry[1])
+                            if not entry[3].done():
+                                entry[3].set_exception(concurrent.futures.TimeoutError("HCI command 0x{:04x} timed out".format(entry[1])))
+                        elif next_deadline is None or entry[0] < next_deadline:
+                            next_deadline = entry[0]
+                self._pump()
+                self._condition.wait(None if next_deadline is None else next_deadline - now)
@@ -0,0 +1,373 @@
+#!/usr/bin/python
+
+# LE connection manager
+#
+# The controller only runs one LE Create Connection at a time. ConnectionManager queues connect
+# requests and feeds them through that single initiator slot back-to-back, each with a timeout after
+# which the attempt is cancelled (LE Create Connection Cancel) and the next one started, so one
+# unreachable device doesn't hold up the others. Established connections are kept in a table indexed
+# by handle, with their role, parameters and timestamps.
+#
+# connect(), disconnect() and update_parameters() return concurrent.futures.Futures:
+#
+#   connections = ConnectionManager(hci)
+#   futures = [connections.connect(address, LE_RANDOM_ADDRESS) for address in sensors]
+#   for future in concurrent.futures.as_completed(futures):
+#       connection = future.result()
+#       ...
+#       connections.disconnect(connection.handle)
+#
+# A connect future can be cancelled, also while it's the one being attempted.
+
+import concurrent.futures
+import threading
+import time
+from collections import deque
+
+from .address import BDAddress
+from .builders import (LECreateConnectionCommand, LEConnectionUpdateCommand, DisconnectCommand,
+                       LE_CREATE_CONNECTION_CANCEL_PACKET)
+from .constants import *
+from .decoder import decode_event
+
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class HCIConnectionError(Exception):
+
+    def __init__(self, status, message="LE connection failed"):
+        super(HCIConnectionError, self).__init__("{} with status 0x{:02x}".format(message, status))
+        self.status = status
+
+
+def _address(address, address_type):
+    # a BDAddress, 'AA:BB:CC:DD:EE:FF', a 48-bit int or 6 bytes in HCI (little endian) order
+    if isinstance(address, BDAddress):
+        return address
+    if isinstance(address, str):
+        return BDAddress.parse(address, address_type)
+    if isinstance(address, int):
+        return BDAddress(address, address_type)
+    return BDAddress.from_bytes(address, address_type)
+
+
+class Connection(object):
+    __slots__ = ('handle', 'address', 'role', 'interval', 'latency', 'supervision_timeout', 'master_clock_accuracy',
+                 'connected_at', 'updated_at', 'disconnected', '_update')
+
+    def __init__(self, event, connected_at):
+        self.handle = event.handle
+        self.address = event.peer_bd_address
+        self.role = event.role                          # LE_ROLE_MASTER when we connected
+        self.interval = event.interval                  # units of 1.25ms
+        self.latency = event.latency
+        self.supervision_timeout = event.supervision_timeout  # units of 10ms
+        self.master_clock_accuracy = event.master_clock_accuracy
+        self.connected_at = connected_at                # time.monotonic()
+        self.updated_at = connected_at                  # of the parameters
+        self.disconnected = concurrent.futures.Future()  # resolves with the reason
+        self._update = None                             # future of the pending parameter update
+
+    def __repr__(self):
+        return '<Connection 0x{:04x} {} {}>'.format(self.handle, self.address,
+                                                    'master' if self.role == LE_ROLE_MASTER else 'slave')
+
+
+class _ConnectRequest(object):
+    __slots__ = ('address', 'parameters', 'future', 'timeout', 'deadline', 'cancelling', 'timed_out')
+
+    def __init__(self, address, parameters, timeout):
+        self.address = address
+        self.parameters = parameters
+        self.future = concurrent.futures.Future()
+        self.timeout = timeout
+        self.deadline = None
+        self.cancelling = False
+        self.timed_out = False
+
+
+class ConnectionManager(object):
+
+    # packets needed by the connection manager, see HCIFilter
+    INTERESTS = ((HCI_EVENT_PKT, EVT_LE_META_EVENT), (HCI_EVENT_PKT, EVT_DISCONN_COMPLETE))
+
+    def __init__(self, hci, timeout=5.0, **parameters):
+        # hci: a BluetoothHCI, timeout: of each connection attempt, in seconds
+        # parameters: defaults for connect(), see LECreateConnectionCommand.build()
+        self.hci = hci
+        self.timeout = timeout
+        self.parameters = parameters
+        self.connections = {}               # handle -> Connection
+        self.connected = 0
+        self.failed = 0
+        self.timed_out = 0
+        self._queue = deque()               # _ConnectRequest, waiting for the initiator
+        self._current = None                # _ConnectRequest being attempted
+        self._condition = threading.Condition()
+        self._create_connection = LECreateConnectionCommand()
+        self._connection_update = LEConnectionUpdateCommand()
+        self._disconnect = DisconnectCommand()
+        self._on_connection_user_callback = None
+        self._on_disconnection_user_callback = None
+        self._keep_running = True
+        self._timeout_thread = threading.Thread(target=self._timeout_loop, name='HCIConnectionTimeout')
+        self._timeout_thread.setDaemon(True)
+        self._timeout_thread.start()
+        hci.add_listener(self._on_packet, self.INTERESTS)
+
+    # Commands are never sent while holding the condition: command responses are handled with the command
+    # queue's lock held and may need it.
+
+    def close(self):
+        # Stop, failing the queued requests. Established connections are left as they are.
+        self.hci.remove_listener(self._on_packet)
+        with self._condition:
+            self._keep_running = False
+            requests = list(self._queue)
+            self._queue.clear()
+            if self._current is not None:
+                requests.append(self._current)
+                self._current = None
+            self._condition.notify()
+        self._timeout_thread.join()
+        for request in requests:
+            if not request.future.done():
+                request.future.set_exception(IOError("Connection manager closed"))
+
+    def __len__(self):
+        return len(self.connections)
+
+    def __getitem__(self, handle):
+        return self.connections[handle]
+
+    def find(self, address):
+        # the connection to a BDAddress, None if not connected
+        for connection in list(self.connections.values()):
+            if connection.address == address:
+                return connection
+        return None
+
+    def pending(self):
+        # connect requests not yet completed, including the one being attempted
+        with self._condition:
+            return len(self._queue) + (self._current is not None)
+
+    def on_connection(self, callback):
+        # callback(connection) for every new connection, including those the remote initiated
+        self._on_connection_user_callback = callback
+
+    def on_disconnection(self, callback):
+        # callback(connection, reason)
+        self._on_disconnection_user_callback = callback
+
+    # -------------------------------------------------
+    # Connecting
+
+    def connect(self, address, address_type=LE_PUBLIC_ADDRESS, timeout=None, **parameters):
+        # Returns a Future resolving with the Connection, or failing with HCIConnectionError, HCICommandError or
+        # concurrent.futures.TimeoutError. parameters override the defaults given to the manager.
+        address = _address(address, address_type)
+        if parameters:
+            parameters = dict(self.parameters, **parameters)
+        else:
+            parameters = self.parameters
+        request = _ConnectRequest(address, parameters, self.timeout if timeout is None else timeout)
+        request.future.add_done_callback(self._on_request_done)
+        with self._condition:
+            if not self._keep_running:
+                raise IOError("Connection manager closed")
+            self._queue.append(request)
+            start = self._next()
+        self._start(start)
+        return request.future
+
+    def _next(self):
+        # Take the next request for the initiator if it's free, must hold the condition.
+        # Returns (request, packet) to pass to _start(), outside the condition.
+        if self._current is not None:
+            return None
+        queue = self._queue
+        while queue:
+            request = queue.popleft()
+            if request.future.done():           # cancelled while queued
+                continue
+            self._current = request
+            request.deadline = _clock() + request.timeout
+            self._condition.notify()
+            packet = bytes(self._create_connection.build(request.address, request.address.type, **request.parameters))
+            return request, packet
+        return None
+
+    def _start(self, start):
+        if start is None:
+            return
+        request, packet = start
+        self.hci.send_command_packet(packet).add_done_callback(lambda future: self._on_create_status(request, future))
+
+    def _on_create_status(self, request, future):
+        # The Command Status of LE Create Connection, a failure ends the attempt
+        if future.cancelled() or future.exception() is None:
+            return
+        with self._condition:
+            if self._current is not request:
+                return
+            self._current = None
+            self.failed += 1
+            start = self._next()
+        if not request.future.done():
+            request.future.set_exception(future.exception())
+        self._start(start)
+
+    def _on_request_done(self, future):
+        # cancelling the attempt in progress cancels the LE Create Connection
+        if not future.cancelled():
+            return
+        with self._condition:
+            request = self._current
+            if request is None or request.future is not future or request.cancelling:
+                return
+            request.cancelling = True
+        self._cancel()
+
+    def _cancel(self):
+        # the controller ends the attempt with an LE Connection Complete (HCI_UNKNOWN_CONNECTION_ID), unless the
+        # connection was established meanwhile, when the cancel fails with HCI_COMMAND_DISALLOWED
+        self.hci.send_command_packet(LE_CREATE_CONNECTION_CANCEL_PACKET)
+
+    def _timeout_loop(self):
+        while True:
+            with self._condition:
+                if not self._keep_running:
+                    return
+                request = self._current
+                if request is None or request.cancelling:
+                    self._condition.wait()
+                    continue
+                now = _clock()
+                if request.deadline > now:
+                    self._condition.wait(request.deadline - now)
+                    continue
+                request.cancelling = True
+                request.timed_out = True
+            self._cancel()
+
+    # -------------------------------------------------
+    # Established connections
+
+    def disconnect(self, handle, reason=HCI_OE_USER_ENDED_CONNECTION):
+        # Returns the connection's disconnected Future, resolving with the reason on Disconnection Complete
+        with self._condition:
+            connection = self.connections[handle]
+            packet = bytes(self._disconnect.build(handle, reason))
+        self.hci.send_command_packet(packet).add_done_callback(
+            lambda future: self._on_command_failure(future, connection.disconnected))
+        return connection.disconnected
+
+    def update_parameters(self, handle, min_interval, max_interval, latency=0x0000, supervision_timeout=0x002a,
+                          min_ce_length=0x0000, max_ce_length=0x0000):
+        # Returns a Future resolving with the (updated) Connection on LE Connection Update Complete.
+        # Intervals in units of 1.25ms, supervision timeout in units of 10ms.
+        with self._condition:
+            connection = self.connections[handle]
+            if connection._update is not None and not connection._update.done():
+                raise ValueError("A parameter update is already pending for handle 0x{:04x}".format(handle))
+            update = connection._update = concurrent.futures.Future()
+            packet = bytes(self._connection_update.build(handle, min_interval, max_interval, latency,
+                                                         supervision_timeout, min_ce_length, max_ce_length))
+        self.hci.send_command_packet(packet).add_done_callback(lambda future: self._on_command_failure(future, update))
+        return update
+
+    @staticmethod
+    def _on_command_failure(future, result):
+        if not future.cancelled() and future.exception() is not None and not result.done():
+            result.set_exception(future.exception())
+
+    # -------------------------------------------------
+    # Events
+
+    def _on_packet(self, packet):
+        event = packet[1]
+        if event == EVT_LE_META_EVENT:
+            subevent = packet[3]
+            if subevent == EVT_LE_CONN_COMPLETE:
+                self._on_connection_complete(decode_event(packet))
+            elif subevent == EVT_LE_CONN_UPDATE_COMPLETE:
+                self._on_connection_update_complete(decode_event(packet))
+        elif event == EVT_DISCONN_COMPLETE:
+            self._on_disconnection_complete(decode_event(packet))
+
+    def _on_connection_complete(self, event):
+        connection = None
+        request = None
+        start = None
+        with self._condition:
+            if event.status == HCI_SUCCESS:
+                connection = Connection(event, _clock())
+                self.connections[event.handle] = connection
+            # the initiator slot is exclusive, so a master role connection (or failure) is the current attempt's
+            if self._current is not None and (event.status != HCI_SUCCESS or event.role == LE_ROLE_MASTER):
+                request = self._current
+                self._current = None
+                if connection is not None:
+                    self.connected += 1
+                elif request.timed_out:
+                    self.timed_out += 1
+                else:
+                    self.failed += 1
+                start = self._next()
+
+        if request is not None:
+            future = request.future
+            if connection is not None:
+                if future.cancelled():
+                    # too late to cancel, the caller doesn't want it anymore
+                    self.disconnect(connection.handle)
+                elif not future.done():
+                    future.set_result(connection)
+            elif not future.done():
+                if request.timed_out:
+                    future.set_exception(concurrent.futures.TimeoutError(
+                        "LE connection to {} timed out".format(request.address)))
+                else:
+                    future.set_exception(HCIConnectionError(event.status))
+
+        if connection is not None:
+            callback = self._on_connection_user_callback
+            if callback:
+                callback(connection)
+        self._start(start)
+
+    def _on_connection_update_complete(self, event):
+        with self._condition:
+            connection = self.connections.get(event.handle)
+            if connection is None:
+                return
+            if event.status == HCI_SUCCESS:
+                connection.interval = event.interval
+                connection.latency = event.latency
+                connection.supervision_timeout = event.supervision_timeout
+                connection.updated_at = _clock()
+            update = connection._update
+            connection._update = None
+        if update is not None and not update.done():
+            if event.status == HCI_SUCCESS:
+                update.set_result(connection)
+            else:
+                update.set_exception(HCIConnectionError(event.status, "LE connection update failed"))
+
+    def _on_disconnection_complete(self, event):
+        if event.status != HCI_SUCCESS:
+            return
+        with self._condition:
+            connection = self.connections.pop(event.handle, None)
+        if connection is None:
+            return
+        update = connection._update
+        if update is not None and not update.done():
+            update.set_exception(HCIConnectionError(event.reason, "Disconnected"))
+        if not connection.disconnected.done():
+            connection.disconnected.set_result(event.reason)
+        callback = self._on_disconnection_user_callback
+        if callback:
+            callback(connection, event.reason)
@@ -18,7 +18,12 @@ HCIGETDEVINFO = -2147202861 #0x800448d3L  # _IOR(ord('H'), 211, 4)
 # HCI Status
 
 HCI_SUCCESS = 0x00
+HCI_UNKNOWN_CONNECTION_ID = 0x02            # e.g. LE Create Connection cancelled
+HCI_CONNECTION_TIMEOUT = 0x08
+HCI_COMMAND_DISALLOWED = 0x0c
 HCI_OE_USER_ENDED_CONNECTION = 0x13
+HCI_CONNECTION_TERMINATED = 0x16            # by the local host
+HCI_CONNECTION_FAILED_TO_ESTABLISH = 0x3e
 
 
 
@@ -27,6 +32,13 @@ HCI_OE_USER_ENDED_CONNECTION = 0x13
 LE_PUBLIC_ADDRESS = 0x00
 LE_RANDOM_ADDRESS = 0x01
 
+# RSSI (and TX power) of advertising reports when the controller can't measure it
+RSSI_NOT_AVAILABLE = 127
+
+# Role in LE Connection Complete
+LE_ROLE_MASTER = 0x00
+LE_ROLE_SLAVE = 0x01
+
 # Types of bluetooth scan
 
 SCAN_TYPE_PASSIVE = 0x00
@@ -49,14 +61,53 @@ FILTER_POLICY_CONN_WHITELIST = 0x02  # Allow Scan Request from Any, Connect Requ
 FILTER_POLICY_SCAN_AND_CONN_WHITELIST = 0x03  # Allow Scan Request from White List Only, Connect Request from White List Only
 
 
+# Bluetooth 5 PHYs (Core_v5.0.pdf Vol 2 Part E section 7.8.53 onwards)
+LE_PHY_1M = 0x01
+LE_PHY_2M = 0x02
+LE_PHY_CODED = 0x03
+LE_PHY_NONE = 0x00                  # e.g. no secondary advertising channel (legacy PDUs)
+
+# Scanning_PHYs bits of LE Set Extended Scan Parameters
+LE_SCAN_PHY_1M = 0x01
+LE_SCAN_PHY_CODED = 0x04
+
+# Extended advertising event properties, and the matching bits of the extended report event type
+ADV_PROP_CONNECTABLE = 0x0001
+ADV_PROP_SCANNABLE = 0x0002
+ADV_PROP_DIRECTED = 0x0004
+ADV_PROP_HIGH_DUTY_DIRECTED = 0x0008
+ADV_PROP_LEGACY = 0x0010
+ADV_PROP_ANONYMOUS = 0x0020
+ADV_PROP_INCLUDE_TX_POWER = 0x0040
+EXT_ADV_EVT_SCAN_RESPONSE = 0x0008
+EXT_ADV_EVT_LEGACY = 0x0010
+
+# Data status, bits 5-6 of the extended report event type
+EXT_ADV_DATA_COMPLETE = 0x00
+EXT_ADV_DATA_INCOMPLETE = 0x01      # more to come in the next report
+EXT_ADV_DATA_TRUNCATED = 0x02       # incomplete, no more to come
+
+# Operation of LE Set Extended Advertising / Scan Response Data
+ADV_DATA_OP_INTERMEDIATE = 0x00
+ADV_DATA_OP_FIRST = 0x01
+ADV_DATA_OP_LAST = 0x02
+ADV_DATA_OP_COMPLETE = 0x03
+ADV_DATA_OP_UNCHANGED = 0x04
+
+ADV_TX_POWER_NO_PREFERENCE = 0x7f
+
+
 # From bluetootchsocket.cpp
 
 HCI_COMMAND_PKT = 0x01
 HCI_ACLDATA_PKT = 0x02
+HCI_SCODATA_PKT = 0x03
 HCI_EVENT_PKT = 0x04
+HCI_ISODATA_PKT = 0x05
 
 EVT_CMD_COMPLETE = 0x0e
 EVT_CMD_STATUS = 0x0f
+EVT_NUM_COMP_PKTS = 0x13
 
 
 LE_META_EVENT = 0x3E                # Core_4.2.pdf section: 7.7.65 LE Meta Event
@@ -68,6 +119,9 @@ EVT_LE_CONN_COMPLETE = 0x01
 EVT_LE_ADVERTISING_REPORT = 0x02
 EVT_LE_CONN_UPDATE_COMPLETE = 0x03
 EVT_LE_READ_REMOTE_USED_FEATURES_COMPLETE = 0x04
+EVT_LE_EXTENDED_ADVERTISING_REPORT = 0x0d
+EVT_LE_SCAN_TIMEOUT = 0x11
+EVT_LE_ADVERTISING_SET_TERMINATED = 0x12
 EVT_DISCONN_COMPLETE = 0x05
 EVT_LE_META_EVENT = 0x3e
 
@@ -75,19 +129,118 @@ EVT_LE_META_EVENT = 0x3e
 ATT_CID = 0x0004
 
 
+# ATT opcodes, Core_4.2.pdf Vol 3 Part F section 3.4
+ATT_OP_ERROR_RSP = 0x01
+ATT_OP_MTU_REQ = 0x02
+ATT_OP_MTU_RSP = 0x03
+ATT_OP_FIND_INFO_REQ = 0x04
+ATT_OP_FIND_INFO_RSP = 0x05
+ATT_OP_FIND_BY_TYPE_REQ = 0x06
+ATT_OP_FIND_BY_TYPE_RSP = 0x07
+ATT_OP_READ_BY_TYPE_REQ = 0x08
+ATT_OP_READ_BY_TYPE_RSP = 0x09
+ATT_OP_READ_REQ = 0x0a
+ATT_OP_READ_RSP = 0x0b
+ATT_OP_READ_BLOB_REQ = 0x0c
+ATT_OP_READ_BLOB_RSP = 0x0d
+ATT_OP_READ_MULTI_REQ = 0x0e
+ATT_OP_READ_MULTI_RSP = 0x0f
+ATT_OP_READ_BY_GROUP_REQ = 0x10
+ATT_OP_READ_BY_GROUP_RSP = 0x11
+ATT_OP_WRITE_REQ = 0x12
+ATT_OP_WRITE_RSP = 0x13
+ATT_OP_PREP_WRITE_REQ = 0x16
+ATT_OP_PREP_WRITE_RSP = 0x17
+ATT_OP_EXEC_WRITE_REQ = 0x18
+ATT_OP_EXEC_WRITE_RSP = 0x19
+ATT_OP_HANDLE_NOTIFY = 0x1b
+ATT_OP_HANDLE_IND = 0x1d
+ATT_OP_HANDLE_CNF = 0x1e
+ATT_OP_WRITE_CMD = 0x52
+ATT_OP_SIGNED_WRITE_CMD = 0xd2
+
+# ATT error codes
+ATT_ECODE_INVALID_HANDLE = 0x01
+ATT_ECODE_READ_NOT_PERM = 0x02
+ATT_ECODE_WRITE_NOT_PERM = 0x03
+ATT_ECODE_INVALID_PDU = 0x04
+ATT_ECODE_AUTHENTICATION = 0x05
+ATT_ECODE_REQ_NOT_SUPP = 0x06
+ATT_ECODE_INVALID_OFFSET = 0x07
+ATT_ECODE_AUTHORIZATION = 0x08
+ATT_ECODE_PREP_QUEUE_FULL = 0x09
+ATT_ECODE_ATTR_NOT_FOUND = 0x0a
+ATT_ECODE_ATTR_NOT_LONG = 0x0b
+ATT_ECODE_INSUFF_ENCR_KEY_SIZE = 0x0c
+ATT_ECODE_INVAL_ATTR_VALUE_LEN = 0x0d
+ATT_ECODE_UNLIKELY = 0x0e
+ATT_ECODE_INSUFF_ENC = 0x0f
+ATT_ECODE_UNSUPP_GRP_TYPE = 0x10
+ATT_ECODE_INSUFF_RESOURCES = 0x11
+
+ATT_DEFAULT_LE_MTU = 23
+ATT_MAX_MTU = 517
+ATT_MAX_VALUE_LEN = 512
+
+# GATT attribute types
+GATT_PRIM_SVC_UUID = 0x2800
+GATT_SND_SVC_UUID = 0x2801
+GATT_INCLUDE_UUID = 0x2802
+GATT_CHARAC_UUID = 0x2803
+GATT_CHARAC_EXT_PROPER_UUID = 0x2900
+GATT_CHARAC_USER_DESC_UUID = 0x2901
+GATT_CLIENT_CHARAC_CFG_UUID = 0x2902
+
+# GATT characteristic properties
+GATT_CHR_PROP_BROADCAST = 0x01
+GATT_CHR_PROP_READ = 0x02
+GATT_CHR_PROP_WRITE_WITHOUT_RESP = 0x04
+GATT_CHR_PROP_WRITE = 0x08
+GATT_CHR_PROP_NOTIFY = 0x10
+GATT_CHR_PROP_INDICATE = 0x20
+GATT_CHR_PROP_AUTH = 0x40
+GATT_CHR_PROP_EXT_PROP = 0x80
+
+# Client Characteristic Configuration values
+GATT_CCC_NOTIFY = 0x0001
+GATT_CCC_INDICATE = 0x0002
+
+
+ACL_START_NO_FLUSH = 0x00
+ACL_CONT = 0x01
 ACL_START = 0x02
 
 
 OGF_LE_CTL = 0x08
 OGF_LINK_CTL = 0x01
+OGF_HOST_CTL = 0x03
+OGF_INFO_PARAM = 0x04
+
+OCF_RESET = 0x0003
+OCF_READ_BUFFER_SIZE = 0x0005
+
+OCF_LE_READ_BUFFER_SIZE = 0x0002
 
 OCF_LE_SET_SCAN_PARAMETERS = 0x000B
 OCF_LE_SET_SCAN_ENABLE = 0x000C
 OCF_LE_CREATE_CONN = 0x000D
+OCF_LE_CREATE_CONN_CANCEL = 0x000E
+OCF_LE_CONN_UPDATE = 0x0013
 OCF_LE_SET_ADVERTISING_PARAMETERS = 0x0006
 OCF_LE_SET_ADVERTISE_ENABLE = 0x000A
 OCF_LE_SET_ADVERTISING_DATA = 0x0008
 OCF_LE_SET_SCAN_RESPONSE_DATA = 0x0009
+OCF_LE_SET_ADVERTISING_SET_RANDOM_ADDRESS = 0x0035
+OCF_LE_SET_EXTENDED_ADVERTISING_PARAMETERS = 0x0036
+OCF_LE_SET_EXTENDED_ADVERTISING_DATA = 0x0037
+OCF_LE_SET_EXTENDED_SCAN_RESPONSE_DATA = 0x0038
+OCF_LE_SET_EXTENDED_ADVERTISING_ENABLE = 0x0039
+OCF_LE_READ_MAXIMUM_ADVERTISING_DATA_LENGTH = 0x003A
+OCF_LE_READ_NUMBER_OF_SUPPORTED_ADVERTISING_SETS = 0x003B
+OCF_LE_REMOVE_ADVERTISING_SET = 0x003C
+OCF_LE_CLEAR_ADVERTISING_SETS = 0x003D
+OCF_LE_SET_EXTENDED_SCAN_PARAMETERS = 0x0041
+OCF_LE_SET_EXTENDED_SCAN_ENABLE = 0x0042
 OCF_DISCONNECT = 0x0006
 
 LE_SET_SCAN_PARAMETERS_CMD = OCF_LE_SET_SCAN_PARAMETERS | OGF_LE_CTL << 10
@@ -96,6 +249,45 @@ LE_SET_ADVERTISING_PARAMETERS_CMD = OCF_LE_SET_ADVERTISING_PARAMETERS | OGF_LE_C
 LE_SET_ADVERTISING_DATA_CMD = OCF_LE_SET_ADVERTISING_DATA | OGF_LE_CTL << 10
 LE_SET_SCAN_RESPONSE_DATA_CMD = OCF_LE_SET_SCAN_RESPONSE_DATA | OGF_LE_CTL << 10
 LE_SET_ADVERTISE_ENABLE_CMD = OCF_LE_SET_ADVERTISE_ENABLE | OGF_LE_CTL << 10
+LE_SET_ADVERTISING_SET_RANDOM_ADDRESS_CMD = OCF_LE_SET_ADVERTISING_SET_RANDOM_ADDRESS | OGF_LE_CTL << 10
+LE_SET_EXTENDED_ADVERTISING_PARAMETERS_CMD = OCF_LE_SET_EXTENDED_ADVERTISING_PARAMETERS | OGF_LE_CTL << 10
+LE_SET_EXTENDED_ADVERTISING_DATA_CMD = OCF_LE_SET_EXTENDED_ADVERTISING_DATA | OGF_LE_CTL << 10
+LE_SET_EXTENDED_SCAN_RESPONSE_DATA_CMD = OCF_LE_SET_EXTENDED_SCAN_RESPONSE_DATA | OGF_LE_CTL << 10
+LE_SET_EXTENDED_ADVERTISING_ENABLE_CMD = OCF_LE_SET_EXTENDED_ADVERTISING_ENABLE | OGF_LE_CTL << 10
+LE_READ_MAXIMUM_ADVERTISING_DATA_LENGTH_CMD = OCF_LE_READ_MAXIMUM_ADVERTISING_DATA_LENGTH | OGF_LE_CTL << 10
+LE_READ_NUMBER_OF_SUPPORTED_ADVERTISING_SETS_CMD = OCF_LE_READ_NUMBER_OF_SUPPORTED_ADVERTISING_SETS | OGF_LE_CTL << 10
+LE_REMOVE_ADVERTISING_SET_CMD = OCF_LE_REMOVE_ADVERTISING_SET | OGF_LE_CTL << 10
+LE_CLEAR_ADVERTISING_SETS_CMD = OCF_LE_CLEAR_ADVERTISING_SETS | OGF_LE_CTL << 10
+LE_SET_EXTENDED_SCAN_PARAMETERS_CMD = OCF_LE_SET_EXTENDED_SCAN_PARAMETERS | OGF_LE_CTL << 10
+LE_SET_EXTENDED_SCAN_ENABLE_CMD = OCF_LE_SET_EXTENDED_SCAN_ENABLE | OGF_LE_CTL << 10
 
 LE_CREATE_CONN_CMD = OCF_LE_CREATE_CONN | OGF_LE_CTL << 10
+LE_CREATE_CONN_CANCEL_CMD = OCF_LE_CREATE_CONN_CANCEL | OGF_LE_CTL << 10
+LE_CONN_UPDATE_CMD = OCF_LE_CONN_UPDATE | OGF_LE_CTL << 10
 DISCONNECT_CMD = OCF_DISCONNECT | OGF_LINK_CTL << 10
+RESET_CMD = OCF_RESET | OGF_HOST_CTL << 10
+READ_BUFFER_SIZE_CMD = OCF_READ_BUFFER_SIZE | OGF_INFO_PARAM << 10
+LE_READ_BUFFER_SIZE_CMD = OCF_LE_READ_BUFFER_SIZE | OGF_LE_CTL << 10
+
+
+# Advertising / EIR data types, Bluetooth Assigned Numbers "Generic Access Profile"
+AD_TYPE_FLAGS = 0x01
+AD_TYPE_INCOMPLETE_16BIT_UUIDS = 0x02
+AD_TYPE_COMPLETE_16BIT_UUIDS = 0x03
+AD_TYPE_INCOMPLETE_32BIT_UUIDS = 0x04
+AD_TYPE_COMPLETE_32BIT_UUIDS = 0x05
+AD_TYPE_INCOMPLETE_128BIT_UUIDS = 0x06
+AD_TYPE_COMPLETE_128BIT_UUIDS = 0x07
+AD_TYPE_SHORT_LOCAL_NAME = 0x08
+AD_TYPE_COMPLETE_LOCAL_NAME = 0x09
+AD_TYPE_TX_POWER_LEVEL = 0x0a
+AD_TYPE_SERVICE_DATA_16BIT = 0x16
+AD_TYPE_APPEARANCE = 0x19
+AD_TYPE_SERVICE_DATA_32BIT = 0x20
+AD_TYPE_SERVICE_DATA_128BIT = 0x21
+AD_TYPE_MANUFACTURER_DATA = 0xff
+
+# AD_TYPE_FLAGS bits
+AD_FLAG_LE_LIMITED_DISCOVERABLE = 0x01
+AD_FLAG_LE_GENERAL_DISCOVERABLE = 0x02
+AD_FLAG_BR_EDR_NOT_SUPPORTED = 0x04
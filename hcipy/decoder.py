@@ -0,0 +1,402 @@
+#!/usr/bin/python
+
+# HCI event decoder
+#
+# Decodes HCI event packets (as delivered to on_data, i.e. starting with the packet indicator)
+# into small __slots__ objects. Decoding is table driven, keyed by (event, LE sub-event), and
+# uses module level precompiled Structs with unpack_from, so no format strings are parsed and
+# no intermediate dicts or slices are created per packet.
+#
+# Struct layouts from: https://git.kernel.org/pub/scm/bluetooth/bluez.git/tree/lib/hci.h
+
+import array
+import struct
+
+from .address import BDAddress
+from .advdata import AdvertisingData
+from .constants import *
+
+
+# indicator, evt, plen  (+ subevent for LE meta events)
+HCI_EVENT_HDR_SIZE = 3
+HCI_LE_META_HDR_SIZE = 4
+
+_evt_cmd_complete = struct.Struct('<BH')                # ncmd, opcode
+_evt_cmd_status = struct.Struct('<BBH')                 # status, ncmd, opcode
+_evt_disconn_complete = struct.Struct('<BHB')           # status, handle, reason
+_hci_comp_pkts_info = struct.Struct('<HH')              # handle, count
+_evt_le_conn_complete = struct.Struct('<BHBBIHHHHB')    # status, handle, role, peer_bdaddr_type, peer_bdaddr(lo, hi),
+                                                        # interval, latency, supervision_timeout, master_clock_accuracy
+_evt_le_conn_update_complete = struct.Struct('<BHHHH')  # status, handle, interval, latency, supervision_timeout
+_evt_le_read_remote_used_features_complete = struct.Struct('<BHQ')    # status, handle, features
+_le_advertising_info = struct.Struct('<BBIHB')          # evt_type, bdaddr_type, bdaddr(lo, hi), length
+_rssi = struct.Struct('<b')
+_le_extended_advertising_info = struct.Struct('<HBIHBBBbbHBIHB')   # evt_type, bdaddr_type, bdaddr(lo, hi), primary_phy,
+                                                        # secondary_phy, sid, tx_power, rssi, periodic interval,
+                                                        # direct_bdaddr_type, direct_bdaddr(lo, hi), length
+
+
+class HCIEvent(object):
+    __slots__ = ()
+
+    event = None
+    subevent = None
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__,
+                               ', '.join('{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+
+class CommandComplete(HCIEvent):
+    __slots__ = ('ncmd', 'opcode', 'status', 'return_parameters')
+
+    event = EVT_CMD_COMPLETE
+
+    def __init__(self, ncmd, opcode, status, return_parameters):
+        self.ncmd = ncmd
+        self.opcode = opcode
+        self.status = status                            # first return parameter, None for a NOP
+        self.return_parameters = return_parameters      # memoryview, status included
+
+
+class CommandStatus(HCIEvent):
+    __slots__ = ('status', 'ncmd', 'opcode')
+
+    event = EVT_CMD_STATUS
+
+    def __init__(self, status, ncmd, opcode):
+        self.status = status
+        self.ncmd = ncmd
+        self.opcode = opcode
+
+
+class DisconnectionComplete(HCIEvent):
+    __slots__ = ('status', 'handle', 'reason')
+
+    event = EVT_DISCONN_COMPLETE
+
+    def __init__(self, status, handle, reason):
+        self.status = status
+        self.handle = handle
+        self.reason = reason
+
+
+class NumberOfCompletedPackets(HCIEvent):
+    __slots__ = ('handles', 'counts')
+
+    event = EVT_NUM_COMP_PKTS
+
+    def __init__(self, handles, counts):
+        self.handles = handles
+        self.counts = counts
+
+
+class LEConnectionComplete(HCIEvent):
+    __slots__ = ('status', 'handle', 'role', 'peer_address_type', 'peer_address',
+                 'interval', 'latency', 'supervision_timeout', 'master_clock_accuracy')
+
+    event = EVT_LE_META_EVENT
+    subevent = EVT_LE_CONN_COMPLETE
+
+    def __init__(self, status, handle, role, peer_address_type, peer_address,
+                 interval, latency, supervision_timeout, master_clock_accuracy):
+        self.status = status
+        self.handle = handle
+        self.role = role
+        self.peer_address_type = peer_address_type
+        self.peer_address = peer_address                # 48-bit int
+        self.interval = interval                        # units of 1.25ms
+        self.latency = latency
+        self.supervision_timeout = supervision_timeout  # units of 10ms
+        self.master_clock_accuracy = master_clock_accuracy
+
+    @property
+    def peer_bd_address(self):
+        return BDAddress(self.peer_address, self.peer_address_type)
+
+
+class LEConnectionUpdateComplete(HCIEvent):
+    __slots__ = ('status', 'handle', 'interval', 'latency', 'supervision_timeout')
+
+    event = EVT_LE_META_EVENT
+    subevent = EVT_LE_CONN_UPDATE_COMPLETE
+
+    def __init__(self, status, handle, interval, latency, supervision_timeout):
+        self.status = status
+        self.handle = handle
+        self.interval = interval                        # units of 1.25ms
+        self.latency = latency
+        self.supervision_timeout = supervision_timeout  # units of 10ms
+
+
+class LEReadRemoteUsedFeaturesComplete(HCIEvent):
+    __slots__ = ('status', 'handle', 'features')
+
+    event = EVT_LE_META_EVENT
+    subevent = EVT_LE_READ_REMOTE_USED_FEATURES_COMPLETE
+
+    def __init__(self, status, handle, features):
+        self.status = status
+        self.handle = handle
+        self.features = features                        # 64-bit LE features bit mask
+
+
+class AdvertisingReport(object):
+    __slots__ = ('event_type', 'address_type', 'address', 'data', 'rssi')
+
+    def __init__(self, event_type, address_type, address, data, rssi):
+        self.event_type = event_type
+        self.address_type = address_type
+        self.address = address                          # 48-bit int
+        self.data = data                                # memoryview of the AD structures
+        self.rssi = rssi                                # dBm
+
+    @property
+    def bd_address(self):
+        return BDAddress(self.address, self.address_type)
+
+    @property
+    def ad(self):
+        # parsed AD structures, only valid as long as data is
+        return AdvertisingData(self.data)
+
+    __repr__ = HCIEvent.__repr__
+
+
+class LEAdvertisingReport(HCIEvent):
+    __slots__ = ('reports',)
+
+    event = EVT_LE_META_EVENT
+    subevent = EVT_LE_ADVERTISING_REPORT
+
+    def __init__(self, reports):
+        self.reports = reports
+
+
+class ExtendedAdvertisingReport(object):
+    __slots__ = ('event_type', 'address_type', 'address', 'primary_phy', 'secondary_phy', 'sid', 'tx_power', 'rssi',
+                 'periodic_interval', 'direct_address_type', 'direct_address', 'data')
+
+    def __init__(self, event_type, address_type, address, primary_phy, secondary_phy, sid, tx_power, rssi,
+                 periodic_interval, direct_address_type, direct_address, data):
+        self.event_type = event_type                    # ADV_PROP_* / EXT_ADV_EVT_* bits and the data status
+        self.address_type = address_type
+        self.address = address                          # 48-bit int
+        self.primary_phy = primary_phy
+        self.secondary_phy = secondary_phy
+        self.sid = sid
+        self.tx_power = tx_power                        # dBm, 127 if not available
+        self.rssi = rssi                                # dBm, 127 if not available
+        self.periodic_interval = periodic_interval
+        self.direct_address_type = direct_address_type
+        self.direct_address = direct_address
+        self.data = data                                # memoryview of (this fragment of) the AD structures
+
+    @property
+    def data_status(self):
+        # EXT_ADV_DATA_COMPLETE / EXT_ADV_DATA_INCOMPLETE / EXT_ADV_DATA_TRUNCATED
+        return (self.event_type >> 5) & 0x03
+
+    @property
+    def bd_address(self):
+        return BDAddress(self.address, self.address_type)
+
+    @property
+    def ad(self):
+        # only meaningful for complete data, see ExtendedAdvertisingReassembler
+        return AdvertisingData(self.data)
+
+    __repr__ = HCIEvent.__repr__
+
+
+class LEExtendedAdvertisingReport(HCIEvent):
+    __slots__ = ('reports',)
+
+    event = EVT_LE_META_EVENT
+    subevent = EVT_LE_EXTENDED_ADVERTISING_REPORT
+
+    def __init__(self, reports):
+        self.reports = reports
+
+
+# -------------------------------------------------
+# Decoders, each is given a memoryview of the whole packet
+
+def _decode_cmd_complete(data):
+    ncmd, opcode = _evt_cmd_complete.unpack_from(data, HCI_EVENT_HDR_SIZE)
+    return_parameters = data[HCI_EVENT_HDR_SIZE + 3:]
+    return CommandComplete(ncmd, opcode, return_parameters[0] if len(return_parameters) else None, return_parameters)
+
+
+def _decode_cmd_status(data):
+    return CommandStatus(*_evt_cmd_status.unpack_from(data, HCI_EVENT_HDR_SIZE))
+
+
+def _decode_disconn_complete(data):
+    return DisconnectionComplete(*_evt_disconn_complete.unpack_from(data, HCI_EVENT_HDR_SIZE))
+
+
+def _decode_num_comp_pkts(data):
+    handles = []
+    counts = []
+    offset = HCI_EVENT_HDR_SIZE + 1
+    for _ in range(data[HCI_EVENT_HDR_SIZE]):
+        handle, count = _hci_comp_pkts_info.unpack_from(data, offset)
+        handles.append(handle)
+        counts.append(count)
+        offset += _hci_comp_pkts_info.size
+    return NumberOfCompletedPackets(handles, counts)
+
+
+def _decode_le_conn_complete(data):
+    (status, handle, role, peer_address_type, address_lo, address_hi,
+     interval, latency, supervision_timeout, master_clock_accuracy) = _evt_le_conn_complete.unpack_from(data, HCI_LE_META_HDR_SIZE)
+    return LEConnectionComplete(status, handle, role, peer_address_type, address_lo | (address_hi << 32),
+                                interval, latency, supervision_timeout, master_clock_accuracy)
+
+
+def _decode_le_conn_update_complete(data):
+    return LEConnectionUpdateComplete(*_evt_le_conn_update_complete.unpack_from(data, HCI_LE_META_HDR_SIZE))
+
+
+def _decode_le_read_remote_used_features_complete(data):
+    return LEReadRemoteUsedFeaturesComplete(*_evt_le_read_remote_used_features_complete.unpack_from(data, HCI_LE_META_HDR_SIZE))
+
+
+def _decode_le_advertising_report(data):
+    num_reports = data[HCI_LE_META_HDR_SIZE]
+    offset = HCI_LE_META_HDR_SIZE + 1
+    reports = []
+    for _ in range(num_reports):
+        event_type, address_type, address_lo, address_hi, length = _le_advertising_info.unpack_from(data, offset)
+        offset += _le_advertising_info.size
+        rssi = _rssi.unpack_from(data, offset + length)[0]
+        reports.append(AdvertisingReport(event_type, address_type, address_lo | (address_hi << 32),
+                                         data[offset:offset + length], rssi))
+        offset += length + 1
+    return LEAdvertisingReport(reports)
+
+
+def _decode_le_extended_advertising_report(data):
+    num_reports = data[HCI_LE_META_HDR_SIZE]
+    offset = HCI_LE_META_HDR_SIZE + 1
+    reports = []
+    for _ in range(num_reports):
+        (event_type, address_type, address_lo, address_hi, primary_phy, secondary_phy, sid, tx_power, rssi,
+         periodic_interval, direct_address_type, direct_lo, direct_hi, length) = _le_extended_advertising_info.unpack_from(data, offset)
+        offset += _le_extended_advertising_info.size
+        reports.append(ExtendedAdvertisingReport(event_type, address_type, address_lo | (address_hi << 32), primary_phy,
+                                                 secondary_phy, sid, tx_power, rssi, periodic_interval,
+                                                 direct_address_type, direct_lo | (direct_hi << 32),
+                                                 data[offset:offset + length]))
+        offset += length
+    return LEExtendedAdvertisingReport(reports)
+
+
+# (event, LE sub-event or None) -> decoder
+EVENT_DECODERS = {
+    (EVT_CMD_COMPLETE, None): _decode_cmd_complete,
+    (EVT_CMD_STATUS, None): _decode_cmd_status,
+    (EVT_DISCONN_COMPLETE, None): _decode_disconn_complete,
+    (EVT_NUM_COMP_PKTS, None): _decode_num_comp_pkts,
+    (EVT_LE_META_EVENT, EVT_LE_CONN_COMPLETE): _decode_le_conn_complete,
+    (EVT_LE_META_EVENT, EVT_LE_ADVERTISING_REPORT): _decode_le_advertising_report,
+    (EVT_LE_META_EVENT, EVT_LE_CONN_UPDATE_COMPLETE): _decode_le_conn_update_complete,
+    (EVT_LE_META_EVENT, EVT_LE_READ_REMOTE_USED_FEATURES_COMPLETE): _decode_le_read_remote_used_features_complete,
+    (EVT_LE_META_EVENT, EVT_LE_EXTENDED_ADVERTISING_REPORT): _decode_le_extended_advertising_report,
+}
+
+
+# -------------------------------------------------
+# Columnar bulk parser for LE Advertising Reports
+#
+# Accumulates every report of many EVT_LE_ADVERTISING_REPORT events into parallel arrays, one per
+# field, without creating an object per report. The AD payloads are appended to one shared buffer,
+# report i's payload is buffer[data_offsets[i]:data_offsets[i] + data_lengths[i]].
+
+class AdvertisingReportBatch(object):
+
+    def __init__(self):
+        self.event_types = array.array('B')
+        self.address_types = array.array('B')
+        self.addresses = array.array('Q')        # 48-bit ints
+        self.rssi = array.array('b')
+        self.data_offsets = array.array('I')
+        self.data_lengths = array.array('B')
+        self.buffer = bytearray()
+
+    def __len__(self):
+        return len(self.rssi)
+
+    def clear(self):
+        del self.event_types[:]
+        del self.address_types[:]
+        del self.addresses[:]
+        del self.rssi[:]
+        del self.data_offsets[:]
+        del self.data_lengths[:]
+        del self.buffer[:]
+
+    def bd_address(self, index):
+        return BDAddress(self.addresses[index], self.address_types[index])
+
+    def data(self, index):
+        offset = self.data_offsets[index]
+        return bytes(self.buffer[offset:offset + self.data_lengths[index]])
+
+    def ad(self, index):
+        # parsed AD structures of report index. Over a copy: a view into buffer would stop it growing.
+        return AdvertisingData(self.data(index))
+
+    def add_event(self, data):
+        # Append all the reports of one LE Advertising Report event, returns the number of reports added
+        if data[0] != HCI_EVENT_PKT or data[1] != EVT_LE_META_EVENT or data[3] != EVT_LE_ADVERTISING_REPORT:
+            return 0
+
+        num_reports = data[HCI_LE_META_HDR_SIZE]
+        offset = HCI_LE_META_HDR_SIZE + 1
+        unpack_info = _le_advertising_info.unpack_from
+        info_size = _le_advertising_info.size
+        unpack_rssi = _rssi.unpack_from
+        buf = self.buffer
+
+        for _ in range(num_reports):
+            event_type, address_type, address_lo, address_hi, length = unpack_info(data, offset)
+            offset += info_size
+            self.event_types.append(event_type)
+            self.address_types.append(address_type)
+            self.addresses.append(address_lo | (address_hi << 32))
+            self.data_offsets.append(len(buf))
+            self.data_lengths.append(length)
+            buf += data[offset:offset + length]
+            offset += length
+            self.rssi.append(unpack_rssi(data, offset)[0])
+            offset += 1
+
+        return num_reports
+
+    def add_events(self, batch):
+        # e.g. used as an on_data_batch callback, or with a list of packets
+        count = 0
+        for data in batch:
+            count += self.add_event(data)
+        return count
+
+
+def register_event_decoder(event, subevent, decoder):
+    EVENT_DECODERS[(event, subevent)] = decoder
+
+
+def decode_event(data):
+    # Returns the decoded event, or None for packets that aren't (known) events.
+    # Variable length fields are memoryviews into data, copy them if they need to outlive it.
+    if data[0] != HCI_EVENT_PKT:
+        return None
+    event = data[1]
+    subevent = data[3] if event == EVT_LE_META_EVENT else None
+    decoder = EVENT_DECODERS.get((event, subevent))
+    if decoder is None:
+        return None
+    if not isinstance(data, memoryview):
+        data = memoryview(data)
+    return decoder(data)
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+# Host side advertisement de-duplication
+#
+# An alternative to the controller's SCAN_FILTER_DUPLICATES, whose small internal table overflows
+# in crowded places. Reports are keyed on (address, address type, hash of the AD payload): a report
+# is let through when its payload is new (or changed), otherwise at most once per refresh interval,
+# which keeps RSSI fresh while suppressing the flood of identical reports.
+# Memory is bounded, entries expire after a TTL and the least recently seen are evicted at the cap.
+
+import array
+import time
+from collections import OrderedDict
+
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class AdvertisingDeduplicator(object):
+
+    def __init__(self, refresh_interval=1.0, ttl=60.0, max_entries=10000, clock=_clock):
+        self.refresh_interval = refresh_interval
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.passed = 0
+        self.suppressed = 0
+        self.evicted = 0
+        self._clock = clock
+        self._entries = OrderedDict()    # key -> [last passed, last seen], least recently seen first
+        self._next_expiry = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def accept(self, address, address_type, payload, now=None):
+        # Returns True if this report should be passed on
+        if now is None:
+            now = self._clock()
+        if now >= self._next_expiry:
+            self._expire(now)
+
+        entries = self._entries
+        key = (address, address_type, hash(bytes(payload)))
+        entry = entries.get(key)
+
+        if entry is None:
+            entries[key] = [now, now]
+            if len(entries) > self.max_entries:
+                entries.popitem(last=False)
+                self.evicted += 1
+            self.passed += 1
+            return True
+
+        entry[1] = now
+        entries.move_to_end(key)
+        if now - entry[0] >= self.refresh_interval:
+            entry[0] = now
+            self.passed += 1
+            return True
+
+        self.suppressed += 1
+        return False
+
+    def filter_batch(self, batch, now=None):
+        # Returns an array of the indexes of the reports in an AdvertisingReportBatch that should be passed on
+        if now is None:
+            now = self._clock()
+        accept = self.accept
+        addresses = batch.addresses
+        address_types = batch.address_types
+        data_offsets = batch.data_offsets
+        data_lengths = batch.data_lengths
+        buf = memoryview(batch.buffer)
+        passed = array.array('I')
+        try:
+            for i in range(len(batch)):
+                offset = data_offsets[i]
+                if accept(addresses[i], address_types[i], buf[offset:offset + data_lengths[i]], now):
+                    passed.append(i)
+        finally:
+            buf.release()
+        return passed
+
+    def _expire(self, now):
+        # entries are ordered by last seen, so expired ones are always at the front
+        entries = self._entries
+        deadline = now - self.ttl
+        while entries:
+            key, entry = next(iter(entries.items()))
+            if entry[1] > deadline:
+                break
+            del entries[key]
+        self._next_expiry = now + min(self.ttl, 1.0)
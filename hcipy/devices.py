@@ -0,0 +1,159 @@
+#!/usr/bin/python
+
+# Memory bounded device registry for long running scans
+#
+# Keeps one small __slots__ record per device, keyed by the 48-bit int address, in a dict ordered by
+# last seen time. A lookup/update per report is O(1) and age based eviction only ever touches the
+# oldest entries.
+#
+# update() is normally called from the receive thread, a lock keeps snapshot() and iteration from other
+# threads consistent with it.
+
+import threading
+import time
+from collections import OrderedDict
+
+from .address import BDAddress
+from .constants import *
+
+
+_clock = getattr(time, 'monotonic', time.time)
+
+
+class DeviceRecord(object):
+    __slots__ = ('address', 'address_type', 'first_seen', 'last_seen', 'packet_count',
+                 'rssi_min', 'rssi_max', 'rssi_ewma', 'last_payload')
+
+    def __init__(self, address, address_type, now, rssi, payload):
+        self.address = address
+        self.address_type = address_type
+        self.first_seen = now
+        self.last_seen = now
+        self.packet_count = 1
+        self.last_payload = payload
+        if rssi == RSSI_NOT_AVAILABLE:
+            # None until a report with an RSSI
+            self.rssi_min = self.rssi_max = self.rssi_ewma = None
+        else:
+            self.rssi_min = rssi
+            self.rssi_max = rssi
+            self.rssi_ewma = float(rssi)
+
+    @property
+    def bd_address(self):
+        return BDAddress(self.address, self.address_type)
+
+    def as_tuple(self):
+        return (self.address, self.address_type, self.first_seen, self.last_seen, self.packet_count,
+                self.rssi_min, self.rssi_max, self.rssi_ewma, self.last_payload)
+
+    def __repr__(self):
+        return 'DeviceRecord({})'.format(', '.join('{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+
+class DeviceRegistry(object):
+
+    # field names of the tuples returned by snapshot()
+    SNAPSHOT_FIELDS = DeviceRecord.__slots__
+
+    def __init__(self, max_age=300.0, max_devices=None, ewma_alpha=0.2, clock=_clock):
+        self.max_age = max_age
+        self.max_devices = max_devices
+        self.ewma_alpha = ewma_alpha
+        self.evicted = 0
+        self._clock = clock
+        self._devices = OrderedDict()    # address -> DeviceRecord, least recently seen first
+        self._next_eviction = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __contains__(self, address):
+        return address in self._devices
+
+    def __iter__(self):
+        # live records, still updated in place
+        with self._lock:
+            return iter(list(self._devices.values()))
+
+    def get(self, address, default=None):
+        return self._devices.get(address, default)
+
+    def update(self, address, address_type, rssi, payload, now=None):
+        if now is None:
+            now = self._clock()
+        with self._lock:
+            return self._update(address, address_type, rssi, payload, now)
+
+    def _update(self, address, address_type, rssi, payload, now):
+        if now >= self._next_eviction:
+            self._evict(now)
+
+        devices = self._devices
+        record = devices.get(address)
+        if record is None:
+            record = devices[address] = DeviceRecord(address, address_type, now, rssi, bytes(payload))
+            if self.max_devices is not None and len(devices) > self.max_devices:
+                devices.popitem(last=False)
+                self.evicted += 1
+            return record
+
+        devices.move_to_end(address)
+        record.address_type = address_type
+        record.last_seen = now
+        record.packet_count += 1
+        if rssi != RSSI_NOT_AVAILABLE:
+            if record.rssi_ewma is None:
+                record.rssi_min = record.rssi_max = rssi
+                record.rssi_ewma = float(rssi)
+            else:
+                if rssi < record.rssi_min:
+                    record.rssi_min = rssi
+                elif rssi > record.rssi_max:
+                    record.rssi_max = rssi
+                record.rssi_ewma += self.ewma_alpha * (rssi - record.rssi_ewma)
+        record.last_payload = bytes(payload)
+        return record
+
+    def update_batch(self, batch, indexes=None, now=None):
+        # Update from an AdvertisingReportBatch, optionally only the given report indexes
+        # (e.g. the ones passed by an AdvertisingDeduplicator)
+        if now is None:
+            now = self._clock()
+        update = self._update
+        buf = memoryview(batch.buffer)
+        try:
+            with self._lock:
+                for i in (range(len(batch)) if indexes is None else indexes):
+                    offset = batch.data_offsets[i]
+                    update(batch.addresses[i], batch.address_types[i], batch.rssi[i],
+                           buf[offset:offset + batch.data_lengths[i]], now)
+        finally:
+            buf.release()
+
+    def evict(self, now=None):
+        # Drop devices not seen for max_age seconds, returns the number dropped
+        if now is None:
+            now = self._clock()
+        with self._lock:
+            return self._evict(now)
+
+    def _evict(self, now):
+        devices = self._devices
+        deadline = now - self.max_age
+        count = 0
+        while devices:
+            address, record = next(iter(devices.items()))
+            if record.last_seen > deadline:
+                break
+            del devices[address]
+            count += 1
+        self.evicted += count
+        self._next_eviction = now + min(self.max_age, 1.0)
+        return count
+
+    def snapshot(self):
+        # Point in time copy as a list of plain tuples (see SNAPSHOT_FIELDS), safe to hand to an exporter thread
+        with self._lock:
+            return [record.as_tuple() for record in self._devices.values()]
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+
+# Bounded dispatch queue
+#
+# Decouples user callbacks from the receive thread: packets are queued and a pool of worker threads
+# runs the callback, so a slow handler no longer stalls the socket reads (and lets the kernel buffer
+# overflow). What happens when the handlers can't keep up is explicit, see the overflow policies,
+# and every packet dropped or merged is counted.
+#
+# With more than one worker packets may be handled out of order.
+
+import threading
+import traceback
+from collections import deque
+
+from .constants import *
+
+
+# Overflow policies, when a packet arrives and the queue is full:
+DISPATCH_BLOCK = 'block'                # wait for room, i.e. push back on the receive thread (and the kernel)
+DISPATCH_DROP_OLDEST = 'drop_oldest'    # drop the oldest queued packet
+DISPATCH_DROP_NEWEST = 'drop_newest'    # drop the arriving packet
+DISPATCH_COALESCE = 'coalesce'          # always replace a queued packet with the same key (see key=),
+                                        # otherwise drop the oldest
+
+DISPATCH_POLICIES = (DISPATCH_BLOCK, DISPATCH_DROP_OLDEST, DISPATCH_DROP_NEWEST, DISPATCH_COALESCE)
+
+
+def advertiser_key(packet):
+    # Coalescing key for LE Advertising Reports: the advertiser address (and event type), so only the
+    # latest report per advertiser is queued. None (never coalesced) for anything else.
+    if (len(packet) > 13 and packet[0] == HCI_EVENT_PKT and packet[1] == EVT_LE_META_EVENT
+            and packet[3] == EVT_LE_ADVERTISING_REPORT and packet[4] == 1):
+        return bytes(packet[5:13])      # event type, address type, address
+    return None
+
+
+class HCIDispatchQueue(object):
+
+    def __init__(self, callback, workers=1, max_size=1024, overflow=DISPATCH_BLOCK, key=None):
+        # callback(packet) is run on a worker thread, packets must not be reused by the producer
+        # key(packet): hashable coalescing key or None, only used by DISPATCH_COALESCE
+        if overflow not in DISPATCH_POLICIES:
+            raise ValueError("Unknown overflow policy: {}".format(overflow))
+        if overflow == DISPATCH_COALESCE and key is None:
+            raise ValueError("The coalesce overflow policy needs a key function")
+        self.callback = callback
+        self.max_size = max_size
+        self.overflow = overflow
+        self.key = key if overflow == DISPATCH_COALESCE else None
+        self.queued = 0
+        self.processed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.high_water = 0
+        self._queue = deque()           # [key, packet]
+        self._pending = {}              # key -> queued entry, for coalescing
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._keep_running = True
+        self._workers = []
+        for n in range(workers):
+            thread = threading.Thread(target=self._worker, name='HCIDispatch-{}'.format(n))
+            thread.setDaemon(True)
+            thread.start()
+            self._workers.append(thread)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, packet):
+        # From the receive thread, returns False if the packet was dropped (always once closed)
+        with self._lock:
+            if not self._keep_running:
+                self.dropped += 1
+                return False
+            queue = self._queue
+            key = None
+            if self.key is not None:
+                key = self.key(packet)
+                if key is not None:
+                    entry = self._pending.get(key)
+                    if entry is not None:
+                        entry[1] = packet           # keeps its place in the queue
+                        self.coalesced += 1
+                        return True
+
+            if len(queue) >= self.max_size:
+                overflow = self.overflow
+                if overflow == DISPATCH_BLOCK:
+                    while len(queue) >= self.max_size and self._keep_running:
+                        self._not_full.wait()
+                    if not self._keep_running:
+                        self.dropped += 1
+                        return False
+                elif overflow == DISPATCH_DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                else:
+                    oldest = queue.popleft()
+                    if oldest[0] is not None:
+                        del self._pending[oldest[0]]
+                    self.dropped += 1
+
+            entry = [key, packet]
+            queue.append(entry)
+            if key is not None:
+                self._pending[key] = entry
+            self.queued += 1
+            if len(queue) > self.high_water:
+                self.high_water = len(queue)
+            self._not_empty.notify()
+            return True
+
+    def close(self, drain=True):
+        # Stop the workers, after handling what is still queued if drain is set
+        with self._lock:
+            if not drain:
+                self.dropped += len(self._queue)
+                self._queue.clear()
+                self._pending.clear()
+            self._keep_running = False
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        current = threading.current_thread()
+        for thread in self._workers:
+            if thread is not current:
+                thread.join()
+        self._workers = []
+
+    def stats(self):
+        return dict(queued=self.queued, processed=self.processed, dropped=self.dropped, coalesced=self.coalesced,
+                    errors=self.errors, depth=len(self._queue), high_water=self.high_water,
+                    max_size=self.max_size, overflow=self.overflow)
+
+    def _worker(self):
+        lock = self._lock
+        not_empty = self._not_empty
+        queue = self._queue
+        while True:
+            with lock:
+                while not queue and self._keep_running:
+                    not_empty.wait()
+                if not queue:
+                    return
+                key, packet = queue.popleft()
+                if key is not None:
+                    del self._pending[key]
+                self._not_full.notify()
+
+            failed = 0
+            try:
+                self.callback(packet)
+            except Exception:
+                failed = 1
+                traceback.print_exc()
+            with lock:
+                self.processed += 1
+                self.errors += failed
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+
+# Bluetooth 5 extended scanning and advertising
+#
+# Extended advertising data can be up to 1650 bytes, which the controller reports in fragments:
+# consecutive LE Extended Advertising Reports from the same advertiser whose data status says more is
+# to come. ExtendedAdvertisingReassembler joins them back into one report. Complete, unfragmented
+# reports (the common case) are passed through as they are, without copying.
+#
+#   reassembler = ExtendedAdvertisingReassembler(on_report)
+#   hci.subscribe(reassembler.add_event, subevent=EVT_LE_EXTENDED_ADVERTISING_REPORT)
+#   hci.send_command_packet(LESetExtendedScanParametersCommand().build(phys=LE_SCAN_PHY_1M | LE_SCAN_PHY_CODED))
+#   hci.send_command_packet(LESetExtendedScanEnableCommand().build(True))
+#
+# ExtendedAdvertisingSets configures several advertising sets, each with its own parameters and data,
+# which are all started and stopped by a single enable command.
+
+import threading
+from collections import OrderedDict
+
+from .builders import (LESetExtendedAdvertisingParametersCommand, LESetExtendedAdvertisingDataCommand,
+                       LESetExtendedScanResponseDataCommand, LESetExtendedAdvertisingEnableCommand,
+                       LESetAdvertisingSetRandomAddressCommand, LERemoveAdvertisingSetCommand,
+                       LE_CLEAR_ADVERTISING_SETS_PACKET, ADVERTISING_DATA_SIZE)
+from .constants import *
+from .decoder import ExtendedAdvertisingReport, decode_event
+
+
+MAX_ADVERTISING_HANDLE = 0xef
+
+
+# -------------------------------------------------
+# Report reassembly
+
+class ExtendedAdvertisingReassembler(object):
+
+    def __init__(self, callback=None, max_pending=64):
+        # callback(report) for every complete (or truncated) report, see add_event()
+        # max_pending: advertisers with a partial report, the oldest is dropped beyond that
+        self.callback = callback
+        self.max_pending = max_pending
+        self.dropped = 0
+        self._pending = OrderedDict()       # (address, address type, sid, scan response) -> [fragment data, ...]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add_event(self, data):
+        # Feed an LE Extended Advertising Report event packet, returns the reports completed by it.
+        # Passed through reports have data as a memoryview into the packet, only valid as long as it is.
+        event = decode_event(data)
+        if event is None or event.subevent != EVT_LE_EXTENDED_ADVERTISING_REPORT:
+            return []
+        completed = []
+        for report in event.reports:
+            report = self.add_report(report)
+            if report is not None:
+                completed.append(report)
+                if self.callback is not None:
+                    self.callback(report)
+        return completed
+
+    def add_report(self, report):
+        # Returns the complete report, or None if it's only a fragment
+        key = (report.address, report.address_type, report.sid, report.event_type & EXT_ADV_EVT_SCAN_RESPONSE)
+        status = report.data_status
+        with self._lock:
+            fragments = self._pending.pop(key, None)
+            if status == EXT_ADV_DATA_INCOMPLETE:
+                if fragments is None:
+                    fragments = []
+                    if len(self._pending) >= self.max_pending:
+                        self._pending.popitem(last=False)
+                        self.dropped += 1
+                fragments.append(bytes(report.data))
+                self._pending[key] = fragments
+                return None
+
+        if fragments is None:
+            return report
+        fragments.append(bytes(report.data))
+        return ExtendedAdvertisingReport(report.event_type, report.address_type, report.address, report.primary_phy,
+                                         report.secondary_phy, report.sid, report.tx_power, report.rssi,
+                                         report.periodic_interval, report.direct_address_type, report.direct_address,
+                                         b''.join(fragments))
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+
+
+# -------------------------------------------------
+# Advertising sets
+
+class ExtendedAdvertisingSet(object):
+    __slots__ = ('handle', 'parameters', 'data', 'scan_response')
+
+    def __init__(self, handle, parameters, data, scan_response):
+        self.handle = handle
+        self.parameters = parameters
+        self.data = data
+        self.scan_response = scan_response
+
+    def __repr__(self):
+        return '<ExtendedAdvertisingSet {}>'.format(self.handle)
+
+
+class ExtendedAdvertisingSets(object):
+    # Each method sends its commands through BluetoothHCI.send_command_packet() and returns their futures,
+    # in the order sent, e.g. for concurrent.futures.wait().
+
+    def __init__(self, hci):
+        self.hci = hci
+        self.sets = {}                      # handle -> ExtendedAdvertisingSet
+        self._parameters = LESetExtendedAdvertisingParametersCommand()
+        self._data = LESetExtendedAdvertisingDataCommand()
+        self._scan_response = LESetExtendedScanResponseDataCommand()
+        self._enable = LESetExtendedAdvertisingEnableCommand()
+        self._random_address = LESetAdvertisingSetRandomAddressCommand()
+        self._remove = LERemoveAdvertisingSetCommand()
+        self._lock = threading.Lock()       # the builders share their buffers
+
+    def __len__(self):
+        return len(self.sets)
+
+    def _send(self, packets):
+        return [self.hci.send_command_packet(packet) for packet in packets]
+
+    def add(self, data=b'', scan_response=b'', handle=None, random_address=None, **parameters):
+        # Configure a new set, returns (set, futures). parameters: see LESetExtendedAdvertisingParametersCommand,
+        # by default non-connectable extended advertising, SID = handle. With a scan response it's scannable: legacy
+        # (so at most 31 bytes of each) if there's also data, scannable extended advertising can't carry any.
+        with self._lock:
+            if handle is None:
+                handle = next((handle for handle in range(MAX_ADVERTISING_HANDLE + 1) if handle not in self.sets), None)
+                if handle is None:
+                    raise ValueError("No free advertising handle")
+            elif handle in self.sets or not 0 <= handle <= MAX_ADVERTISING_HANDLE:
+                raise ValueError("Invalid or used advertising handle: {}".format(handle))
+            if scan_response:
+                parameters.setdefault('properties', ADV_PROP_LEGACY | ADV_PROP_SCANNABLE if data else ADV_PROP_SCANNABLE)
+            else:
+                parameters.setdefault('properties', 0)
+            if data and parameters['properties'] & (ADV_PROP_LEGACY | ADV_PROP_SCANNABLE) == ADV_PROP_SCANNABLE:
+                raise ValueError("Scannable extended advertising can't have advertising data")
+            self._check_legacy_size(parameters['properties'], data, scan_response)
+            parameters.setdefault('sid', handle & 0x0f)
+            if random_address is not None:
+                parameters.setdefault('own_address_type', LE_RANDOM_ADDRESS)
+
+            packets = [bytes(self._parameters.build(handle=handle, **parameters))]
+            if random_address is not None:
+                packets.append(bytes(self._random_address.build(handle, random_address)))
+            if data:
+                packets.extend(self._data.fragments(handle, data))
+            if scan_response:
+                packets.extend(self._scan_response.fragments(handle, scan_response))
+            advertising_set = ExtendedAdvertisingSet(handle, parameters, bytes(data), bytes(scan_response))
+            self.sets[handle] = advertising_set
+        return advertising_set, self._send(packets)
+
+    def set_data(self, handle, data=None, scan_response=None):
+        # Replace the data and/or the scan response of a set, only what's given and changed is sent
+        with self._lock:
+            advertising_set = self.sets[handle]
+            self._check_legacy_size(advertising_set.parameters['properties'], data or b'', scan_response or b'')
+            packets = []
+            if data is not None and bytes(data) != advertising_set.data:
+                advertising_set.data = bytes(data)
+                packets.extend(self._data.fragments(handle, data))
+            if scan_response is not None and bytes(scan_response) != advertising_set.scan_response:
+                advertising_set.scan_response = bytes(scan_response)
+                packets.extend(self._scan_response.fragments(handle, scan_response))
+        return self._send(packets)
+
+    @staticmethod
+    def _check_legacy_size(properties, data, scan_response):
+        # legacy PDUs carry at most 31 bytes, the controller would reject longer data (fragments)
+        if properties & ADV_PROP_LEGACY:
+            for payload in (data, scan_response):
+                if len(payload) > ADVERTISING_DATA_SIZE:
+                    raise ValueError("Legacy advertising data is limited to {} bytes, got {}".format(
+                        ADVERTISING_DATA_SIZE, len(payload)))
+
+    def enable(self, handles=None, duration=0, max_events=0):
+        # Start all (or the given) sets with one command. duration in units of 10ms, 0 for no limit.
+        with self._lock:
+            if handles is None:
+                handles = sorted(self.sets)
+            packet = bytes(self._enable.build(True, [(handle, duration, max_events) for handle in handles]))
+        return self._send([packet])
+
+    def disable(self, handles=None):
+        # Stop the given sets, or all of them
+        with self._lock:
+            packet = bytes(self._enable.build(False, [] if handles is None else list(handles)))
+        return self._send([packet])
+
+    def remove(self, handle):
+        with self._lock:
+            del self.sets[handle]
+            packet = bytes(self._remove.build(handle))
+        return self._send([packet])
+
+    def clear(self):
+        with self._lock:
+            self.sets.clear()
+        return self._send([LE_CLEAR_ADVERTISING_SETS_PACKET])
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+
+# HCI socket filter builder
+#
+# Computes the minimal kernel HCI filter (HCIPY_HCI_FILTER_STRUCT: type mask, event masks, opcode)
+# from a reference counted set of interests, so that the kernel drops everything no handler wants
+# before it costs a wakeup, a copy and a Python callback.
+#
+# Kernel filter semantics (net/bluetooth/hci_sock.c, is_filtered_packet):
+#  - the packet type must be set in the type mask
+#  - event packets must also have their event code set in the event mask
+#  - if an opcode is set, EVT_CMD_COMPLETE / EVT_CMD_STATUS must also be for that opcode
+
+import struct
+from collections import Counter
+
+from .constants import *
+
+
+HCI_FLT_TYPE_BITS = 31
+HCI_FLT_EVENT_BITS = 63
+
+
+class HCIFilter(object):
+
+    def __init__(self):
+        self._interests = Counter()     # (packet_type, event, opcode) -> reference count, None is a wildcard
+
+    def __len__(self):
+        return len(self._interests)
+
+    def add(self, packet_type=None, event=None, opcode=None):
+        # opcode is only meaningful for EVT_CMD_COMPLETE / EVT_CMD_STATUS interests
+        self._interests[(packet_type, event, opcode)] += 1
+
+    def remove(self, packet_type=None, event=None, opcode=None):
+        key = (packet_type, event, opcode)
+        count = self._interests[key] - 1
+        if count > 0:
+            self._interests[key] = count
+        else:
+            del self._interests[key]
+
+    def update(self, interests, remove=False):
+        # interests: iterable of tuples of add() arguments
+        for interest in interests:
+            if remove:
+                self.remove(*interest)
+            else:
+                self.add(*interest)
+
+    def clear(self):
+        self._interests.clear()
+
+    def masks(self):
+        type_mask = 0
+        event_mask = 0
+        cmd_opcodes = set()
+
+        for packet_type, event, opcode in self._interests:
+            if packet_type is None:
+                type_mask = 0xffffffff
+                event_mask = 0xffffffffffffffff
+                cmd_opcodes.add(None)
+                continue
+
+            type_mask |= 1 << (packet_type & HCI_FLT_TYPE_BITS)
+            if packet_type != HCI_EVENT_PKT:
+                continue
+
+            if event is None:
+                event_mask = 0xffffffffffffffff
+                cmd_opcodes.add(None)
+            else:
+                event_mask |= 1 << (event & HCI_FLT_EVENT_BITS)
+                if event in (EVT_CMD_COMPLETE, EVT_CMD_STATUS):
+                    cmd_opcodes.add(opcode)
+
+        # the kernel can only match one opcode, and only if nobody wants the others
+        opcode = 0
+        if len(cmd_opcodes) == 1:
+            opcode = next(iter(cmd_opcodes)) or 0
+
+        return type_mask, event_mask & 0xffffffff, event_mask >> 32, opcode
+
+    def pack(self):
+        return struct.pack(HCIPY_HCI_FILTER_STRUCT, *self.masks())
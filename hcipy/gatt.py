@@ -0,0 +1,495 @@
+#!/usr/bin/python
+
+# GATT client
+#
+# ATT allows one outstanding request per connection, so each GATTClient keeps its own request queue
+# and sends the next request straight from the receive thread as soon as the response to the previous
+# one arrives: multi-step procedures (discovery, long reads) run back-to-back without a round trip
+# through the caller, and many connections progress in parallel. Write Commands (Write Without
+# Response) need no response at all and stream() keeps the ACL transmit queue topped up to the
+# controller's buffer count, so bulk transfers run close to the link capacity.
+#
+# Discovered services and characteristics are cached per device address (GATTClientManager.cache) and
+# reused on reconnection, skipping discovery.
+#
+#   gatt = GATTClientManager(acl)
+#   client = gatt.client(connection.handle, connection.address)
+#   client.exchange_mtu().result()
+#   client.discover().result()
+#   battery = client.characteristic(0x2a19)
+#   level = client.read(battery.value_handle).result()
+#   client.subscribe(battery, on_battery_level).result()
+#   client.stream(firmware.value_handle, chunks)
+#
+# Every request method returns a concurrent.futures.Future, failing with ATTError for an ATT Error
+# Response. Notification callbacks run on the receive thread with a memoryview only valid during the call.
+
+import concurrent.futures
+import struct
+import threading
+import time
+import uuid
+from collections import deque
+
+from .constants import *
+
+
+_clock = getattr(time, 'monotonic', time.time)
+
+_uint16 = struct.Struct('<H')
+_handle_range = struct.Struct('<BHH')           # opcode, start, end
+_read_blob_req = struct.Struct('<BHH')          # opcode, handle, offset
+_handle_pdu = struct.Struct('<BH')              # opcode, handle
+_error_rsp = struct.Struct('<BBHB')             # opcode, request opcode, handle, error
+_characteristic = struct.Struct('<BH')          # properties, value handle
+
+ATT_RESPONSES = frozenset((ATT_OP_ERROR_RSP, ATT_OP_MTU_RSP, ATT_OP_FIND_INFO_RSP, ATT_OP_FIND_BY_TYPE_RSP,
+                           ATT_OP_READ_BY_TYPE_RSP, ATT_OP_READ_RSP, ATT_OP_READ_BLOB_RSP, ATT_OP_READ_MULTI_RSP,
+                           ATT_OP_READ_BY_GROUP_RSP, ATT_OP_WRITE_RSP, ATT_OP_PREP_WRITE_RSP, ATT_OP_EXEC_WRITE_RSP))
+
+ATT_TRANSACTION_TIMEOUT = 30.0
+
+
+class ATTError(Exception):
+
+    def __init__(self, request_opcode, handle, error):
+        super(ATTError, self).__init__("ATT request 0x{:02x} on handle 0x{:04x} failed with error 0x{:02x}".format(
+            request_opcode, handle, error))
+        self.request_opcode = request_opcode
+        self.handle = handle
+        self.error = error
+
+
+# -------------------------------------------------
+# UUIDs: 16-bit ones as ints, 128-bit ones as uuid.UUID, little endian on the air
+
+def uuid_to_bytes(value):
+    if isinstance(value, uuid.UUID):
+        return value.bytes[::-1]
+    return _uint16.pack(value)
+
+
+def uuid_from_bytes(data):
+    if len(data) == 2:
+        return data[0] | (data[1] << 8)
+    return uuid.UUID(bytes=bytes(data[::-1]))
+
+
+class GATTService(object):
+    __slots__ = ('uuid', 'start_handle', 'end_handle', 'characteristics')
+
+    def __init__(self, service_uuid, start_handle, end_handle):
+        self.uuid = service_uuid
+        self.start_handle = start_handle
+        self.end_handle = end_handle
+        self.characteristics = []
+
+    def __repr__(self):
+        return '<GATTService {} 0x{:04x}-0x{:04x}>'.format(self.uuid, self.start_handle, self.end_handle)
+
+
+class GATTCharacteristic(object):
+    __slots__ = ('uuid', 'handle', 'value_handle', 'properties', 'end_handle', 'cccd_handle')
+
+    def __init__(self, characteristic_uuid, handle, value_handle, properties, end_handle):
+        self.uuid = characteristic_uuid
+        self.handle = handle                # of the declaration
+        self.value_handle = value_handle
+        self.properties = properties        # GATT_CHR_PROP_* bits
+        self.end_handle = end_handle        # last handle of its descriptors
+        self.cccd_handle = None             # Client Characteristic Configuration, found on subscribe()
+
+    def __repr__(self):
+        return '<GATTCharacteristic {} 0x{:04x}>'.format(self.uuid, self.value_handle)
+
+
+def _value_handle(characteristic):
+    return characteristic.value_handle if isinstance(characteristic, GATTCharacteristic) else characteristic
+
+
+# -------------------------------------------------
+# Client
+
+class GATTClient(object):
+
+    def __init__(self, manager, handle, address=None):
+        # use GATTClientManager.client()
+        self.manager = manager
+        self.acl = manager.acl
+        self.handle = handle                # connection handle
+        self.address = address
+        self.mtu = ATT_DEFAULT_LE_MTU
+        self.connected = True
+        self.services = None                # discovered (or cached) GATTServices
+        self._requests = deque()            # [pdu, future], waiting for the outstanding one
+        self._outstanding = None            # [deadline, pdu, future]
+        self._subscriptions = {}            # value handle -> callback(value)
+
+    def __repr__(self):
+        return '<GATTClient 0x{:04x} {}>'.format(self.handle, self.address)
+
+    # -------------------------------------------------
+    # Transactions
+
+    def _request(self, pdu):
+        future = concurrent.futures.Future()
+        with self.manager._condition:
+            if not self.connected:
+                future.set_exception(IOError("Disconnected"))
+                return future
+            if self._outstanding is None:
+                self._send_request(pdu, future)
+            else:
+                self._requests.append([pdu, future])
+        return future
+
+    def _send_request(self, pdu, future):
+        # must hold the manager's condition
+        self._outstanding = [_clock() + self.manager.timeout, pdu, future]
+        self.manager._condition.notify()
+        self.acl.send(self.handle, pdu, ATT_CID)
+
+    def _on_response(self, payload):
+        # From the receive thread, with the manager's condition held. Returns the future to resolve, and how.
+        outstanding = self._outstanding
+        if outstanding is None:
+            return None, None
+        self._outstanding = None
+        requests = self._requests
+        while requests:
+            pdu, future = requests.popleft()
+            if not future.done():
+                self._send_request(pdu, future)
+                break
+        if payload[0] == ATT_OP_ERROR_RSP:
+            _, request_opcode, handle, error = _error_rsp.unpack_from(payload)
+            return outstanding[2], ATTError(request_opcode, handle, error)
+        return outstanding[2], bytes(payload)
+
+    def _fail(self):
+        # must hold the manager's condition, returns the futures to fail
+        futures = [future for _, future in self._requests]
+        self._requests.clear()
+        if self._outstanding is not None:
+            futures.append(self._outstanding[2])
+            self._outstanding = None
+        return futures
+
+    def _run(self, procedure):
+        # Drive a procedure: a generator yielding request PDUs and getting back the response PDUs (or ATTErrors
+        # thrown in), whose return value resolves the returned future.
+        result = concurrent.futures.Future()
+
+        def step(response=None, error=None):
+            try:
+                if error is not None:
+                    pdu = procedure.throw(error)
+                else:
+                    pdu = procedure.send(response)
+            except StopIteration as stop:
+                result.set_result(stop.value)
+                return
+            except Exception as exc:
+                result.set_exception(exc)
+                return
+            self._request(pdu).add_done_callback(on_response)
+
+        def on_response(future):
+            exc = future.exception()
+            if exc is not None:
+                step(error=exc)
+            else:
+                step(future.result())
+
+        step()
+        return result
+
+    # -------------------------------------------------
+    # Procedures
+
+    def exchange_mtu(self, mtu=ATT_MAX_MTU):
+        # Future of the negotiated MTU
+        return self._run(self._exchange_mtu(mtu))
+
+    def _exchange_mtu(self, mtu):
+        response = yield _handle_pdu.pack(ATT_OP_MTU_REQ, mtu)
+        self.mtu = max(ATT_DEFAULT_LE_MTU, min(mtu, _uint16.unpack_from(response, 1)[0]))
+        return self.mtu
+
+    def discover(self, refresh=False):
+        # Future of all the primary services with their characteristics, from the cache if known
+        cached = self.manager.cache.get(self.address) if self.address is not None and not refresh else None
+        if cached is not None:
+            self.services = cached
+            result = concurrent.futures.Future()
+            result.set_result(cached)
+            return result
+        return self._run(self._discover())
+
+    def _discover(self):
+        services = yield from self._discover_services()
+        for service in services:
+            yield from self._discover_characteristics(service)
+        self.services = services
+        if self.address is not None:
+            self.manager.cache[self.address] = services
+        return services
+
+    def discover_services(self):
+        return self._run(self._discover_services())
+
+    def _discover_services(self):
+        services = []
+        start = 0x0001
+        while start <= 0xffff:
+            try:
+                response = yield _handle_range.pack(ATT_OP_READ_BY_GROUP_REQ, start, 0xffff) + _uint16.pack(GATT_PRIM_SVC_UUID)
+            except ATTError as exc:
+                if exc.error == ATT_ECODE_ATTR_NOT_FOUND:
+                    break
+                raise
+            length = response[1]
+            end = start
+            for offset in range(2, len(response) - length + 1, length):
+                start_handle, end = struct.unpack_from('<HH', response, offset)
+                services.append(GATTService(uuid_from_bytes(response[offset + 4:offset + length]), start_handle, end))
+            if end == 0xffff or end < start:
+                break
+            start = end + 1
+        return services
+
+    def discover_characteristics(self, service):
+        return self._run(self._discover_characteristics(service))
+
+    def _discover_characteristics(self, service):
+        characteristics = []
+        start = service.start_handle
+        while start <= service.end_handle:
+            try:
+                response = yield (_handle_range.pack(ATT_OP_READ_BY_TYPE_REQ, start, service.end_handle) +
+                                  _uint16.pack(GATT_CHARAC_UUID))
+            except ATTError as exc:
+                if exc.error == ATT_ECODE_ATTR_NOT_FOUND:
+                    break
+                raise
+            length = response[1]
+            handle = start
+            for offset in range(2, len(response) - length + 1, length):
+                handle = _uint16.unpack_from(response, offset)[0]
+                properties, value_handle = _characteristic.unpack_from(response, offset + 2)
+                if characteristics:
+                    characteristics[-1].end_handle = handle - 1
+                characteristics.append(GATTCharacteristic(uuid_from_bytes(response[offset + 5:offset + length]),
+                                                          handle, value_handle, properties, service.end_handle))
+            if handle < start:
+                break
+            start = handle + 1
+        service.characteristics = characteristics
+        return characteristics
+
+    def characteristic(self, characteristic_uuid, service_uuid=None):
+        # a discovered characteristic by UUID, None if not found
+        for service in self.services or ():
+            if service_uuid is not None and service.uuid != service_uuid:
+                continue
+            for characteristic in service.characteristics:
+                if characteristic.uuid == characteristic_uuid:
+                    return characteristic
+        return None
+
+    def read(self, characteristic):
+        # Future of the value (bytes), long values are read with Read Blob requests
+        return self._run(self._read(_value_handle(characteristic)))
+
+    def _read(self, handle):
+        response = yield _handle_pdu.pack(ATT_OP_READ_REQ, handle)
+        value = response[1:]
+        while len(response) == self.mtu and len(value) < ATT_MAX_VALUE_LEN:
+            try:
+                response = yield _read_blob_req.pack(ATT_OP_READ_BLOB_REQ, handle, len(value))
+            except ATTError as exc:
+                if exc.error in (ATT_ECODE_ATTR_NOT_LONG, ATT_ECODE_INVALID_OFFSET):
+                    break
+                raise
+            value += response[1:]
+        return value
+
+    def write(self, characteristic, value):
+        # Write Request, the future resolves when the server has acknowledged it
+        if len(value) > self.mtu - 3:
+            raise ValueError("Value too long for the ATT MTU ({} > {})".format(len(value), self.mtu - 3))
+        return self._request(_handle_pdu.pack(ATT_OP_WRITE_REQ, _value_handle(characteristic)) + bytes(value))
+
+    def write_without_response(self, characteristic, value):
+        # Write Command, queued on the ACL link at once, doesn't wait for anything
+        if len(value) > self.mtu - 3:
+            raise ValueError("Value too long for the ATT MTU ({} > {})".format(len(value), self.mtu - 3))
+        if not self.connected:
+            raise IOError("Disconnected")
+        self.acl.send(self.handle, _handle_pdu.pack(ATT_OP_WRITE_CMD, _value_handle(characteristic)) + bytes(value),
+                      ATT_CID)
+
+    def stream(self, characteristic, values, timeout=ATT_TRANSACTION_TIMEOUT):
+        # Write Commands for each of values, keeping as many queued as the controller has ACL buffers, so the
+        # link never idles and the queue never grows. Blocks, so must not be called from the receive thread.
+        # Returns the number of values sent.
+        handle = _value_handle(characteristic)
+        count = 0
+        for value in values:
+            if not self.acl.wait_pending(self.handle, max(self.acl.total_packets, 1), timeout):
+                raise concurrent.futures.TimeoutError("ACL link stalled")
+            self.write_without_response(handle, value)
+            count += 1
+        return count
+
+    def subscribe(self, characteristic, callback, indicate=False):
+        # callback(value) for each notification (or indication, confirmed automatically). Future resolving once
+        # the Client Characteristic Configuration has been written.
+        return self._run(self._configure(characteristic, callback, GATT_CCC_INDICATE if indicate else GATT_CCC_NOTIFY))
+
+    def unsubscribe(self, characteristic):
+        return self._run(self._configure(characteristic, None, 0))
+
+    def _configure(self, characteristic, callback, value):
+        if not isinstance(characteristic, GATTCharacteristic):
+            raise ValueError("subscribe() needs a discovered GATTCharacteristic")
+        if characteristic.cccd_handle is None:
+            # look for the descriptor among the characteristic's, remembered in the (cached) characteristic
+            start = characteristic.value_handle + 1
+            while characteristic.cccd_handle is None and start <= characteristic.end_handle:
+                try:
+                    response = yield _handle_range.pack(ATT_OP_FIND_INFO_REQ, start, characteristic.end_handle)
+                except ATTError as exc:
+                    if exc.error == ATT_ECODE_ATTR_NOT_FOUND:
+                        break
+                    raise
+                length = 4 if response[1] == 0x01 else 18
+                handle = start
+                for offset in range(2, len(response) - length + 1, length):
+                    handle = _uint16.unpack_from(response, offset)[0]
+                    if length == 4 and _uint16.unpack_from(response, offset + 2)[0] == GATT_CLIENT_CHARAC_CFG_UUID:
+                        characteristic.cccd_handle = handle
+                        break
+                start = handle + 1
+            if characteristic.cccd_handle is None:
+                raise ValueError("{!r} has no Client Characteristic Configuration descriptor".format(characteristic))
+
+        if callback is not None:
+            self._subscriptions[characteristic.value_handle] = callback
+        yield _handle_pdu.pack(ATT_OP_WRITE_REQ, characteristic.cccd_handle) + _uint16.pack(value)
+        if callback is None:
+            self._subscriptions.pop(characteristic.value_handle, None)
+
+    def _on_notification(self, opcode, payload):
+        value_handle = _uint16.unpack_from(payload, 1)[0]
+        if opcode == ATT_OP_HANDLE_IND:
+            self.acl.send(self.handle, bytes(bytearray([ATT_OP_HANDLE_CNF])), ATT_CID)
+        callback = self._subscriptions.get(value_handle)
+        if callback is not None:
+            callback(payload[3:])
+
+
+class GATTClientManager(object):
+    # One frame listener (and request timeout thread) for the GATT clients of all the connections
+
+    INTERESTS = ((HCI_EVENT_PKT, EVT_DISCONN_COMPLETE),)
+
+    def __init__(self, acl, cache=None, timeout=ATT_TRANSACTION_TIMEOUT):
+        # acl: an ACLManager. cache: address -> discovered services, e.g. shared between managers or
+        # preloaded, a dict by default. timeout: of each ATT transaction, in seconds
+        self.acl = acl
+        self.cache = {} if cache is None else cache
+        self.timeout = timeout
+        self.clients = {}                   # connection handle -> GATTClient
+        self._condition = threading.Condition()
+        self._keep_running = True
+        self._timeout_thread = threading.Thread(target=self._timeout_loop, name='GATTClientTimeout')
+        self._timeout_thread.setDaemon(True)
+        self._timeout_thread.start()
+        acl.add_frame_listener(self._on_frame)
+        acl.hci.add_listener(self._on_packet, self.INTERESTS)
+
+    def close(self):
+        self.acl.remove_frame_listener(self._on_frame)
+        self.acl.hci.remove_listener(self._on_packet)
+        with self._condition:
+            self._keep_running = False
+            self._condition.notify()
+            futures = []
+            for client in self.clients.values():
+                client.connected = False
+                futures.extend(client._fail())
+            self.clients.clear()
+        self._timeout_thread.join()
+        for future in futures:
+            if not future.done():
+                future.set_exception(IOError("GATT client closed"))
+
+    def client(self, handle, address=None):
+        # The GATTClient of a connection handle, address (a BDAddress) to use the discovery cache
+        with self._condition:
+            client = self.clients.get(handle)
+            if client is None:
+                client = self.clients[handle] = GATTClient(self, handle, address)
+            return client
+
+    def invalidate(self, address):
+        # Forget the cached discovery of a device, e.g. after a firmware update changed its services
+        self.cache.pop(address, None)
+
+    def _on_frame(self, handle, cid, payload):
+        if cid != ATT_CID or not len(payload):
+            return
+        opcode = payload[0]
+        client = self.clients.get(handle)
+        if client is None:
+            return
+        if opcode in ATT_RESPONSES:
+            with self._condition:
+                future, outcome = client._on_response(payload)
+            if future is not None and not future.done():
+                if isinstance(outcome, Exception):
+                    future.set_exception(outcome)
+                else:
+                    future.set_result(outcome)
+        elif opcode == ATT_OP_HANDLE_NOTIFY or opcode == ATT_OP_HANDLE_IND:
+            client._on_notification(opcode, payload)
+
+    def _on_packet(self, packet):
+        if packet[1] != EVT_DISCONN_COMPLETE or packet[3] != HCI_SUCCESS:
+            return
+        handle = _uint16.unpack_from(packet, 4)[0]
+        with self._condition:
+            client = self.clients.pop(handle, None)
+            if client is None:
+                return
+            client.connected = False
+            futures = client._fail()
+        for future in futures:
+            if not future.done():
+                future.set_exception(IOError("Disconnected"))
+
+    def _timeout_loop(self):
+        condition = self._condition
+        while True:
+            expired = []
+            with condition:
+                if not self._keep_running:
+                    return
+                now = _clock()
+                next_deadline = None
+                for client in list(self.clients.values()):
+                    outstanding = client._outstanding
+                    if outstanding is None:
+                        continue
+                    if outstanding[0] <= now:
+                        # the bearer can't be used anymore after a transaction timeout
+                        client.connected = False
+                        expired.extend(client._fail())
+                    elif next_deadline is None or outstanding[0] < next_deadline:
+                        next_deadline = outstanding[0]
+                if not expired:
+                    condition.wait(None if next_deadline is None else next_deadline - now)
+            for future in expired:
+                if not future.done():
+                    future.set_exception(concurrent.futures.TimeoutError("ATT transaction timed out"))
@@ -0,0 +1,571 @@
+#!/usr/bin/python
+
+# GATT server
+#
+# GATTDatabase keeps the attributes in parallel arrays sorted by handle, plus one sorted handle array
+# per attribute type. Requests covering a handle range (Find Information, Read By Type, Read By Group
+# Type, Find By Type Value) are a bisect into the right array and a slice, however big the database.
+# Responses carry as many attributes as fit in the connection's MTU.
+#
+# GATTServer answers the ATT requests of every connection (each central has its own MTU and Client
+# Characteristic Configuration) and sends notifications and indications. Notifications are queued per
+# connection and handed to the ACL layer while the controller has buffers for them: whatever piles up
+# in between goes out together when the controller reports completed packets, i.e. once per
+# connection event, instead of trickling out one at a time.
+#
+#   database = GATTDatabase()
+#   database.add_service(0x180f)
+#   battery = database.add_characteristic(0x2a19, GATT_CHR_PROP_READ | GATT_CHR_PROP_NOTIFY, b'\x64')
+#   server = GATTServer(acl, database)
+#   server.notify(battery, b'\x63')
+#
+# Spec: Core_4.2.pdf Vol 3 Part F (ATT) and Part G (GATT)
+
+import concurrent.futures
+import struct
+import threading
+import traceback
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+from .constants import *
+from .decoder import decode_event
+from .gatt import GATTCharacteristic, uuid_from_bytes, uuid_to_bytes
+
+
+_uint16 = struct.Struct('<H')
+_handle_pdu = struct.Struct('<BH')              # opcode, handle
+_error_rsp = struct.Struct('<BBHB')             # opcode, request opcode, handle, error
+_handle_range = struct.Struct('<HH')
+
+# attribute access
+ATT_READ = 0x01
+ATT_WRITE = 0x02
+ATT_WRITE_CMD = 0x04
+
+_GROUP_TYPES = (GATT_PRIM_SVC_UUID, GATT_SND_SVC_UUID)
+
+
+class _CallbackError(Exception):
+    # an on_read / on_write callback raised, answered with an error for the attribute handle
+
+    def __init__(self, handle):
+        super(_CallbackError, self).__init__(handle)
+        self.handle = handle
+
+
+# -------------------------------------------------
+# Attribute database
+
+class GATTDatabase(object):
+
+    def __init__(self):
+        # one entry per attribute, sorted by handle
+        self.handles = array('H')
+        self.types = []                 # 16-bit UUIDs as ints, 128-bit ones as uuid.UUID
+        self.values = []                # bytes
+        self.access = []                # ATT_READ / ATT_WRITE / ATT_WRITE_CMD bits
+        self.group_ends = array('H')    # last handle of a service, for service declarations
+        self._by_type = {}              # type -> array of the handles of that type, sorted
+        self._type_bytes = {}           # type -> its UUID on the air
+        self._on_read = {}              # handle -> callback(connection handle), returning the value
+        self._on_write = {}             # handle -> callback(connection handle, value)
+        self.cccds = {}                 # Client Characteristic Configuration handle -> value handle
+        self.characteristics = {}       # value handle -> GATTCharacteristic
+        self._service = None            # index of the current service declaration
+        self._characteristic = None
+
+    def __len__(self):
+        return len(self.handles)
+
+    def _index(self, handle):
+        # position of the attribute, None if there isn't one with that handle
+        index = bisect_left(self.handles, handle)
+        if index < len(self.handles) and self.handles[index] == handle:
+            return index
+        return None
+
+    def _add(self, attribute_type, value, access, handle=None):
+        if handle is None:
+            handle = self.handles[-1] + 1 if self.handles else 0x0001
+        elif self.handles and handle <= self.handles[-1]:
+            raise ValueError("Handle 0x{:04x} not after the last one (0x{:04x})".format(handle, self.handles[-1]))
+        if handle > 0xffff:
+            raise ValueError("No handle left")
+        self.handles.append(handle)
+        self.types.append(attribute_type)
+        self.values.append(bytes(value))
+        self.access.append(access)
+        self.group_ends.append(handle)
+        by_type = self._by_type.get(attribute_type)
+        if by_type is None:
+            by_type = self._by_type[attribute_type] = array('H')
+            self._type_bytes[attribute_type] = uuid_to_bytes(attribute_type)
+        by_type.append(handle)
+        if self._service is not None:
+            self.group_ends[self._service] = handle
+        if self._characteristic is not None:
+            self._characteristic.end_handle = handle
+        return handle
+
+    def add_service(self, service_uuid, primary=True, handle=None):
+        # Start a service, the characteristics added next belong to it. handle: of the declaration,
+        # to keep handles stable (and clients' caches valid) as the database changes, next free by default
+        self._characteristic = None
+        self._service = None
+        handle = self._add(GATT_PRIM_SVC_UUID if primary else GATT_SND_SVC_UUID, uuid_to_bytes(service_uuid),
+                           ATT_READ, handle)
+        self._service = len(self.handles) - 1
+        return handle
+
+    def add_characteristic(self, characteristic_uuid, properties, value=b'', on_read=None, on_write=None):
+        # Declaration, value and, for notify / indicate, the Client Characteristic Configuration.
+        # on_read(connection handle) returns the value instead of the stored one, on_write(connection handle,
+        # value) is called after each write. Returns a GATTCharacteristic.
+        if self._service is None:
+            raise ValueError("add_service() first")
+        self._characteristic = None
+        handle = self._add(GATT_CHARAC_UUID, b'', ATT_READ)
+        value_handle = handle + 1
+        self.values[-1] = struct.pack('<BH', properties, value_handle) + uuid_to_bytes(characteristic_uuid)
+
+        access = ((ATT_READ if properties & GATT_CHR_PROP_READ else 0) |
+                  (ATT_WRITE if properties & GATT_CHR_PROP_WRITE else 0) |
+                  (ATT_WRITE_CMD if properties & GATT_CHR_PROP_WRITE_WITHOUT_RESP else 0))
+        self._add(characteristic_uuid, value, access)
+        if on_read is not None:
+            self._on_read[value_handle] = on_read
+        if on_write is not None:
+            self._on_write[value_handle] = on_write
+
+        characteristic = GATTCharacteristic(characteristic_uuid, handle, value_handle, properties, value_handle)
+        if properties & (GATT_CHR_PROP_NOTIFY | GATT_CHR_PROP_INDICATE):
+            characteristic.cccd_handle = self._add(GATT_CLIENT_CHARAC_CFG_UUID, b'\x00\x00', ATT_READ | ATT_WRITE)
+            self.cccds[characteristic.cccd_handle] = value_handle
+        characteristic.end_handle = self.handles[-1]
+        self.characteristics[value_handle] = characteristic
+        self._characteristic = characteristic
+        return characteristic
+
+    def add_descriptor(self, descriptor_uuid, value=b'', access=ATT_READ):
+        # A descriptor of the last characteristic, e.g. GATT_CHARAC_USER_DESC_UUID
+        if self._characteristic is None:
+            raise ValueError("add_characteristic() first")
+        return self._add(descriptor_uuid, value, access)
+
+    def get_value(self, handle):
+        if isinstance(handle, GATTCharacteristic):
+            handle = handle.value_handle
+        index = self._index(handle)
+        if index is None:
+            raise KeyError(handle)
+        return self.values[index]
+
+    def set_value(self, handle, value):
+        # Change a stored value, without notifying, see GATTServer.notify()
+        if isinstance(handle, GATTCharacteristic):
+            handle = handle.value_handle
+        index = self._index(handle)
+        if index is None:
+            raise KeyError(handle)
+        self.values[index] = bytes(value)
+
+    def range(self, start, end, attribute_type=None):
+        # (first, last + 1) positions of the attributes within the handles, of a type if given, in the
+        # handles array or the type's one
+        handles = self.handles if attribute_type is None else self._by_type.get(attribute_type, ())
+        return bisect_left(handles, start), bisect_right(handles, end)
+
+
+# -------------------------------------------------
+# Server
+
+class _Bearer(object):
+    # the ATT state of one connection
+    __slots__ = ('handle', 'mtu', 'configurations', 'notifications', 'indications', 'indicating')
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.mtu = ATT_DEFAULT_LE_MTU
+        self.configurations = {}        # value handle -> Client Characteristic Configuration bits
+        self.notifications = deque()    # notification PDUs not yet handed to the ACL layer
+        self.indications = deque()      # (PDU, future), waiting for the outstanding one to be confirmed
+        self.indicating = None          # future of the outstanding indication
+
+
+class GATTServer(object):
+
+    INTERESTS = ((HCI_EVENT_PKT, EVT_NUM_COMP_PKTS), (HCI_EVENT_PKT, EVT_DISCONN_COMPLETE))
+
+    def __init__(self, acl, database, mtu=ATT_MAX_MTU):
+        # acl: an ACLManager, database: a GATTDatabase, mtu: the largest ATT MTU accepted
+        self.acl = acl
+        self.database = database
+        self.mtu = mtu
+        self.bearers = {}               # connection handle -> _Bearer
+        self._lock = threading.Lock()
+        self.notifications_sent = 0
+        self.batches = 0                # times queued notifications were flushed together
+        self._handlers = {
+            ATT_OP_MTU_REQ: self._on_mtu_request,
+            ATT_OP_FIND_INFO_REQ: self._on_find_information,
+            ATT_OP_FIND_BY_TYPE_REQ: self._on_find_by_type_value,
+            ATT_OP_READ_BY_TYPE_REQ: self._on_read_by_type,
+            ATT_OP_READ_REQ: self._on_read,
+            ATT_OP_READ_BLOB_REQ: self._on_read_blob,
+            ATT_OP_READ_BY_GROUP_REQ: self._on_read_by_group_type,
+            ATT_OP_WRITE_REQ: self._on_write,
+            ATT_OP_WRITE_CMD: self._on_write,
+            ATT_OP_HANDLE_CNF: self._on_confirmation,
+        }
+        acl.add_frame_listener(self._on_frame)
+        acl.hci.add_listener(self._on_packet, self.INTERESTS)
+
+    def close(self):
+        self.acl.remove_frame_listener(self._on_frame)
+        self.acl.hci.remove_listener(self._on_packet)
+        with self._lock:
+            bearers = list(self.bearers.values())
+            self.bearers.clear()
+        for bearer in bearers:
+            self._fail_indications(bearer)
+
+    def _bearer(self, handle):
+        bearer = self.bearers.get(handle)
+        if bearer is None:
+            with self._lock:
+                bearer = self.bearers.setdefault(handle, _Bearer(handle))
+        return bearer
+
+    # -------------------------------------------------
+    # Requests
+
+    def _on_frame(self, handle, cid, payload):
+        if cid != ATT_CID or not len(payload):
+            return
+        opcode = payload[0]
+        handler = self._handlers.get(opcode)
+        if handler is None:
+            # unsupported requests (even opcodes) are answered, commands and anything for a client ignored
+            if not opcode & 0x41:
+                self._error(handle, opcode, 0x0000, ATT_ECODE_REQ_NOT_SUPP)
+            return
+        try:
+            handler(self._bearer(handle), opcode, payload)
+        except _CallbackError as exc:
+            # the application's fault, report it and don't leave the client waiting for its ATT timeout
+            traceback.print_exc()
+            if not opcode & 0x40:
+                self._error(handle, opcode, exc.handle, ATT_ECODE_UNLIKELY)
+        except (struct.error, ValueError):
+            # malformed PDU, must not take the receive thread down
+            if not opcode & 0x40:
+                self._error(handle, opcode, 0x0000, ATT_ECODE_INVALID_PDU)
+
+    def _send(self, bearer, pdu):
+        self.acl.send(bearer.handle, pdu, ATT_CID)
+
+    def _error(self, handle, opcode, attribute_handle, error):
+        self.acl.send(handle, _error_rsp.pack(ATT_OP_ERROR_RSP, opcode, attribute_handle, error), ATT_CID)
+
+    def _range(self, bearer, opcode, payload):
+        # the requested handle range, None (with the error sent) if invalid
+        if len(payload) < 5:
+            self._error(bearer.handle, opcode, 0x0000, ATT_ECODE_INVALID_PDU)
+            return None
+        start, end = _handle_range.unpack_from(payload, 1)
+        if start == 0 or start > end:
+            self._error(bearer.handle, opcode, start, ATT_ECODE_INVALID_HANDLE)
+            return None
+        return start, end
+
+    def _type(self, bearer, opcode, payload):
+        # the attribute type after the handle range, a 16 or 128-bit UUID, None (with the error sent) if invalid
+        if len(payload) not in (7, 21):
+            self._error(bearer.handle, opcode, 0x0000, ATT_ECODE_INVALID_PDU)
+            return None
+        return uuid_from_bytes(payload[5:])
+
+    def _read_value(self, bearer, index):
+        database = self.database
+        handle = database.handles[index]
+        value_handle = database.cccds.get(handle)
+        if value_handle is not None:
+            return _uint16.pack(bearer.configurations.get(value_handle, 0))
+        on_read = database._on_read.get(handle)
+        if on_read is not None:
+            try:
+                return bytes(on_read(bearer.handle))
+            except Exception as exc:
+                raise _CallbackError(handle) from exc
+        return database.values[index]
+
+    def _on_mtu_request(self, bearer, opcode, payload):
+        bearer.mtu = max(ATT_DEFAULT_LE_MTU, min(_uint16.unpack_from(payload, 1)[0], self.mtu))
+        self._send(bearer, _handle_pdu.pack(ATT_OP_MTU_RSP, self.mtu))
+
+    def _on_find_information(self, bearer, opcode, payload):
+        handle_range = self._range(bearer, opcode, payload)
+        if handle_range is None:
+            return
+        database = self.database
+        first, last = database.range(*handle_range)
+        if first == last:
+            return self._error(bearer.handle, opcode, handle_range[0], ATT_ECODE_ATTR_NOT_FOUND)
+        # one format per response: all 16-bit or all 128-bit types, as the first one
+        type_bytes = database._type_bytes
+        size = len(type_bytes[database.types[first]])
+        response = bytearray((ATT_OP_FIND_INFO_RSP, 0x01 if size == 2 else 0x02))
+        limit = bearer.mtu - 2 - size
+        for index in range(first, last):
+            uuid_bytes = type_bytes[database.types[index]]
+            if len(uuid_bytes) != size or len(response) > limit:
+                break
+            response += _uint16.pack(database.handles[index])
+            response += uuid_bytes
+        self._send(bearer, response)
+
+    def _on_find_by_type_value(self, bearer, opcode, payload):
+        # e.g. looking for a service by UUID: (found handle, group end) pairs
+        handle_range = self._range(bearer, opcode, payload)
+        if handle_range is None:
+            return
+        database = self.database
+        attribute_type = _uint16.unpack_from(payload, 5)[0]
+        value = bytes(payload[7:])
+        by_type = database._by_type.get(attribute_type, ())
+        first, last = database.range(handle_range[0], handle_range[1], attribute_type)
+        response = bytearray((ATT_OP_FIND_BY_TYPE_RSP,))
+        limit = bearer.mtu - 4
+        for position in range(first, last):
+            if len(response) > limit:
+                break
+            index = database._index(by_type[position])
+            if database.values[index] == value:
+                response += _handle_range.pack(database.handles[index], database.group_ends[index])
+        if len(response) == 1:
+            return self._error(bearer.handle, opcode, handle_range[0], ATT_ECODE_ATTR_NOT_FOUND)
+        self._send(bearer, response)
+
+    def _on_read_by_type(self, bearer, opcode, payload):
+        handle_range = self._range(bearer, opcode, payload)
+        if handle_range is None:
+            return
+        attribute_type = self._type(bearer, opcode, payload)
+        if attribute_type is None:
+            return
+        database = self.database
+        by_type = database._by_type.get(attribute_type, ())
+        first, last = database.range(handle_range[0], handle_range[1], attribute_type)
+        if first == last:
+            return self._error(bearer.handle, opcode, handle_range[0], ATT_ECODE_ATTR_NOT_FOUND)
+
+        # (handle, value) pairs all of the first one's length, values truncated to fit the MTU
+        response = bytearray((ATT_OP_READ_BY_TYPE_RSP, 0))
+        length = None
+        for position in range(first, last):
+            index = database._index(by_type[position])
+            if not database.access[index] & ATT_READ:
+                if length is None:
+                    return self._error(bearer.handle, opcode, database.handles[index], ATT_ECODE_READ_NOT_PERM)
+                break
+            value = self._read_value(bearer, index)[:min(bearer.mtu - 4, 253)]
+            if length is None:
+                length = len(value)
+            elif len(value) != length or len(response) + 2 + length > bearer.mtu:
+                break
+            response += _uint16.pack(database.handles[index])
+            response += value
+        response[1] = length + 2
+        self._send(bearer, response)
+
+    def _on_read_by_group_type(self, bearer, opcode, payload):
+        handle_range = self._range(bearer, opcode, payload)
+        if handle_range is None:
+            return
+        group_type = self._type(bearer, opcode, payload)
+        if group_type is None:
+            return
+        database = self.database
+        if group_type not in _GROUP_TYPES:
+            return self._error(bearer.handle, opcode, handle_range[0], ATT_ECODE_UNSUPP_GRP_TYPE)
+        by_type = database._by_type.get(group_type, ())
+        first, last = database.range(handle_range[0], handle_range[1], group_type)
+        if first == last:
+            return self._error(bearer.handle, opcode, handle_range[0], ATT_ECODE_ATTR_NOT_FOUND)
+
+        # (handle, group end, UUID), all 16-bit or all 128-bit UUIDs as the first one
+        response = bytearray((ATT_OP_READ_BY_GROUP_RSP, 0))
+        length = None
+        for position in range(first, last):
+            index = database._index(by_type[position])
+            value = database.values[index]
+            if length is None:
+                length = len(value)
+            elif len(value) != length or len(response) + 4 + length > bearer.mtu:
+                break
+            response += _handle_range.pack(database.handles[index], database.group_ends[index])
+            response += value
+        response[1] = length + 4
+        self._send(bearer, response)
+
+    def _on_read(self, bearer, opcode, payload):
+        self._read(bearer, opcode, _uint16.unpack_from(payload, 1)[0], None)
+
+    def _on_read_blob(self, bearer, opcode, payload):
+        handle, offset = _handle_range.unpack_from(payload, 1)
+        self._read(bearer, opcode, handle, offset)
+
+    def _read(self, bearer, opcode, handle, offset):
+        index = self.database._index(handle)
+        if index is None:
+            return self._error(bearer.handle, opcode, handle, ATT_ECODE_INVALID_HANDLE)
+        if not self.database.access[index] & ATT_READ:
+            return self._error(bearer.handle, opcode, handle, ATT_ECODE_READ_NOT_PERM)
+        value = self._read_value(bearer, index)
+        if offset is None:
+            response = bytearray((ATT_OP_READ_RSP,))
+            offset = 0
+        else:
+            if offset > len(value):
+                return self._error(bearer.handle, opcode, handle, ATT_ECODE_INVALID_OFFSET)
+            response = bytearray((ATT_OP_READ_BLOB_RSP,))
+        response += value[offset:offset + bearer.mtu - 1]
+        self._send(bearer, response)
+
+    def _on_write(self, bearer, opcode, payload):
+        # Write Request, or Write Command: never answered, not even with an error
+        command = opcode == ATT_OP_WRITE_CMD
+        handle = _uint16.unpack_from(payload, 1)[0]
+        value = bytes(payload[3:])
+        database = self.database
+        index = database._index(handle)
+        if index is None:
+            error = ATT_ECODE_INVALID_HANDLE
+        elif not database.access[index] & (ATT_WRITE_CMD if command else ATT_WRITE):
+            error = ATT_ECODE_WRITE_NOT_PERM
+        elif len(value) > ATT_MAX_VALUE_LEN:
+            error = ATT_ECODE_INVAL_ATTR_VALUE_LEN
+        elif handle in database.cccds:
+            if len(value) != 2:
+                error = ATT_ECODE_INVAL_ATTR_VALUE_LEN
+            else:
+                error = None
+                configuration = _uint16.unpack(value)[0]
+                if configuration:
+                    bearer.configurations[database.cccds[handle]] = configuration
+                else:
+                    bearer.configurations.pop(database.cccds[handle], None)
+        else:
+            error = None
+            database.values[index] = value
+            on_write = database._on_write.get(handle)
+            if on_write is not None:
+                try:
+                    on_write(bearer.handle, value)
+                except Exception as exc:
+                    raise _CallbackError(handle) from exc
+        if command:
+            return
+        if error is not None:
+            return self._error(bearer.handle, opcode, handle, error)
+        self._send(bearer, bytes(bytearray((ATT_OP_WRITE_RSP,))))
+
+    # -------------------------------------------------
+    # Notifications and indications
+
+    def subscribers(self, characteristic):
+        # handles of the connections which enabled notifications or indications of the characteristic
+        value_handle = characteristic.value_handle if isinstance(characteristic, GATTCharacteristic) else characteristic
+        return [bearer.handle for bearer in list(self.bearers.values()) if value_handle in bearer.configurations]
+
+    def notify(self, characteristic, value, connections=None):
+        # Store the value and notify the subscribed connections (or those of them given), with the value
+        # truncated to each one's MTU. Returns the number of notifications queued.
+        value_handle = characteristic.value_handle if isinstance(characteristic, GATTCharacteristic) else characteristic
+        self.database.set_value(value_handle, value)
+        value = bytes(value)
+        queued = 0
+        with self._lock:
+            for bearer in self.bearers.values():
+                if connections is not None and bearer.handle not in connections:
+                    continue
+                if bearer.configurations.get(value_handle, 0) & GATT_CCC_NOTIFY:
+                    bearer.notifications.append(_handle_pdu.pack(ATT_OP_HANDLE_NOTIFY, value_handle) +
+                                                value[:bearer.mtu - 3])
+                    self._flush(bearer)
+                    queued += 1
+        return queued
+
+    def indicate(self, characteristic, value, connections=None):
+        # As notify(), for connections which enabled indications. Returns {connection handle: future}, each
+        # resolving when that central has confirmed. A connection has one indication outstanding at a time.
+        value_handle = characteristic.value_handle if isinstance(characteristic, GATTCharacteristic) else characteristic
+        self.database.set_value(value_handle, value)
+        value = bytes(value)
+        futures = {}
+        with self._lock:
+            for bearer in self.bearers.values():
+                if connections is not None and bearer.handle not in connections:
+                    continue
+                if bearer.configurations.get(value_handle, 0) & GATT_CCC_INDICATE:
+                    future = futures[bearer.handle] = concurrent.futures.Future()
+                    pdu = _handle_pdu.pack(ATT_OP_HANDLE_IND, value_handle) + value[:bearer.mtu - 3]
+                    if bearer.indicating is None:
+                        bearer.indicating = future
+                        self._send(bearer, pdu)
+                    else:
+                        bearer.indications.append((pdu, future))
+        return futures
+
+    def _flush(self, bearer):
+        # must hold the lock: hand queued notifications to the ACL layer while the controller can take them
+        notifications = bearer.notifications
+        if not notifications:
+            return
+        available = self.acl.total_packets - self.acl.pending(bearer.handle)
+        if available <= 0:
+            return
+        if len(notifications) > 1 and available > 1:
+            self.batches += 1
+        while notifications and available > 0:
+            self._send(bearer, notifications.popleft())
+            self.notifications_sent += 1
+            available -= 1
+
+    def _on_confirmation(self, bearer, opcode, payload):
+        with self._lock:
+            future = bearer.indicating
+            bearer.indicating = None
+            if bearer.indications:
+                pdu, bearer.indicating = bearer.indications.popleft()
+                self._send(bearer, pdu)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    def _fail_indications(self, bearer):
+        futures = [future for _, future in bearer.indications]
+        if bearer.indicating is not None:
+            futures.append(bearer.indicating)
+        bearer.indications.clear()
+        bearer.indicating = None
+        for future in futures:
+            if not future.done():
+                future.set_exception(IOError("Disconnected"))
+
+    def _on_packet(self, packet):
+        evt = packet[1]
+        if evt == EVT_NUM_COMP_PKTS:
+            # the controller has sent packets (a connection event went by): flush what accumulated since
+            event = decode_event(packet)
+            with self._lock:
+                for handle in event.handles:
+                    bearer = self.bearers.get(handle)
+                    if bearer is not None:
+                        self._flush(bearer)
+        elif evt == EVT_DISCONN_COMPLETE and packet[3] == HCI_SUCCESS:
+            with self._lock:
+                bearer = self.bearers.pop(_uint16.unpack_from(packet, 4)[0], None)
+            if bearer is not None:
+                self._fail_indications(bearer)
@@ -18,50 +18,206 @@
 # With help from https://github.com/colin-guyon/py-bluetooth-utils and the BlueZ Python library.
 
 import array
+import errno
 import struct
 import fcntl
+import os
+import select
 import socket
 import threading
+import time
 
+from .address import BDAddress
 from .constants import *
+from .commands import HCICommandQueue
+from .filter import HCIFilter
+from .dispatch import DISPATCH_BLOCK, HCIDispatchQueue
+from .metrics import HCIMetrics
+from .router import HCIRouter
 
 
-# -------------------------------------------------
-# Socket HCI transport API
+_clock = getattr(time, 'perf_counter', time.time)
 
-# This socket based to the Bluetooth HCI.
 
-# Strong candidate for refactoring into factory pattern to support
-# alternate transports (e.g. serial) and easier mocking for automated testing.
+# -------------------------------------------------
+# HCI transport provider API
 
-class BluetoothHCISocketProvider:
+# Every transport (kernel socket, H4 UART, ...) implements this interface,
+# BluetoothHCI only ever talks to a provider through these methods.
+
+class BluetoothHCIProvider(object):
 
     def __init__(self, device_id=0):
         self.device_id = device_id
-        self._keep_running = True
+
+    def open(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def send_cmd(self, cmd, data):
+        # ioctl-equivalent, returns the (possibly updated) request buffer
+        raise NotImplementedError
+
+    def send_cmd_value(self, cmd, value):
+        # ioctl-equivalent taking an integer argument
+        raise NotImplementedError
+
+    def write_buffer(self, data):
+        raise NotImplementedError
+
+    def set_filter(self, data):
+        # data is packed using HCIPY_HCI_FILTER_STRUCT
+        raise NotImplementedError
+
+    def on_data(self, callback):
+        raise NotImplementedError
+
+    def on_data_batch(self, callback):
+        # callback receives a list of packets (memoryviews) per wakeup, only valid during the call
+        raise NotImplementedError
+
+    # Providers created with poller=False don't start a receive thread, instead whoever owns the
+    # event loop (e.g. a selector) calls read_ready() when fileno() becomes readable.
+
+    def fileno(self):
+        raise NotImplementedError
+
+    def read_ready(self):
+        # Receive and dispatch whatever is available without blocking, returns the number of packets
+        raise NotImplementedError
+
+    def receive_queue(self):
+        # (bytes received by the OS but not read yet, packets the OS dropped as its queue was full), see
+        # HCIMetrics. Either is None if unknown.
+        return None, None
+
+
+# Transport factory, providers register themselves by name.
+
+HCI_PROVIDERS = {}
+
+
+def register_hci_provider(name, provider_class):
+    HCI_PROVIDERS[name] = provider_class
+
+
+def create_hci_provider(transport='socket', device_id=0, **kwargs):
+    try:
+        provider_class = HCI_PROVIDERS[transport]
+    except KeyError:
+        raise ValueError("Unknown HCI transport: {}".format(transport))
+    return provider_class(device_id, **kwargs)
+
+
+# -------------------------------------------------
+# Socket HCI transport API
+
+# This socket based to the Bluetooth HCI.
+
+SO_RCVBUFFORCE = getattr(socket, 'SO_RCVBUFFORCE', 33)
+SO_MEMINFO = getattr(socket, 'SO_MEMINFO', 55)
+SK_MEMINFO_RMEM_ALLOC = 0
+SK_MEMINFO_DROPS = 8
+_meminfo = struct.Struct('=9I')
+
+# Largest packet a single recv can return: 1 indicator + 4 header + up to 1024 data bytes for ACL packets (the
+# kernel's HCI_MAX_ACL_SIZE, e.g. 1021 byte 3-DH5 payloads), events are at most 1 + 2 + 255 bytes.
+HCI_MAX_PACKET_SIZE = 1 + 4 + 1024
+
+class BluetoothHCISocketProvider(BluetoothHCIProvider):
+
+    def __init__(self, device_id=0, sock=None, buffer_pool_size=64 * HCI_MAX_PACKET_SIZE, poller=True,
+                 receive_buffer_size=None):
+        # sock: an already bound socket to use instead of a new HCI socket (e.g. a socketpair for testing)
+        # poller: start a receive thread on open(), otherwise read_ready() must be called by the owner
+        # receive_buffer_size: kernel socket receive buffer (SO_RCVBUF) in bytes, to absorb bursts
+        super(BluetoothHCISocketProvider, self).__init__(device_id)
+        self.poller = poller
         self._socket = None
         self._socket_on_data_user_callback = None
+        self._socket_on_data_batch_user_callback = None
         self._socket_poll_thread = None
-        self._socket = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW, socket.BTPROTO_HCI)
+        self._poller_stop = None            # Event of the running poller, each poller has its own
+        self._previous_poller = None        # stopped from its own callback, the next one waits for it to end
+        self._wakeup = None                 # self-pipe (read end, write end), wakes the poller up to stop it
+        self._eof = False
+        self._error = None                  # what ended the last _drain() other than EOF, e.g. ENETDOWN
+        self._bind_on_open = sock is None
+        self._receive_buffer_size = receive_buffer_size
+        if sock is None:
+            sock = self._create_socket()
+        self._socket = sock
+        if receive_buffer_size:
+            self.set_receive_buffer_size(receive_buffer_size)
+
+        # Preallocated receive pool, packets of one wakeup are received back-to-back into it
+        # and handed out as memoryview slices, so the receive path does no per-packet allocation.
+        self._buffer_pool = bytearray(max(buffer_pool_size, HCI_MAX_PACKET_SIZE))
+        self._buffer_pool_view = memoryview(self._buffer_pool)
 
 
     def __del__(self):
-        self._keep_running = False
+        wakeup = self._wakeup
+        if wakeup is not None:
+            os.close(wakeup[0])
+            os.close(wakeup[1])
 
+    def _create_socket(self):
+        if not self._bind_on_open:
+            raise IOError("The socket given to the provider has been closed and can't be reopened")
+        return socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW, socket.BTPROTO_HCI)
 
     def open(self):
+        if self._socket.fileno() < 0:
+            # reopened after close(), a closed socket can't be used (or bound) again
+            self._socket = self._create_socket()
+            if self._receive_buffer_size:
+                self.set_receive_buffer_size(self._receive_buffer_size)
 
         # TODO: specify channel: HCI_CHANNEL_RAW, HCI_CHANNEL_USER, HCI_CHANNEL_CONTROL
         # https://www.spinics.net/lists/linux-bluetooth/msg37345.html
-        self._socket.bind((self.device_id,))
-
-        self._socket_poll_thread = threading.Thread(target=self._socket_poller, name='HCISocketPoller')
+        if self._bind_on_open:
+            self._socket.bind((self.device_id,))
+
+        if not self.poller or self._socket_poll_thread is not None:
+            return
+
+        if self._wakeup is None:
+            self._wakeup = os.pipe()
+        self._poller_stop = threading.Event()
+        self._socket_poll_thread = threading.Thread(target=self._socket_poller, name='HCISocketPoller',
+                                                    args=(self._socket, self._poller_stop, self._previous_poller))
+        self._previous_poller = None
         self._socket_poll_thread.setDaemon(True)
         self._socket_poll_thread.start()
 
     def close(self):
+        # Stops (and joins) the poller first, so it never touches a closed socket. The next open() creates
+        # a new socket, see _create_socket().
+        self._stop_poller()
         self._socket.close()
 
+    def _stop_poller(self):
+        current = threading.current_thread()
+        thread = self._socket_poll_thread
+        if thread is not None:
+            self._poller_stop.set()
+            self._socket_poll_thread = None
+            if thread is current:
+                # close() from a callback: the poller ends once it returns, a poller started by open()
+                # meanwhile waits for that before receiving anything (the buffer pool is still in use)
+                self._previous_poller = thread
+                return
+            os.write(self._wakeup[1], b'\0')
+            thread.join()
+            os.read(self._wakeup[0], 64)
+        previous = self._previous_poller
+        if previous is not None and previous is not current:
+            previous.join()
+            self._previous_poller = None
+
     def send_cmd(self, cmd, data):
         arr = array.array('B', data)
         fcntl.ioctl(self._socket.fileno(), cmd, arr)
@@ -76,32 +232,318 @@ class BluetoothHCISocketProvider:
     def set_filter(self, data):
         self._socket.setsockopt(socket.SOL_HCI, socket.HCI_FILTER, data)
 
-    def _socket_poller(self):
-        while self._keep_running:
-            data = self._socket.recv(1024)         # blocking
-            if self._socket_on_data_user_callback:
-                self._socket_on_data_user_callback(bytearray(data))
+    def fileno(self):
+        return self._socket.fileno()
+
+    def set_receive_buffer_size(self, size):
+        # Beyond net.core.rmem_max the kernel silently caps SO_RCVBUF, SO_RCVBUFFORCE (CAP_NET_ADMIN) doesn't.
+        # Returns the size actually in effect (as reported by the kernel, which doubles it for bookkeeping).
+        sock = self._socket
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) < size:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, size)
+            except (IOError, OSError):
+                pass
+        return self.receive_buffer_size()
+
+    def receive_buffer_size(self):
+        return self._socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+    def receive_queue(self):
+        # From SO_MEMINFO (Linux 4.12+): the memory charged for the queued packets (their payload plus the
+        # kernel's per packet overhead, compare with receive_buffer_size()) and the socket's drop counter.
+        # FIONREAD is no use here, for datagram sockets it only gives the size of the next packet.
+        try:
+            meminfo = self._socket.getsockopt(socket.SOL_SOCKET, SO_MEMINFO, _meminfo.size)
+        except (IOError, OSError, ValueError):
+            return None, None
+        if len(meminfo) < _meminfo.size:
+            return None, None
+        meminfo = _meminfo.unpack(meminfo)
+        return meminfo[SK_MEMINFO_RMEM_ALLOC], meminfo[SK_MEMINFO_DROPS]
+
+    def _socket_poller(self, sock, stop, previous):
+        # Sleeps in select() on both the socket and the self-pipe, so close() wakes it up at once instead
+        # of it sleeping in recv on a socket closed under it. While packets keep arriving it only drains
+        # the socket, without a select() per wakeup. stop and sock are this poller's own, a later one (after
+        # a restart from a callback) has new ones.
+        if previous is not None:
+            previous.join()
+        wakeup = self._wakeup[0]
+        readable = [sock, wakeup]
+
+        while not stop.is_set():
+            batch = self._drain(sock)
+            if batch:
+                self._dispatch_batch(batch)
+            if self._error is not None:
+                raise self._error       # ends the poller, reported by threading
+            if self._eof or stop.is_set():
+                break
+            if len(batch) > 1:
+                continue        # busy, most likely more is queued already
+            try:
+                ready = select.select(readable, [], [])[0]
+            except (IOError, OSError, ValueError):
+                break           # closed by its owner
+            if wakeup in ready:
+                break
+
+    def read_ready(self):
+        batch = self._drain(self._socket)
+        if batch:
+            self._dispatch_batch(batch)
+        if self._error is not None:
+            raise self._error
+        if self._eof:
+            raise IOError("HCI socket closed by the peer")
+        return len(batch)
+
+    def _drain(self, sock):
+        # receive whatever else is already queued on the socket, without blocking. A zero length read is
+        # the end of the stream (e.g. the peer of a socketpair closed), not a packet. Any other error than
+        # "nothing queued" is kept in _error, for the caller to raise once what was read is dispatched.
+        pool = self._buffer_pool_view
+        last_offset = len(pool) - HCI_MAX_PACKET_SIZE
+        batch = []
+        offset = 0
+        self._eof = False
+        self._error = None
+        while offset <= last_offset:
+            try:
+                nbytes = sock.recv_into(pool[offset:offset + HCI_MAX_PACKET_SIZE],
+                                        HCI_MAX_PACKET_SIZE, socket.MSG_DONTWAIT)
+            except (IOError, OSError, ValueError) as e:
+                if getattr(e, 'errno', None) not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._error = e     # e.g. ENETDOWN once the adapter is gone, ValueError once closed
+                break
+            if not nbytes:
+                self._eof = True
+                break
+            batch.append(pool[offset:offset + nbytes])
+            offset += nbytes
+        return batch
+
+    def _dispatch_batch(self, batch):
+        batch_callback = self._socket_on_data_batch_user_callback
+        if batch_callback:
+            batch_callback(batch)
+
+        callback = self._socket_on_data_user_callback
+        if callback:
+            for packet in batch:
+                callback(bytearray(packet))
 
     def on_data(self, callback):
         self._socket_on_data_user_callback = callback
 
+    def on_data_batch(self, callback):
+        self._socket_on_data_batch_user_callback = callback
+
+
+register_hci_provider('socket', BluetoothHCISocketProvider)
+
 
 class BluetoothHCI:
 
-    def __init__(self, device_id=0, auto_start = True):
-        # TODO: be given a provider interface from a factory (e.g. socket, serial, mock)
-        self.hci = BluetoothHCISocketProvider(device_id)
+    # Interests (see HCIFilter.add) of the command queue, which needs every command response
+    COMMAND_INTERESTS = ((HCI_EVENT_PKT, EVT_CMD_COMPLETE), (HCI_EVENT_PKT, EVT_CMD_STATUS))
+
+    # Interests assumed for callbacks registered without any
+    ALL_INTERESTS = ((None,),)
+
+    def __init__(self, device_id=0, auto_start = True, transport='socket', provider=None, auto_filter=False,
+                 metrics=False, **transport_options):
+        # The provider can be given directly (e.g. a mock), otherwise it's built by the transport factory,
+        # e.g. BluetoothHCI(transport='uart', port='/dev/ttyAMA0', baudrate=921600)
+        # auto_filter: keep the HCI filter in sync with the interests of the registered callbacks/listeners,
+        # instead of the caller using set_filter()
+        # metrics: collect HCIMetrics, see stats() and enable_metrics()
+        if provider is None:
+            provider = create_hci_provider(transport, device_id, **transport_options)
+        self.hci = provider
+        self._on_data_user_callback = None
+        self._on_data_batch_user_callback = None
+        self._listeners = []
+        self._capture = None
+        self._dispatch_queue = None
+        self._dispatch_args = None
+        self.router = HCIRouter()
+
+        self.auto_filter = auto_filter
+        self.filter = HCIFilter()
+        self.filter.update(self.COMMAND_INTERESTS)
+        self._filter_lock = threading.Lock()
+        self._interests = {}                    # 'on_data' / 'on_data_batch' / listener -> interests
+        self._pushed_filter = None
+
+        # Received packets are always taken from the provider in batches, so that command responses
+        # can be tracked before the packets are handed on to the user callbacks.
+        self.commands = HCICommandQueue(self.write)
+        self.last_restart_time = None
+        self.metrics = None
+        self.enable_metrics(metrics)
+
         if auto_start:
             self.start()
 
+    def _on_data_batch(self, batch):
+        capture = self._capture
+        if capture:
+            for packet in batch:
+                capture.write_packet(packet, True)
+        self._stage_commands(batch)
+        self._stage_listeners(batch)
+        self._stage_on_data_batch(batch)
+        self._stage_on_data(batch)
+
+    # The dispatch stages, each returns whether it had anything to do (for the metered path's timing)
+
+    def _stage_commands(self, batch):
+        commands = False
+        for packet in batch:
+            if packet[0] == HCI_EVENT_PKT and (packet[1] == EVT_CMD_COMPLETE or packet[1] == EVT_CMD_STATUS):
+                self.commands.on_event(bytearray(packet))
+                commands = True
+        return commands
+
+    def _stage_listeners(self, batch):
+        listeners = self._listeners
+        for listener in listeners:
+            for packet in batch:
+                listener(packet)
+        return bool(listeners)
+
+    def _stage_on_data_batch(self, batch):
+        batch_callback = self._on_data_batch_user_callback
+        if batch_callback:
+            batch_callback(batch)
+            return True
+        return False
+
+    def _stage_on_data(self, batch):
+        callback = self._on_data_user_callback
+        if callback:
+            dispatch_queue = self._dispatch_queue
+            if dispatch_queue is not None:
+                callback = dispatch_queue.put
+            for packet in batch:
+                callback(bytearray(packet))
+            return True
+        return False
+
+    def _on_data_batch_metered(self, batch):
+        # _on_data_batch timing each stage, installed by enable_metrics()
+        metrics = self.metrics
+        if metrics is None:
+            return self._on_data_batch(batch)
+        clock = metrics.clock
+        callback_time = metrics.callback_time
+        start = clock()
+        metrics.count_batch(batch)
+
+        capture = self._capture
+        if capture:
+            for packet in batch:
+                capture.write_packet(packet, True)
+
+        stage_start = clock()
+        for name, stage in (('commands', self._stage_commands), ('listeners', self._stage_listeners),
+                            ('on_data_batch', self._stage_on_data_batch), ('on_data', self._stage_on_data)):
+            if stage(batch):
+                now = clock()
+                callback_time[name].add((now - stage_start) * 1e6)
+                stage_start = now
+
+        metrics.dispatch_time.add((clock() - start) * 1e6)
+        metrics.count_queue(*self.hci.receive_queue())
+
+    # -------------------------------------------------
+    # Metrics
+
+    def enable_metrics(self, enabled=True):
+        # Switches the provider between the plain and the instrumented receive path, so that disabled
+        # metrics cost nothing. Enabling again keeps the collected metrics, use metrics.reset() to clear.
+        if enabled:
+            if self.metrics is None:
+                self.metrics = HCIMetrics()
+            self.hci.on_data_batch(self._on_data_batch_metered)
+        else:
+            self.metrics = None
+            self.hci.on_data_batch(self._on_data_batch)
+        self.commands.metrics = self.metrics
+
+    def stats(self):
+        # Snapshot of the metrics as a plain dict, None if metrics are disabled
+        metrics = self.metrics
+        if metrics is None:
+            return None
+        stats = metrics.stats()
+        dispatch_queue = self._dispatch_queue
+        if dispatch_queue is not None:
+            stats['dispatch'] = dispatch_queue.stats()
+        return stats
+
+    # -------------------------------------------------
+    # Dispatch queue
+
+    def enable_dispatch(self, workers=1, max_size=1024, overflow=DISPATCH_BLOCK, key=None):
+        # Run the on_data callback on a pool of worker threads fed by a bounded queue (see HCIDispatchQueue),
+        # instead of on the receive thread. on_data_batch callbacks and listeners still run on the receive
+        # thread, as their memoryviews are only valid during the call. Returns the queue, for its counters.
+        # stop() drains and joins the workers, start() creates a new queue with the same settings.
+        self.disable_dispatch()
+        self._dispatch_args = (workers, max_size, overflow, key)
+        return self._open_dispatch()
+
+    def disable_dispatch(self, drain=True):
+        self._dispatch_args = None
+        self._close_dispatch(drain)
+
+    def _open_dispatch(self):
+        if self._dispatch_args is not None and self._dispatch_queue is None:
+            self._dispatch_queue = HCIDispatchQueue(self._dispatch_on_data, *self._dispatch_args)
+        return self._dispatch_queue
+
+    def _close_dispatch(self, drain=True):
+        dispatch_queue = self._dispatch_queue
+        if dispatch_queue is not None:
+            self._dispatch_queue = None
+            dispatch_queue.close(drain)
+
+    def _dispatch_on_data(self, data):
+        callback = self._on_data_user_callback
+        if callback:
+            callback(data)
+
     # -------------------------------------------------
     # Public HCI API, simply delegates to the composite HCI provider
 
     def start(self):
+        self._open_dispatch()
         self.hci.open()
+        with self._filter_lock:
+            self._pushed_filter = None
+            self._push_filter()
 
     def stop(self):
+        # Returns once the provider's receive thread and the dispatch workers have ended, commands still pending
+        # fail with IOError. start() can be called again afterwards, see restart().
         self.hci.close()
+        self._close_dispatch()
+        self.commands.close()
+
+    def restart(self):
+        # stop() and start() again on the same objects, e.g. to recover after device_down() / device_up().
+        # Returns the time it took in seconds, also kept as last_restart_time and in the metrics.
+        started = _clock()
+        self.stop()
+        self.start()
+        elapsed = self.last_restart_time = _clock() - started
+        if self.metrics is not None:
+            self.metrics.restarted(elapsed)
+        return elapsed
 
     def send_cmd(self, cmd, data):
         return self.hci.send_cmd(cmd, data)
@@ -118,13 +560,92 @@ class BluetoothHCI:
         self.hci.send_cmd_value(cmd, value)
 
     def write(self, data):
+        capture = self._capture
+        if capture:
+            capture.write_packet(data, False)
         self.hci.write_buffer(data)
 
+    def capture(self, writer):
+        # Record all traffic (as passed by the HCI filter) to a BTSnoopWriter, None to stop
+        self._capture = writer
+
     def set_filter(self, data):
         self.hci.set_filter(data)
 
-    def on_data(self, callback):
-        self.hci.on_data(callback)
+    def on_data(self, callback, interests=None):
+        # interests: the packets the callback wants, for auto_filter, e.g. [(HCI_EVENT_PKT, EVT_LE_META_EVENT)]
+        self._on_data_user_callback = callback
+        self._set_interests('on_data', interests if callback else ())
+
+    def on_data_batch(self, callback, interests=None):
+        # Called once per receive wakeup with a list of memoryviews, these are only valid during the callback.
+        self._on_data_batch_user_callback = callback
+        self._set_interests('on_data_batch', interests if callback else ())
+
+    def add_listener(self, callback, interests=None):
+        # Internal packet listeners (e.g. the ACL layer), called with each received packet as a
+        # memoryview before the user callbacks. The memoryview is only valid during the call.
+        self._listeners = self._listeners + [callback]      # copy on write, the poller may be iterating
+        self._set_interests(callback, interests)
+
+    def remove_listener(self, callback):
+        self._listeners = [listener for listener in self._listeners if listener != callback]
+        self._set_interests(callback, ())
+
+    def subscribe(self, callback, packet_type=None, event=None, subevent=None, opcode=None, handle=None):
+        # Route packets by packet type, event, LE subevent, command opcode or connection handle, see HCIRouter.
+        # The router runs as a listener, so callbacks get memoryviews only valid during the call.
+        subscription = self.router.subscribe(callback, packet_type, event, subevent, opcode, handle)
+        self._update_router()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.router.unsubscribe(subscription)
+        self._update_router()
+
+    def _update_router(self):
+        route = self.router.route
+        if not self.router:
+            self.remove_listener(route)
+        elif route in self._listeners:
+            self._set_interests(route, self.router.interests())
+        else:
+            self.add_listener(route, self.router.interests())
+
+    def _set_interests(self, owner, interests):
+        # None means everything, () nothing
+        if interests is None:
+            interests = self.ALL_INTERESTS
+        with self._filter_lock:
+            self.filter.update(self._interests.pop(owner, ()), remove=True)
+            if interests:
+                self._interests[owner] = tuple(interests)
+                self.filter.update(interests)
+            self._push_filter()
+
+    def _push_filter(self):
+        if not self.auto_filter:
+            return
+        data = self.filter.pack()
+        if data != self._pushed_filter:
+            self.hci.set_filter(data)
+            self._pushed_filter = data
+
+    def fileno(self):
+        return self.hci.fileno()
+
+    def read_ready(self):
+        # only for providers created with poller=False, see BluetoothHCIAdapterManager
+        return self.hci.read_ready()
+
+    def send_command(self, opcode, params=b'', timeout=None):
+        # Queued with Num_HCI_Command_Packets flow control, returns a concurrent.futures.Future that resolves
+        # with the decoded CommandComplete/CommandStatus (or fails with HCICommandError / TimeoutError).
+        return self.commands.submit(opcode, params, timeout)
+
+    def send_command_packet(self, packet, timeout=None):
+        # As send_command, for a complete command packet, e.g. from one of the command builders
+        return self.commands.submit_packet(packet, timeout)
 
     # -------------------------------------------------
     # Public HCI Convenience API
@@ -158,7 +679,7 @@ class BluetoothHCI:
         # Just extract a few parts for now
         device_id = hci_dev_info[0]
         device_name = hci_dev_info[1].split(b'\0',1)[0]
-        bd_addr = "%0x:%0x:%0x:%0x:%0x:%0x" % hci_dev_info[7:1:-1]
+        bd_addr = str(BDAddress.from_bytes(bytearray(hci_dev_info[2:8])))
 
         return dict(id=device_id,
                     name=device_name,
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+# Multi-adapter manager
+#
+# Opens several HCI devices and services all of their sockets from a single selector (epoll) thread,
+# instead of one poller thread per adapter. Received packets are tagged with the source device id.
+# Also keeps simple per-adapter load counters to spread work (scans, connections, ...) across adapters.
+
+import functools
+import os
+import selectors
+import threading
+import traceback
+from collections import OrderedDict, defaultdict
+
+from .hci import BluetoothHCI
+
+
+class BluetoothHCIAdapterManager(object):
+
+    def __init__(self, device_ids=(), transport='socket', **transport_options):
+        self.adapters = OrderedDict()       # device_id -> BluetoothHCI
+        self.packets_received = defaultdict(int)
+        self._load = defaultdict(lambda: defaultdict(int))     # device_id -> kind -> count
+        self._transport = transport
+        self._transport_options = transport_options
+        self._selector = selectors.DefaultSelector()
+        self._selector_thread = None
+        self._keep_running = False
+        self._lock = threading.Lock()
+        self._on_data_user_callback = None
+        self._on_data_batch_user_callback = None
+        self._on_error_user_callback = None
+
+        # self-pipe, used to wake the selector thread up to stop it
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+
+        for device_id in device_ids:
+            self.add_adapter(device_id)
+
+    def __getitem__(self, device_id):
+        return self.adapters[device_id]
+
+    def __iter__(self):
+        return iter(list(self.adapters.values()))
+
+    def __len__(self):
+        return len(self.adapters)
+
+    # -------------------------------------------------
+    # Adapters
+
+    def add_adapter(self, device_id, provider=None):
+        # provider: optional, must have been created with poller=False
+        with self._lock:
+            if device_id in self.adapters:
+                raise ValueError("Adapter {} is already managed".format(device_id))
+            if provider is None:
+                hci = BluetoothHCI(device_id, auto_start=False, transport=self._transport, poller=False,
+                                   **self._transport_options)
+            else:
+                hci = BluetoothHCI(device_id, auto_start=False, provider=provider)
+            hci.on_data_batch(functools.partial(self._on_adapter_data_batch, device_id))
+            hci.start()
+            self.adapters[device_id] = hci
+            self._selector.register(hci.fileno(), selectors.EVENT_READ, hci)
+        return hci
+
+    def remove_adapter(self, device_id):
+        with self._lock:
+            hci = self.adapters.pop(device_id)
+            self._selector.unregister(hci.fileno())
+            self._load.pop(device_id, None)
+            self.packets_received.pop(device_id, None)
+        hci.stop()
+
+    # -------------------------------------------------
+    # Selector thread
+
+    def start(self):
+        if self._selector_thread is not None:
+            return
+        self._keep_running = True
+        self._selector_thread = threading.Thread(target=self._selector_loop, name='HCIAdapterManager')
+        self._selector_thread.setDaemon(True)
+        self._selector_thread.start()
+
+    def stop(self):
+        if self._selector_thread is None:
+            return
+        self._keep_running = False
+        os.write(self._wakeup_w, b'\0')
+        self._selector_thread.join()
+        self._selector_thread = None
+
+    def close(self):
+        self.stop()
+        for device_id in list(self.adapters):
+            self.remove_adapter(device_id)
+        self._selector.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+    def _selector_loop(self):
+        select = self._selector.select
+        while self._keep_running:
+            for key, _ in select():
+                hci = key.data
+                if hci is None:
+                    os.read(self._wakeup_r, 64)
+                    continue
+                try:
+                    hci.read_ready()
+                except (IOError, OSError) as exc:
+                    # the transport failed (unplugged, peer closed, ...): drop that adapter, keep the others
+                    self._adapter_failed(key, exc)
+                except Exception as exc:
+                    # raised by a callback (e.g. a listener), the adapter itself is fine
+                    self._report(self._device_id(hci), exc)
+
+    def _device_id(self, hci):
+        return next((device_id for device_id, adapter in list(self.adapters.items()) if adapter is hci), None)
+
+    def _adapter_failed(self, key, exc):
+        hci = key.data
+        with self._lock:
+            self._selector.unregister(key.fileobj)
+            device_id = self._device_id(hci)
+            if device_id is not None:
+                del self.adapters[device_id]
+                self._load.pop(device_id, None)
+                self.packets_received.pop(device_id, None)
+        try:
+            hci.stop()
+        except (IOError, OSError):
+            pass
+        self._report(device_id, exc)
+
+    def _report(self, device_id, exc):
+        callback = self._on_error_user_callback
+        if callback:
+            callback(device_id, exc)
+        else:
+            traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+    def _on_adapter_data_batch(self, device_id, batch):
+        self.packets_received[device_id] += len(batch)
+
+        # whatever the user callbacks raise (IOError included) is theirs, not the adapter's: reported, and the
+        # following packets are still delivered
+        batch_callback = self._on_data_batch_user_callback
+        if batch_callback:
+            try:
+                batch_callback(device_id, batch)
+            except Exception as exc:
+                self._report(device_id, exc)
+
+        callback = self._on_data_user_callback
+        if callback:
+            for packet in batch:
+                try:
+                    callback(device_id, bytearray(packet))
+                except Exception as exc:
+                    self._report(device_id, exc)
+
+    # -------------------------------------------------
+    # Callbacks, tagged with the source adapter
+
+    def on_data(self, callback):
+        # callback(device_id, data)
+        self._on_data_user_callback = callback
+
+    def on_data_batch(self, callback):
+        # callback(device_id, batch), the memoryviews are only valid during the callback
+        self._on_data_batch_user_callback = callback
+
+    def on_error(self, callback):
+        # callback(device_id, exception), called on the selector thread for exceptions raised by callbacks (the
+        # adapter is kept) and for transport errors, once the failed adapter has been removed and stopped (it is
+        # no longer in adapters). The other adapters keep being serviced. Without it the traceback is printed.
+        self._on_error_user_callback = callback
+
+    # -------------------------------------------------
+    # Placement, e.g:
+    #   device_id = manager.acquire('connections')
+    #   ... connect using manager[device_id] ...
+    #   manager.release(device_id, 'connections')
+
+    def load(self, device_id, kind):
+        return self._load[device_id][kind]
+
+    def least_loaded(self, kind):
+        # the adapter with the fewest 'kind' (ties broken by received traffic), None if there are no adapters
+        with self._lock:
+            return self._least_loaded(kind)
+
+    def acquire(self, kind):
+        with self._lock:
+            device_id = self._least_loaded(kind)
+            if device_id is None:
+                raise ValueError("No adapters")
+            self._load[device_id][kind] += 1
+        return device_id
+
+    def _least_loaded(self, kind):
+        if not self.adapters:
+            return None
+        return min(self.adapters, key=lambda device_id: (self._load[device_id][kind], self.packets_received[device_id]))
+
+    def release(self, device_id, kind):
+        with self._lock:
+            if self._load[device_id][kind] > 0:
+                self._load[device_id][kind] -= 1
+
+    def spread(self, items, kind):
+        # assign each item to the least loaded adapter in turn, returns {device_id: [items]}
+        placement = defaultdict(list)
+        for item in items:
+            placement[self.acquire(kind)].append(item)
+        return dict(placement)
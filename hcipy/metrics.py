@@ -0,0 +1,167 @@
+#!/usr/bin/python
+
+# Runtime metrics
+#
+# Counters and histograms to see where a busy host spends its time: received packets and bytes by
+# packet type / event / subevent, command round-trip latency by opcode, time spent in each stage of
+# the receive dispatch (command tracking, listeners, user callbacks), per wakeup dispatch time, how
+# many packets were queued per wakeup, what was still queued after it and how many packets the kernel
+# dropped because its receive queue was full (sockets only, from SO_MEMINFO).
+#
+# Metrics are off by default, see BluetoothHCI(metrics=True). When off nothing is measured or counted:
+# BluetoothHCI installs an uninstrumented receive path instead of checking a flag per packet.
+
+import time
+from collections import defaultdict
+
+from .constants import *
+
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class Histogram(object):
+    # Power of two buckets: bucket n counts values below 2**n (bucket 0: below 1), the last bucket
+    # counts everything else. Latencies are recorded in microseconds.
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    BUCKETS = 25            # up to ~16s in microseconds
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * self.BUCKETS
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.buckets[min(int(value).bit_length(), self.BUCKETS - 1)] += 1
+
+    def percentile(self, fraction):
+        # upper bound of the bucket holding the given fraction of the samples, None if empty
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for n, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(1 << n, self.max)
+        return self.max
+
+    def snapshot(self):
+        return dict(count=self.count,
+                    mean=self.total / float(self.count) if self.count else None,
+                    min=self.min,
+                    max=self.max,
+                    p50=self.percentile(0.5),
+                    p99=self.percentile(0.99),
+                    buckets={1 << n: count for n, count in enumerate(self.buckets) if count})
+
+
+class HCIMetrics(object):
+
+    def __init__(self, clock=_clock):
+        self.clock = clock
+        self._drops_seen = None                         # last kernel drop counter, see count_queue()
+        self.reset()
+
+    def reset(self):
+        self.started = self.clock()
+        self.packets = defaultdict(int)                 # (packet_type, event, subevent) -> count
+        self.bytes = defaultdict(int)                   # (packet_type, event, subevent) -> bytes
+        self.commands_sent = 0
+        self.command_latency = defaultdict(Histogram)   # opcode -> round trip in us
+        self.command_timeouts = defaultdict(int)        # opcode -> count
+        self.callback_time = defaultdict(Histogram)     # dispatch stage -> us per wakeup
+        self.dispatch_time = Histogram()                # us to dispatch everything received in one wakeup
+        self.batch_size = Histogram()                   # packets received per wakeup
+        self.queue_bytes = Histogram()                  # bytes still queued on the transport after a wakeup
+        self.backlogged = 0                             # wakeups after which more was already queued
+        self.transport_dropped = 0                      # packets the kernel dropped, its receive queue was full
+        self.restart_time = Histogram()                 # us to stop and start the transport again
+
+    # -------------------------------------------------
+    # Recording, called from BluetoothHCI / HCICommandQueue
+
+    def count_batch(self, batch):
+        packets = self.packets
+        nbytes = self.bytes
+        for packet in batch:
+            packet_type = packet[0]
+            if packet_type == HCI_EVENT_PKT:
+                event = packet[1]
+                key = (packet_type, event, packet[3] if event == EVT_LE_META_EVENT and len(packet) > 3 else None)
+            else:
+                key = (packet_type, None, None)
+            packets[key] += 1
+            nbytes[key] += len(packet)
+        self.batch_size.add(len(batch))
+
+    def count_queue(self, queued, dropped=None):
+        # see BluetoothHCIProvider.receive_queue(), either is None if the transport can't tell. dropped is the
+        # kernel's counter for the socket, only its increase (or all of it, for a new socket) is counted.
+        if queued is not None:
+            self.queue_bytes.add(queued)
+            if queued:
+                self.backlogged += 1
+        if dropped is not None:
+            seen = self._drops_seen
+            if seen is not None and dropped != seen:
+                self.transport_dropped += dropped - seen if dropped > seen else dropped
+            self._drops_seen = dropped
+
+    def command_sent(self):
+        self.commands_sent += 1
+
+    def command_completed(self, opcode, seconds):
+        self.command_latency[opcode].add(seconds * 1e6)
+
+    def command_timed_out(self, opcode):
+        self.command_timeouts[opcode] += 1
+
+    def restarted(self, seconds):
+        self.restart_time.add(seconds * 1e6)
+
+    # -------------------------------------------------
+    # Snapshot
+
+    def stats(self):
+        # A plain dict (e.g. for logging as JSON, the tuple keys are formatted as strings). The receive thread
+        # keeps adding keys, so the dicts are copied before iterating.
+        packets = {}
+        for key, count in list(self.packets.items()):
+            packets[self._packet_key(*key)] = dict(packets=count, bytes=self.bytes[key])
+
+        return dict(uptime=self.clock() - self.started,
+                    packets=packets,
+                    packets_total=sum(list(self.packets.values())),
+                    bytes_total=sum(list(self.bytes.values())),
+                    commands_sent=self.commands_sent,
+                    command_latency_us={'0x{:04x}'.format(opcode): histogram.snapshot()
+                                        for opcode, histogram in list(self.command_latency.items())},
+                    command_timeouts={'0x{:04x}'.format(opcode): count
+                                      for opcode, count in list(self.command_timeouts.items())},
+                    callback_time_us={name: histogram.snapshot()
+                                      for name, histogram in list(self.callback_time.items())},
+                    dispatch_time_us=self.dispatch_time.snapshot(),
+                    batch_size=self.batch_size.snapshot(),
+                    queue_bytes=self.queue_bytes.snapshot(),
+                    backlogged=self.backlogged,
+                    transport_dropped=self.transport_dropped,
+                    restart_time_us=self.restart_time.snapshot())
+
+    @staticmethod
+    def _packet_key(packet_type, event, subevent):
+        key = '0x{:02x}'.format(packet_type)
+        if event is not None:
+            key += '/0x{:02x}'.format(event)
+        if subevent is not None:
+            key += '/0x{:02x}'.format(subevent)
+        return key
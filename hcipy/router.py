@@ -0,0 +1,164 @@
+#!/usr/bin/python
+
+# Event subscription router
+#
+# Many subscribers share one adapter, each subscribed to the packets it wants by packet type, event
+# code, LE subevent, command opcode or connection handle. A packet is routed with at most a handful of
+# dict lookups on keys taken from its header, whatever the number of subscribers, and no subscriber
+# sees (or has to filter out) packets it didn't subscribe to.
+#
+#   hci.subscribe(on_connection, subevent=EVT_LE_CONN_COMPLETE)
+#   hci.subscribe(on_scan_enabled, opcode=LE_SET_SCAN_ENABLE_CMD)
+#   hci.subscribe(on_link, handle=0x0040)
+
+import threading
+
+from .constants import *
+
+
+# Events carrying a connection handle, (event, subevent) -> offset of the handle in the packet
+HANDLE_OFFSETS = {
+    (EVT_DISCONN_COMPLETE, None): 4,
+    (EVT_LE_META_EVENT, EVT_LE_CONN_COMPLETE): 5,
+    (EVT_LE_META_EVENT, EVT_LE_CONN_UPDATE_COMPLETE): 5,
+    (EVT_LE_META_EVENT, EVT_LE_READ_REMOTE_USED_FEATURES_COMPLETE): 5,
+}
+
+
+def register_handle_offset(event, subevent, offset):
+    # e.g. for vendor or newer events, so that handle subscribers receive them
+    HANDLE_OFFSETS[(event, subevent)] = offset
+
+
+class HCISubscription(object):
+    __slots__ = ('callback', 'key', 'interests')
+
+    def __init__(self, callback, key, interests):
+        self.callback = callback
+        self.key = key
+        self.interests = interests      # for HCIFilter
+
+    def __repr__(self):
+        return '<HCISubscription {!r}>'.format(self.key)
+
+
+class HCIRouter(object):
+
+    def __init__(self):
+        self._routes = {}               # key -> tuple of callbacks, replaced (not mutated) on change
+        self._subscriptions = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def subscribe(self, callback, packet_type=None, event=None, subevent=None, opcode=None, handle=None):
+        # callback(packet) gets a memoryview only valid during the call. Give one of: opcode (responses to
+        # that command), handle (ACL data and connection events of that handle), or packet_type / event /
+        # subevent (the most specific given is used). Returns the subscription, for unsubscribe().
+        key, interests = self._key(packet_type, event, subevent, opcode, handle)
+        subscription = HCISubscription(callback, key, interests)
+        with self._lock:
+            self._subscriptions.append(subscription)
+            self._rebuild()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.remove(subscription)
+            self._rebuild()
+
+    def interests(self):
+        # of all the subscriptions, see HCIFilter.update()
+        interests = []
+        for subscription in self._subscriptions:
+            interests.extend(subscription.interests)
+        return interests
+
+    @staticmethod
+    def _key(packet_type, event, subevent, opcode, handle):
+        if opcode is not None:
+            if packet_type is not None or event is not None or subevent is not None or handle is not None:
+                raise ValueError("opcode can't be combined with other criteria")
+            return ('opcode', opcode), ((HCI_EVENT_PKT, EVT_CMD_COMPLETE, opcode), (HCI_EVENT_PKT, EVT_CMD_STATUS, opcode))
+
+        if handle is not None:
+            if packet_type is not None or event is not None or subevent is not None:
+                raise ValueError("handle can't be combined with other criteria")
+            interests = [(HCI_ACLDATA_PKT,)]
+            interests.extend(sorted(set((HCI_EVENT_PKT, event) for event, _ in HANDLE_OFFSETS)))
+            return ('handle', handle), tuple(interests)
+
+        if subevent is not None:
+            if event not in (None, EVT_LE_META_EVENT) or packet_type not in (None, HCI_EVENT_PKT):
+                raise ValueError("subevent is only valid for LE Meta events")
+            return (HCI_EVENT_PKT, EVT_LE_META_EVENT, subevent), ((HCI_EVENT_PKT, EVT_LE_META_EVENT),)
+
+        if event is not None:
+            if packet_type not in (None, HCI_EVENT_PKT):
+                raise ValueError("event is only valid for event packets")
+            return (HCI_EVENT_PKT, event), ((HCI_EVENT_PKT, event),)
+
+        if packet_type is not None:
+            return (packet_type,), ((packet_type,),)
+
+        raise ValueError("No subscription criteria given")
+
+    def _rebuild(self):
+        # must hold the lock, the receive thread only ever sees a complete routing table
+        routes = {}
+        for subscription in self._subscriptions:
+            routes[subscription.key] = routes.get(subscription.key, ()) + (subscription.callback,)
+        self._routes = routes
+
+    def route(self, packet):
+        # Deliver one received packet to its subscribers, e.g. as a BluetoothHCI listener
+        routes = self._routes
+        if not routes:
+            return
+        packet_type = packet[0]
+
+        callbacks = routes.get((packet_type,))
+        if callbacks:
+            for callback in callbacks:
+                callback(packet)
+
+        if packet_type == HCI_EVENT_PKT:
+            event = packet[1]
+            callbacks = routes.get((packet_type, event))
+            if callbacks:
+                for callback in callbacks:
+                    callback(packet)
+
+            subevent = None
+            if event == EVT_LE_META_EVENT:
+                subevent = packet[3]
+                callbacks = routes.get((packet_type, event, subevent))
+                if callbacks:
+                    for callback in callbacks:
+                        callback(packet)
+            elif event == EVT_CMD_COMPLETE:
+                callbacks = routes.get(('opcode', packet[4] | (packet[5] << 8)))
+                if callbacks:
+                    for callback in callbacks:
+                        callback(packet)
+                return
+            elif event == EVT_CMD_STATUS:
+                callbacks = routes.get(('opcode', packet[5] | (packet[6] << 8)))
+                if callbacks:
+                    for callback in callbacks:
+                        callback(packet)
+                return
+
+            offset = HANDLE_OFFSETS.get((event, subevent))
+            if offset is not None:
+                callbacks = routes.get(('handle', (packet[offset] | (packet[offset + 1] << 8)) & 0x0fff))
+                if callbacks:
+                    for callback in callbacks:
+                        callback(packet)
+
+        elif packet_type == HCI_ACLDATA_PKT:
+            callbacks = routes.get(('handle', (packet[1] | (packet[2] << 8)) & 0x0fff))
+            if callbacks:
+                for callback in callbacks:
+                    callback(packet)
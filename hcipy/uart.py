@@ -0,0 +1,332 @@
+#!/usr/bin/python
+
+# H4 (UART) HCI transport.
+#
+# Talks directly to a controller attached to a serial port, bypassing the kernel's hci_uart
+# line discipline and the raw HCI socket. Packets are framed/reassembled in userspace from
+# large reads, so a single read() syscall can yield many HCI packets.
+#
+# See: Bluetooth Core Specification, Vol 4, Part A - UART Transport Layer
+
+import array
+import errno
+import fcntl
+import os
+import select
+import struct
+import termios
+import threading
+
+from .constants import *
+from .builders import RESET_PACKET
+from .hci import BluetoothHCIProvider, register_hci_provider
+
+
+# -------------------------------------------------
+# H4 framing
+
+# packet indicator -> (header length, offset of length field in header, length field struct)
+H4_PACKET_HEADERS = {
+    HCI_COMMAND_PKT: (3, 2, struct.Struct('<B')),   # opcode(2), plen(1)
+    HCI_ACLDATA_PKT: (4, 2, struct.Struct('<H')),   # handle(2), dlen(2)
+    HCI_SCODATA_PKT: (3, 2, struct.Struct('<B')),   # handle(2), dlen(1)
+    HCI_EVENT_PKT:   (2, 1, struct.Struct('<B')),   # evt(1), plen(1)
+    HCI_ISODATA_PKT: (4, 2, struct.Struct('<H')),   # handle(2), dlen(14 bits)
+}
+
+
+class H4Framer(object):
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.dropped_bytes = 0
+
+    def reset(self):
+        del self._buffer[:]
+
+    def feed(self, data):
+        # Append a chunk of the byte stream, return the list of complete packets (incl. the
+        # packet indicator) found so far; any trailing partial packet is kept for the next call.
+        buf = self._buffer
+        buf += data
+        buf_len = len(buf)
+        packets = []
+        offset = 0
+
+        while offset < buf_len:
+            header = H4_PACKET_HEADERS.get(buf[offset])
+            if header is None:
+                # out of sync (e.g. line noise or we opened mid-packet), skip a byte at a time
+                offset += 1
+                self.dropped_bytes += 1
+                continue
+
+            header_len, length_offset, length_struct = header
+            if offset + 1 + header_len > buf_len:
+                break
+
+            payload_len = length_struct.unpack_from(buf, offset + 1 + length_offset)[0]
+            if buf[offset] == HCI_ISODATA_PKT:
+                payload_len &= 0x3fff
+            packet_end = offset + 1 + header_len + payload_len
+            if packet_end > buf_len:
+                break
+
+            packets.append(buf[offset:packet_end])
+            offset = packet_end
+
+        if offset:
+            del buf[:offset]
+
+        return packets
+
+
+# -------------------------------------------------
+# Userspace equivalent of the kernel's HCI socket filter (net/bluetooth/hci_sock.c)
+
+class HCISoftwareFilter(object):
+
+    def __init__(self, data=None):
+        self.type_mask = 0
+        self.event_mask = 0
+        self.opcode = 0
+        self.enabled = False
+        if data is not None:
+            self.set(data)
+
+    def set(self, data):
+        type_mask, event_mask1, event_mask2, opcode = struct.unpack(HCIPY_HCI_FILTER_STRUCT, bytes(data))
+        self.type_mask = type_mask
+        self.event_mask = event_mask1 | (event_mask2 << 32)
+        self.opcode = opcode
+        self.enabled = True
+
+    def accept(self, packet):
+        if not self.enabled:
+            return True
+
+        packet_type = packet[0]
+        if not (self.type_mask >> (packet_type & 31)) & 1:
+            return False
+
+        if packet_type != HCI_EVENT_PKT:
+            return True
+
+        event = packet[1] & 63
+        if not (self.event_mask >> event) & 1:
+            return False
+
+        if not self.opcode:
+            return True
+
+        if event == EVT_CMD_COMPLETE:
+            return len(packet) >= 6 and self.opcode == packet[4] | (packet[5] << 8)
+        if event == EVT_CMD_STATUS:
+            return len(packet) >= 7 and self.opcode == packet[5] | (packet[6] << 8)
+        return True
+
+
+# -------------------------------------------------
+# UART HCI transport API
+
+class BluetoothHCIUARTProvider(BluetoothHCIProvider):
+
+    def __init__(self, device_id=0, port=None, baudrate=115200, flow_control=True, read_size=4096, poller=True):
+        super(BluetoothHCIUARTProvider, self).__init__(device_id)
+        if port is None:
+            raise ValueError("A serial port is required for the UART transport, e.g. port='/dev/ttyAMA0'")
+        self.port = port
+        self.baudrate = baudrate
+        self.flow_control = flow_control
+        self.read_size = read_size
+        self.poller = poller
+        self._fd = None
+        self._framer = H4Framer()
+        self._filter = HCISoftwareFilter()
+        self._uart_on_data_user_callback = None
+        self._uart_on_data_batch_user_callback = None
+        self._uart_poll_thread = None
+        self._poller_stop = None            # Event of the running poller, each poller has its own
+        self._previous_poller = None        # stopped from its own callback, the next one waits for it to end
+        self._wakeup = None                 # self-pipe (read end, write end), wakes the poller up to stop it
+        self._write_lock = threading.Lock()
+
+    def __del__(self):
+        wakeup = self._wakeup
+        if wakeup is not None:
+            os.close(wakeup[0])
+            os.close(wakeup[1])
+
+    def open(self):
+        if self._fd is not None:
+            return          # already open
+        self._fd = os.open(self.port, os.O_RDWR | os.O_NOCTTY)
+        self._configure_port()
+        self._framer.reset()
+
+        if not self.poller:
+            fcntl.fcntl(self._fd, fcntl.F_SETFL, fcntl.fcntl(self._fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            return
+
+        if self._wakeup is None:
+            self._wakeup = os.pipe()
+        self._poller_stop = threading.Event()
+        self._uart_poll_thread = threading.Thread(target=self._uart_poller, name='HCIUARTPoller',
+                                                  args=(self._fd, self._poller_stop, self._previous_poller))
+        self._previous_poller = None
+        self._uart_poll_thread.setDaemon(True)
+        self._uart_poll_thread.start()
+
+    def close(self):
+        # the poller is stopped (and joined) before the port is closed, so it never reads a closed fd
+        current = threading.current_thread()
+        thread = self._uart_poll_thread
+        if thread is not None:
+            self._poller_stop.set()
+            self._uart_poll_thread = None
+            if thread is current:
+                # from a callback: it ends once that returns, a poller started by open() waits for it
+                self._previous_poller = thread
+            else:
+                os.write(self._wakeup[1], b'\0')
+                thread.join()
+                os.read(self._wakeup[0], 64)
+        previous = self._previous_poller
+        if previous is not None and previous is not current:
+            previous.join()
+            self._previous_poller = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _configure_port(self):
+        try:
+            speed = getattr(termios, 'B{}'.format(self.baudrate))
+        except AttributeError:
+            raise ValueError("Unsupported baudrate: {}".format(self.baudrate))
+
+        iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(self._fd)
+
+        # raw 8N1, equivalent of cfmakeraw()
+        iflag &= ~(termios.IGNBRK | termios.BRKINT | termios.PARMRK | termios.ISTRIP |
+                   termios.INLCR | termios.IGNCR | termios.ICRNL | termios.IXON | termios.IXOFF)
+        oflag &= ~termios.OPOST
+        lflag &= ~(termios.ECHO | termios.ECHONL | termios.ICANON | termios.ISIG | termios.IEXTEN)
+        cflag &= ~(termios.CSIZE | termios.PARENB | termios.CSTOPB)
+        cflag |= termios.CS8 | termios.CREAD | termios.CLOCAL
+        if self.flow_control:
+            cflag |= termios.CRTSCTS
+        else:
+            cflag &= ~termios.CRTSCTS
+
+        # block until at least one byte is available, then return whatever has arrived
+        cc[termios.VMIN] = 1
+        cc[termios.VTIME] = 0
+
+        termios.tcsetattr(self._fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, speed, speed, cc])
+        termios.tcflush(self._fd, termios.TCIOFLUSH)
+
+    # ioctl-equivalents, there is no kernel device behind a UART so these are mapped onto HCI commands
+    # (or answered locally) where it makes sense: HCIGETDEVINFO, HCIDEVUP (a Reset) and HCIDEVDOWN (nothing
+    # to do). Filters are applied in software, see set_filter(). Anything else fails as an unknown ioctl
+    # would, with IOError(ENOTTY).
+
+    def send_cmd(self, cmd, data):
+        arr = array.array('B', data)
+        if cmd == HCIGETDEVINFO:
+            # Only the device id and name are known locally
+            name = os.path.basename(self.port).encode('ascii')[:7]
+            struct.pack_into('=H 8s', arr, 0, self.device_id, name)
+            return arr
+        self._unsupported(cmd)
+
+    def send_cmd_value(self, cmd, value):
+        if cmd == HCIDEVUP:
+            self.write_buffer(RESET_PACKET)
+        elif cmd == HCIDEVDOWN:
+            pass        # nothing to power down, the controller is owned by this process
+        else:
+            self._unsupported(cmd)
+
+    @staticmethod
+    def _unsupported(cmd):
+        raise IOError(errno.ENOTTY, "ioctl 0x{:x} is not supported by the UART transport".format(cmd & 0xffffffff))
+
+    def write_buffer(self, data):
+        view = memoryview(data)
+        with self._write_lock:
+            while len(view):
+                try:
+                    written = os.write(self._fd, view)
+                except (IOError, OSError) as e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+                    select.select([], [self._fd], [])       # non-blocking fd (poller=False), wait for room
+                    continue
+                view = view[written:]
+
+    def set_filter(self, data):
+        self._filter.set(data)
+
+    def _uart_poller(self, fd, stop, previous):
+        # Waits on both the port and the self-pipe, so close() wakes it up at once. fd and stop are this
+        # poller's own, a later one (reopened from a callback) has new ones and waits for this one to end.
+        if previous is not None:
+            previous.join()
+        wakeup = self._wakeup[0]
+        readable = [fd, wakeup]
+        while not stop.is_set():
+            try:
+                ready = select.select(readable, [], [])[0]
+                if wakeup in ready or stop.is_set():
+                    break
+                data = os.read(fd, self.read_size)      # returns as many bytes as are available
+            except OSError:
+                break
+            if not data:
+                break
+            self._dispatch(data)
+
+    def fileno(self):
+        return self._fd
+
+    def receive_queue(self):
+        # bytes in the tty input queue, not yet framed. Overruns aren't counted.
+        buf = array.array('i', [0])
+        try:
+            fcntl.ioctl(self._fd, termios.FIONREAD, buf)
+        except (IOError, OSError, TypeError):
+            return None, None
+        return buf[0], None
+
+    def read_ready(self):
+        try:
+            data = os.read(self._fd, self.read_size)
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+        return self._dispatch(data)
+
+    def _dispatch(self, data):
+        accept = self._filter.accept
+        batch = [packet for packet in self._framer.feed(data) if accept(packet)]
+        if batch:
+            batch_callback = self._uart_on_data_batch_user_callback
+            if batch_callback:
+                batch_callback([memoryview(packet) for packet in batch])
+
+            callback = self._uart_on_data_user_callback
+            if callback:
+                for packet in batch:
+                    callback(packet)
+        return len(batch)
+
+    def on_data(self, callback):
+        self._uart_on_data_user_callback = callback
+
+    def on_data_batch(self, callback):
+        self._uart_on_data_batch_user_callback = callback
+
+
+register_hci_provider('uart', BluetoothHCIUARTProvider)
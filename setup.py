@@ -21,13 +21,14 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=[],
+    python_requires='>=3.5',
     #tests_require=tests_require,
     #test_suite="setup.test_suite",
     platforms=['Raspberry Pi', 'Linux'],
     # https://pypi.python.org/pypi?%3Aaction=list_classifiers
     classifiers=['Development Status :: 2 - Pre-Alpha',
                  'Programming Language :: Python :: 3',
-                 'Programming Language :: Python :: 2',
+                 'Programming Language :: Python :: 3 :: Only',
                  'Environment :: Console',
                  'Intended Audience :: Developers',
                  'Operating System :: POSIX',
@@ -17,3 +17,8 @@ print(popen("hciconfig").read())
 
 hci.device_up()
 print(popen("hciconfig").read())
+
+# stop (joining the receive thread, failing pending commands) and start again on the same object
+print("Restarted in {:.1f}ms".format(hci.restart() * 1000))
+
+hci.stop()
@@ -9,10 +9,25 @@ from codecs import decode
 class BluetoothLEAdvertisementTest():
 
     def __init__(self, device_id=0):
+        # command builders, precompiled and reused for every command sent
+        self.advertise_enable = LESetAdvertiseEnableCommand()
+        self.advertising_parameters = LESetAdvertisingParametersCommand()
+        self.advertising_data = LESetAdvertisingDataCommand()
+        self.scan_response_data = LESetScanResponseDataCommand()
         self.hci = BluetoothHCI(device_id, auto_start=False)
         self.hci.on_data(self.on_data)
         print(self.hci.get_device_info())
 
+        # served to every central that connects
+        self.acl = ACLManager(self.hci)
+        self.database = GATTDatabase()
+        self.database.add_service(0x1800)                   # Generic Access
+        self.database.add_characteristic(0x2a00, GATT_CHR_PROP_READ, b'hcipy')
+        self.database.add_service(0x180f)                   # Battery
+        self.battery_level = self.database.add_characteristic(0x2a19, GATT_CHR_PROP_READ | GATT_CHR_PROP_NOTIFY,
+                                                              b'\x64')
+        self.gatt = GATTServer(self.acl, self.database)
+
     def __del__(self):
         self.hci.on_data(None)
         self.hci.stop()
@@ -21,10 +36,11 @@ class BluetoothLEAdvertisementTest():
         self.hci.start()
         self.hci.device_down()
         self.hci.device_up()
+        self.acl.read_buffer_size()
 
     def set_filter(self):
         typeMask   = 1 << HCI_EVENT_PKT | (1 << HCI_ACLDATA_PKT)
-        eventMask1 = 1 << EVT_DISCONN_COMPLETE | (1 << EVT_CMD_COMPLETE) | (1 << EVT_CMD_STATUS)
+        eventMask1 = 1 << EVT_DISCONN_COMPLETE | (1 << EVT_CMD_COMPLETE) | (1 << EVT_CMD_STATUS) | (1 << EVT_NUM_COMP_PKTS)
         eventMask2 = 1 << (EVT_LE_META_EVENT - 32)
         opcode     = 0
 
@@ -32,56 +48,19 @@ class BluetoothLEAdvertisementTest():
         self.hci.set_filter(filter)
 
     def set_advertise_enable(self, enabled):
-        cmd = struct.pack("<BHBB",
-                          HCI_COMMAND_PKT,
-                          LE_SET_ADVERTISE_ENABLE_CMD,
-                          1,            # cmd parameters length
-                          0x01 if enabled else 0x00
-                          )
-        self.hci.write(cmd)
+        self.hci.write(self.advertise_enable.build(enabled))
 
 
     def set_advertising_parameter(self):
-        cmd = struct.pack("<BHB" + "H H 3B 6B B B",
-                          HCI_COMMAND_PKT,
-                          LE_SET_ADVERTISING_PARAMETERS_CMD,
-                          15,           # cmd parameters length
-                          0x00a0,       # min interval
-                          0x00a0,       # max interval
-                          0,            # adv type
-                          0,            # direct addr type
-                          0,            # direct addr type
-                          0,0,0,0,0,0,  # direct addr
-                          0x07,
-                          0x00
-                          )
+        cmd = self.advertising_parameters.build(min_interval=0x00a0, max_interval=0x00a0,
+                                                advertising_type=ADV_IND, channel_map=0x07)
         self.hci.write(cmd)
 
-    def set_scan_response_data(self, data):
-        padded_data = memoryview(data).tolist()
-        padded_data.extend([0] * (31 - len(padded_data)))
-
-        cmd = struct.pack("<BHB" + "B31B",
-                          HCI_COMMAND_PKT,
-                          LE_SET_SCAN_RESPONSE_DATA_CMD,
-                          32,           # cmd parameters length
-                          len(data),
-                          *padded_data
-                          )
-        self.hci.write(cmd)
+    def set_scan_response_data(self, data=b''):
+        self.hci.write(self.scan_response_data.build(data))
 
-    def set_advertising_data(self, data):
-        padded_data = memoryview(data).tolist()
-        padded_data.extend([0] * (31 - len(padded_data)))
-
-        cmd = struct.pack("<BHB" + "B31B",
-                          HCI_COMMAND_PKT,
-                          LE_SET_ADVERTISING_DATA_CMD,
-                          32,           # cmd parameters length
-                          len(data),
-                          *padded_data
-                          )
-        self.hci.write(cmd)
+    def set_advertising_data(self, data=b''):
+        self.hci.write(self.advertising_data.build(data))
 
     def on_data(self, data):
         print("on_data")
@@ -110,7 +89,7 @@ class BluetoothLEAdvertisementTest():
                     reason = data[6]
                 )
                 print(disconn_info)
-                exit(0)
+                self.set_advertise_enable(True)
             elif data[1] == EVT_LE_META_EVENT:
                 print("EVT_LE_META_EVENT")
                 if data[3] == EVT_LE_CONN_COMPLETE:
@@ -139,6 +118,9 @@ class BluetoothLEAdvertisementTest():
                         supervisionTimeout = (data[12]<<8) + data[11],
                     )
                     print(conn_update_info)
+        elif data[0] == HCI_ACLDATA_PKT:
+            # ATT requests are answered by the GATT server
+            print("HCI_ACLDATA_PKT")
 
 
 if __name__ == "__main__":
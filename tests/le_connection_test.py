@@ -1,7 +1,6 @@
 #!/usr/bin/python
 
 from signal import pause
-from codecs import decode
 from pprint import pformat
 from hcipy import *
 
@@ -12,6 +11,18 @@ class BluetoothLEConnectionTest:
     def __init__(self, dev_id=0):
         self.hci = BluetoothHCI(dev_id, auto_start=False)
         self.hci.on_data(self.on_data)
+        # queues the connect requests through the controller's single initiator, with a timeout each
+        self.connections = ConnectionManager(self.hci, timeout=10.0,
+                                             scan_interval=0x0060,
+                                             scan_window=0x0030,
+                                             min_interval=0x0028,
+                                             max_interval=0x0038,
+                                             latency=0x0000,
+                                             supervision_timeout=0x002a)
+        self.acl = ACLManager(self.hci)
+        self.acl.on_frame(self.on_acl_frame)
+        # ATT requests and the discovered services, cached per device across reconnects
+        self.gatt = GATTClientManager(self.acl)
 
     def __del__(self):
         self.hci.stop()
@@ -22,7 +33,8 @@ class BluetoothLEConnectionTest:
                              (1 << HCI_EVENT_PKT) | (1 << HCI_ACLDATA_PKT),     # Type Mask
                              (1 << EVT_DISCONN_COMPLETE)
                              | (1 << EVT_CMD_COMPLETE)
-                             | (1 << EVT_CMD_STATUS),                           # eventMask1
+                             | (1 << EVT_CMD_STATUS)
+                             | (1 << EVT_NUM_COMP_PKTS),                        # eventMask1
                              1 << (EVT_LE_META_EVENT - 32),                     # eventMask2
                              0                                                  # opcode
                              )
@@ -31,51 +43,39 @@ class BluetoothLEConnectionTest:
 
 
     def create_connection(self, addr, addr_type):
-        bd_addr = list(reversed(bytearray.fromhex(addr.replace(':', ' '))))     # TODO: make a common utility function
-        print('bd_addr={}'.format([hex(b) for b in bd_addr]))                   # TODO: make a common utility function
-
-        cmd = struct.pack(HCIPY_HCI_CMD_STRUCT_HEADER + "HHB B 6B B 6H",
-                          HCI_COMMAND_PKT,
-                          LE_CREATE_CONN_CMD,
-                          0x19,         # cmd parameters length
-                          0x0060,       # interval
-                          0x0030,       # window
-                          0x00,         # initiator filter
-                          addr_type,    # peer address type
-                          bd_addr[0], bd_addr[1], bd_addr[2], bd_addr[3], bd_addr[4], bd_addr[5],
-                          0x0000,       # own address type
-                          0x0028,       # min interval
-                          0x0038,       # max interval
-                          0x0000,       # latency
-                          0x002a,       # supervision timeout
-                          0x0000,       # min ce length
-                          0x0000,       # max ce length
-                          )
-        self.hci.write(cmd)
-
-
-    def write_handle(self, handle, data):
-        data_len = len(data)
-        cmd = struct.pack("B 4H {}B".format(data_len),
-                          HCI_ACLDATA_PKT,
-                          handle,
-                          data_len + 4,
-                          data_len,
-                          ATT_CID,
-                          *data
-                          )
-        self.hci.write(cmd)
+        future = self.connections.connect(addr, addr_type)
+        future.add_done_callback(self.on_connect_done)
+        return future
+
+    def on_connect_done(self, future):
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            print("Connection failed: {}".format(future.exception()))
+        else:
+            print("Connected: {}".format(future.result()))
+
+
+    def discover(self, handle, address):
+        client = self.gatt.client(handle, address)
+        client.exchange_mtu(256)
+        future = client.discover()
+        future.add_done_callback(lambda future: self.on_discover_done(handle, future))
+        return future
+
+    def on_discover_done(self, handle, future):
+        if future.exception() is not None:
+            print("Discovery failed: {}".format(future.exception()))
+        else:
+            for service in future.result():
+                print(service)
+                for characteristic in service.characteristics:
+                    print('\t{}'.format(characteristic))
+        self.disconnect_connection(handle, HCI_OE_USER_ENDED_CONNECTION)
 
 
     def disconnect_connection(self, handle, reason):
-        cmd = struct.pack(HCIPY_HCI_CMD_STRUCT_HEADER + "HB",
-                          HCI_COMMAND_PKT,
-                          DISCONNECT_CMD,
-                          3,             # length
-                          handle,
-                          reason
-                          )
-        self.hci.write(cmd)
+        return self.connections.disconnect(handle, reason)
 
     def on_data(self, data):
         print("------------------------------------------")
@@ -178,7 +178,7 @@ class BluetoothLEConnectionTest:
                     # } __attribute__ ((packed)) evt_le_connection_complete;
                     # #define EVT_LE_CONN_COMPLETE_SIZE 18
 
-                    s = struct.Struct('=B B BB B H B B 6B HHH B')
+                    s = struct.Struct('=B B BB B H B B 6s HHH B')
                     fields = s.unpack(data)
                     evt_le_connection_complete = dict(
                         #packet_indicator=fields[0],
@@ -189,11 +189,11 @@ class BluetoothLEConnectionTest:
                         handle      = fields[5],
                         role        = fields[6],
                         peer_bdaddr_type = fields[7],
-                        peer_bdaddr = fields[8:14],
-                        interval    = fields[14] * 1.25,
-                        latency     = fields[15],
-                        supervision_timeout = fields[16] * 10,
-                        master_clock_accuracy = fields[17],
+                        peer_bdaddr = BDAddress.from_bytes(fields[8], fields[7]),
+                        interval    = fields[9] * 1.25,
+                        latency     = fields[10],
+                        supervision_timeout = fields[11] * 10,
+                        master_clock_accuracy = fields[12],
                     )
 
                     print("evt_le_connection_complete = {}".format(pformat(evt_le_connection_complete)))
@@ -226,7 +226,9 @@ class BluetoothLEConnectionTest:
 
                     print("evt_le_connection_update_complete = {}".format(pformat(evt_le_connection_update_complete)))
 
-                    self.write_handle(evt_le_connection_update_complete['handle'], decode('020001', 'hex'))
+                    connection = self.connections.connections.get(evt_le_connection_update_complete['handle'])
+                    self.discover(evt_le_connection_update_complete['handle'],
+                                  connection.address if connection is not None else None)
 
         elif HCI_ACLDATA_PKT == packet_indicator:
             print("HCI_ACLDATA_PKT")
@@ -237,28 +239,20 @@ class BluetoothLEConnectionTest:
             # } __attribute__ ((packed))	hci_acl_hdr;
             # #define HCI_ACL_HDR_SIZE	4
 
-            # TODO: decode this in a cleaner way...
-            if data[1] >> 12 == ACL_START and (data[8] << 8 + data[7]) == ATT_CID:
-                # s = struct.Struct('=B ...')
-                # fields = s.unpack(data)
-                # evt_ = dict(
-                #     _=fields[1],
-                #
-                # )
+            # fragments are reassembled by the ACL layer, see on_acl_frame()
 
-                handle = data[1] & 0x0fff
-                payload = data[9:-1]
 
-                print('ACL data');
-                print('\t{}'.format(handle))
-                print('\t{}'.format(payload))
-
-                self.disconnect_connection(handle, HCI_OE_USER_ENDED_CONNECTION)
+    def on_acl_frame(self, handle, cid, payload):
+        if cid == ATT_CID:
+            print('ACL data')
+            print('\t{}'.format(handle))
+            print('\t{}'.format(bytearray(payload)))
 
 
     def run(self):
         self.set_filter()
         self.hci.start()
+        self.acl.read_buffer_size()
 
         self.create_connection('B8:27:EB:12:E9:E4', LE_PUBLIC_ADDRESS)  # eenie
         #self.create_connection('ED:8A:7E:36:33:61', LE_RANDOM_ADDRESS)  # BBC micro:bit [vovot]
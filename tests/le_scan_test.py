@@ -7,14 +7,30 @@ from hcipy import *
 
 class BluetoothLEScanTest:
 
-    def __init__(self, dev_id=0):
+    def __init__(self, dev_id=0, deduplicator=None, extended=False):
+        # deduplicator: an optional AdvertisingDeduplicator, an alternative to the controller's duplicate filtering
+        # extended: use Bluetooth 5 extended scanning, on the 1M and Coded PHYs
+        self.extended = extended
+        self.found_bd_addrs = set()
+        self.reports = AdvertisingReportBatch()
+        self.deduplicator = deduplicator
+        self.scan_parameters = LESetScanParametersCommand()
+        self.scan_enable = LESetScanEnableCommand()
         self.hci = BluetoothHCI(dev_id)
-        self.hci.on_data(self.on_data)
+        if extended:
+            self.scan_parameters = LESetExtendedScanParametersCommand()
+            self.scan_enable = LESetExtendedScanEnableCommand()
+            self.reassembler = ExtendedAdvertisingReassembler(self.on_extended_advertising_report)
+            self.hci.subscribe(self.on_scan_parameters_set, opcode=LE_SET_EXTENDED_SCAN_PARAMETERS_CMD)
+            self.hci.subscribe(self.on_scan_enable_set, opcode=LE_SET_EXTENDED_SCAN_ENABLE_CMD)
+            self.hci.subscribe(self.reassembler.add_event, subevent=EVT_LE_EXTENDED_ADVERTISING_REPORT)
+        else:
+            self.hci.subscribe(self.on_scan_parameters_set, opcode=LE_SET_SCAN_PARAMETERS_CMD)
+            self.hci.subscribe(self.on_scan_enable_set, opcode=LE_SET_SCAN_ENABLE_CMD)
+            self.hci.subscribe(self.on_advertising_report, subevent=EVT_LE_ADVERTISING_REPORT)
         print(self.hci.get_device_info())
-        self.found_bd_addrs = set()
 
     def __del__(self):
-        self.hci.on_data(None)
         self.hci.stop()
 
 
@@ -28,60 +44,68 @@ class BluetoothLEScanTest:
         self.hci.set_filter(filter)
 
     def set_scan_parameters(self):
-        len = 7
-        type = SCAN_TYPE_ACTIVE
-        internal = 0x0010   #  ms * 1.6
-        window = 0x0010     #  ms * 1.6
-        own_addr  = LE_PUBLIC_ADDRESS
-        filter = FILTER_POLICY_NO_WHITELIST
-        cmd = struct.pack("<BHBBHHBB", HCI_COMMAND_PKT, LE_SET_SCAN_PARAMETERS_CMD, len,
-                          type, internal, window, own_addr, filter )
-
+        if self.extended:
+            self.hci.write(self.scan_parameters.build(scan_type=SCAN_TYPE_ACTIVE, interval=0x0010, window=0x0010,
+                                                      phys=LE_SCAN_PHY_1M | LE_SCAN_PHY_CODED))
+            return
+        cmd = self.scan_parameters.build(scan_type=SCAN_TYPE_ACTIVE,
+                                         interval=0x0010,   #  ms * 1.6
+                                         window=0x0010,     #  ms * 1.6
+                                         own_address_type=LE_PUBLIC_ADDRESS,
+                                         filter_policy=FILTER_POLICY_NO_WHITELIST)
         self.hci.write(cmd)
 
 
     def set_scan_enable(self, enabled=False, duplicates=False):
-        len = 2
-        enable = 0x01 if enabled else 0x00
-        dups   = 0x01 if duplicates else 0x00
-        cmd = struct.pack("<BHBBB", HCI_COMMAND_PKT, LE_SET_SCAN_ENABLE_CMD, len, enable, dups)
-        self.hci.write(cmd)
-
-
-    def on_data(self, data):
-        if data[0] == HCI_EVENT_PKT:
-            print("HCI_EVENT_PKT")
-            if data[1] == EVT_CMD_COMPLETE:
-                print("EVT_CMD_COMPLETE")
-                # TODO: unpack based on: https://git.kernel.org/pub/scm/bluetooth/bluez.git/tree/lib/hci.h#n1853
-
-                if (data[5]<<8) + data[4] == LE_SET_SCAN_PARAMETERS_CMD:
-                    if data[6] == HCI_SUCCESS:
-                        print('LE Scan Parameters Set');
-
-                elif data[5]<<8 + data[4] ==  LE_SET_SCAN_ENABLE_CMD:
-                    if data[6] == HCI_SUCCESS:
-                        print('LE Scan Enable Set')
-
-            elif data[1] == EVT_LE_META_EVENT:
-                print("EVT_LE_META_EVENT")
-                if data[3] == EVT_LE_ADVERTISING_REPORT:
-
-                    # TODO: unpack based on: https://git.kernel.org/pub/scm/bluetooth/bluez.git/tree/lib/hci.h#n2167
-
-                    gap_adv_type =['ADV_IND', 'ADV_DIRECT_IND', 'ADV_SCAN_IND', 'ADV_NONCONN_IND', 'SCAN_RSP'][data[5]]
-                    gap_addr_type = ['PUBLIC', 'RANDOM'][data[6]]
-                    gap_addr =  [hex(c) for c in data[12:6:-1]]
-
-                    gap_addr_str =  ':'.join([hex(c) for c in data[12:6:-1]])
-                    self.found_bd_addrs.add(gap_addr_str)
-                    eir = [chr(c) for c in data[14:-2]]
-                    rssi = data[-1]
-
-                    print('LE Advertising Report')
-                    print('\tAdv Type  = {}'.format(gap_adv_type))
-                    print('\tAddr Type = {}'.format(gap_addr_type))
-                    print('\tAddr      = {}'.format(gap_addr_str))
-                    print('\tEIR       = {}'.format(eir))
-                    print('\tRSSI      = {}'.format(rssi))
-
+        self.hci.write(self.scan_enable.build(enabled, duplicates))
+
+
+    def on_scan_parameters_set(self, data):
+        if data[1] == EVT_CMD_COMPLETE and data[6] == HCI_SUCCESS:
+            print('LE Scan Parameters Set')
+
+    def on_scan_enable_set(self, data):
+        if data[1] == EVT_CMD_COMPLETE and data[6] == HCI_SUCCESS:
+            print('LE Scan Enable Set')
+
+    def on_advertising_report(self, data):
+        reports = self.reports
+        reports.clear()
+        reports.add_event(data)
+
+        indexes = range(len(reports))
+        if self.deduplicator:
+            indexes = self.deduplicator.filter_batch(reports)
+
+        for i in indexes:
+            gap_adv_type = ['ADV_IND', 'ADV_DIRECT_IND', 'ADV_SCAN_IND', 'ADV_NONCONN_IND', 'SCAN_RSP'][reports.event_types[i]]
+            gap_addr_type = ['PUBLIC', 'RANDOM'][reports.address_types[i]]
+            address = reports.bd_address(i)
+            self.found_bd_addrs.add(address)
+            ad = reports.ad(i)
+            rssi = reports.rssi[i]
+
+            print('LE Advertising Report')
+            print('\tAdv Type  = {}'.format(gap_adv_type))
+            print('\tAddr Type = {}'.format(gap_addr_type))
+            print('\tAddr      = {}'.format(address))
+            print('\tName      = {}'.format(ad.local_name))
+            print('\tFlags     = {}'.format(ad.flags))
+            print('\tServices  = {}'.format(ad.service_uuids))
+            print('\tMfr data  = {}'.format(ad.manufacturer_data))
+            print('\tTX power  = {}'.format(ad.tx_power))
+            print('\tRSSI      = {}'.format(rssi))
+
+    def on_extended_advertising_report(self, report):
+        address = report.bd_address
+        self.found_bd_addrs.add(address)
+        ad = report.ad
+
+        print('LE Extended Advertising Report')
+        print('\tEvent Type = 0x{:04x}'.format(report.event_type))
+        print('\tAddr       = {}'.format(address))
+        print('\tPHY        = {}/{}'.format(report.primary_phy, report.secondary_phy))
+        print('\tData       = {} bytes{}'.format(len(report.data),
+                                              ' (truncated)' if report.data_status == EXT_ADV_DATA_TRUNCATED else ''))
+        print('\tName       = {}'.format(ad.local_name))
+        print('\tRSSI       = {}'.format(report.rssi))
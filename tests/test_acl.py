@@ -0,0 +1,99 @@
+import struct
+import unittest
+
+from hcipy import *
+
+
+class FakeHCI(object):
+
+    def __init__(self):
+        self.written = []
+        self.listeners = []
+
+    def add_listener(self, callback, interests=None):
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self.listeners.remove(callback)
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+    def receive(self, packet):
+        for listener in self.listeners:
+            listener(memoryview(packet))
+
+
+def acl_packet(handle, flags, data):
+    return struct.pack('<BHH', HCI_ACLDATA_PKT, acl_handle_pack(handle, flags), len(data)) + data
+
+
+def num_comp_pkts(*pairs):
+    params = bytearray([len(pairs)])
+    for handle, count in pairs:
+        params += struct.pack('<HH', handle, count)
+    return struct.pack('<BBB', HCI_EVENT_PKT, EVT_NUM_COMP_PKTS, len(params)) + bytes(params)
+
+
+class TestACLManager(unittest.TestCase):
+
+    def setUp(self):
+        self.hci = FakeHCI()
+        self.acl = ACLManager(self.hci)
+        self.acl.set_buffer_size(8, 2)
+
+    def test_fragmentation_and_credits(self):
+        self.acl.set_buffer_size(8, 0)
+        self.acl.send(0x40, b'0123456789')          # 14 bytes incl. L2CAP header -> 2 fragments
+        self.acl.send(0x41, b'abc')                 # 7 bytes -> 1 fragment
+        self.assertEqual(self.hci.written, [])
+
+        # two credits, sent round-robin between the handles
+        self.acl.set_buffer_size(8, 2)
+        self.assertEqual(self.hci.written, [
+            acl_packet(0x40, ACL_START_NO_FLUSH, struct.pack('<HH', 10, ATT_CID) + b'0123'),
+            acl_packet(0x41, ACL_START_NO_FLUSH, struct.pack('<HH', 3, ATT_CID) + b'abc'),
+        ])
+        self.assertEqual(self.acl.credits, 0)
+
+        self.hci.receive(num_comp_pkts((0x40, 1), (0x41, 1)))
+        self.assertEqual(self.hci.written[2], acl_packet(0x40, ACL_CONT, b'456789'))
+        self.assertEqual(self.acl.credits, 1)
+        self.assertEqual(self.acl.pending(), 0)
+
+    def test_disconnect_returns_credits(self):
+        self.acl.send(0x40, b'0123456789' * 3)
+        self.assertEqual(self.acl.credits, 0)
+        self.hci.receive(struct.pack('<BBBBHB', HCI_EVENT_PKT, EVT_DISCONN_COMPLETE, 4, 0, 0x40, HCI_OE_USER_ENDED_CONNECTION))
+        self.assertEqual(self.acl.credits, 2)
+        self.assertEqual(self.acl.pending(), 0)
+
+    def test_reassembly(self):
+        frames = []
+        self.acl.on_frame(lambda handle, cid, payload: frames.append((handle, cid, bytes(payload))))
+
+        self.hci.receive(acl_packet(0x40, ACL_START, struct.pack('<HH', 6, ATT_CID) + b'\x0b\x01'))
+        self.hci.receive(acl_packet(0x41, ACL_START, struct.pack('<HH', 1, ATT_CID) + b'\x02'))
+        self.hci.receive(acl_packet(0x40, ACL_CONT, b'\x02\x03'))
+        self.hci.receive(acl_packet(0x40, ACL_CONT, b'\x04\x05'))
+
+        self.assertEqual(frames, [(0x41, ATT_CID, b'\x02'), (0x40, ATT_CID, b'\x0b\x01\x02\x03\x04\x05')])
+
+    def test_continuation_without_start_is_dropped(self):
+        self.hci.receive(acl_packet(0x40, ACL_CONT, b'\x00\x01'))
+        self.assertEqual(self.acl.dropped_fragments, 1)
+
+    def test_truncated_packets_are_dropped(self):
+        frames = []
+        self.acl.on_frame(lambda handle, cid, payload: frames.append(bytes(payload)))
+        self.hci.receive(acl_packet(0x40, ACL_START, struct.pack('<HH', 4, ATT_CID) + b'\x0b\x01')[:-1])
+        self.hci.receive(acl_packet(0x40, ACL_START, b'\x04')[:-1])
+        self.hci.receive(struct.pack('<BH', HCI_ACLDATA_PKT, 0x40))
+        self.hci.receive(acl_packet(0x40, ACL_START, struct.pack('<HH', 4, ATT_CID) + b'\x0b\x01'))
+        self.hci.receive(acl_packet(0x40, ACL_CONT, b'\x02\x03')[:-1])
+        self.assertEqual(self.acl.dropped_fragments, 4)
+        self.assertEqual(frames, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+from hcipy import *
+
+
+class TestBDAddress(unittest.TestCase):
+
+    def test_formatting_is_canonical_and_cached(self):
+        address = BDAddress(0xf53ac9b015f6, LE_RANDOM_ADDRESS)
+        self.assertIsNone(address._text)
+        self.assertEqual(str(address), 'F5:3A:C9:B0:15:F6')
+        self.assertIs(str(address), str(address))
+        self.assertEqual(str(BDAddress(0x010203040506)), '01:02:03:04:05:06')
+        self.assertEqual(repr(address), "BDAddress('F5:3A:C9:B0:15:F6', random)")
+
+    def test_bytes_round_trip(self):
+        data = b'\x00\xf6\x15\xb0\xc9\x3a\xf5'
+        address = BDAddress.from_bytes(data, LE_RANDOM_ADDRESS, offset=1)
+        self.assertEqual(address.value, 0xf53ac9b015f6)
+        self.assertEqual(address.to_bytes(), data[1:])
+        self.assertEqual(int(address), 0xf53ac9b015f6)
+
+    def test_parse(self):
+        expected = BDAddress(0xf53ac9b015f6, LE_RANDOM_ADDRESS)
+        for text in ('F5:3A:C9:B0:15:F6', 'f5-3a-c9-b0-15-f6', '0xf5:0x3a:0xc9:0xb0:0x15:0xf6'):
+            self.assertEqual(BDAddress.parse(text, LE_RANDOM_ADDRESS), expected)
+        self.assertRaises(ValueError, BDAddress.parse, 'F5:3A:C9:B0:15')
+        self.assertRaises(ValueError, BDAddress.parse, 'F5:3A:C9:B0:15:F6F')
+
+    def test_equality_includes_type(self):
+        public = BDAddress(0x112233445566)
+        random = BDAddress(0x112233445566, LE_RANDOM_ADDRESS)
+        self.assertNotEqual(public, random)
+        self.assertEqual(len({public, random, BDAddress(0x112233445566)}), 2)
+        self.assertNotEqual(public, 0x112233445566)
+
+    def test_random_type(self):
+        self.assertEqual(BDAddress(0xf53ac9b015f6, LE_RANDOM_ADDRESS).random_type, RANDOM_ADDRESS_STATIC)
+        self.assertEqual(BDAddress(0x4a3ac9b015f6, LE_RANDOM_ADDRESS).random_type, RANDOM_ADDRESS_RESOLVABLE)
+        self.assertIsNone(BDAddress(0xf53ac9b015f6).random_type)
+
+    def test_from_reports(self):
+        batch = AdvertisingReportBatch()
+        batch.add_event(bytearray([HCI_EVENT_PKT, EVT_LE_META_EVENT, 12, EVT_LE_ADVERTISING_REPORT, 1,
+                                   ADV_IND, LE_RANDOM_ADDRESS, 0xf6, 0x15, 0xb0, 0xc9, 0x3a, 0xf5, 0, 0xc0]))
+        self.assertEqual(batch.bd_address(0), BDAddress.parse('F5:3A:C9:B0:15:F6', LE_RANDOM_ADDRESS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+import uuid
+
+from hcipy import *
+
+
+EDDYSTONE_UUID = 0xfeaa
+NORDIC_UART_UUID = uuid.UUID('6e400001-b5a3-f393-e0a9-e50e24dcca9e')
+
+AD = bytes(bytearray(
+    [0x02, AD_TYPE_FLAGS, 0x06] +
+    [0x05, AD_TYPE_COMPLETE_16BIT_UUIDS, 0xaa, 0xfe, 0x0f, 0x18] +
+    [0x06, AD_TYPE_SERVICE_DATA_16BIT, 0xaa, 0xfe, 0x10, 0xeb, 0x03] +
+    [0x05, AD_TYPE_SHORT_LOCAL_NAME] + list(b'hcip') +
+    [0x02, AD_TYPE_TX_POWER_LEVEL, 0xf4] +
+    [0x05, AD_TYPE_MANUFACTURER_DATA, 0x4c, 0x00, 0x02, 0x15]))
+
+
+class TestAdvertisingData(unittest.TestCase):
+
+    def test_index_is_lazy(self):
+        ad = AdvertisingData(AD)
+        self.assertIsNone(ad._index)
+        self.assertEqual(ad.flags, 0x06)
+        self.assertEqual(sorted(ad.types()), sorted([AD_TYPE_FLAGS, AD_TYPE_COMPLETE_16BIT_UUIDS, AD_TYPE_SERVICE_DATA_16BIT,
+                                                     AD_TYPE_SHORT_LOCAL_NAME, AD_TYPE_TX_POWER_LEVEL,
+                                                     AD_TYPE_MANUFACTURER_DATA]))
+
+    def test_fields(self):
+        ad = AdvertisingData(AD)
+        self.assertEqual(ad.local_name, 'hcip')
+        self.assertEqual(ad.tx_power, -12)
+        self.assertEqual(ad.service_uuids, [0xfeaa, 0x180f])
+        self.assertEqual(ad.manufacturer_id, 0x004c)
+        company, data = ad.manufacturer_data
+        self.assertEqual((company, bytes(data)), (0x004c, b'\x02\x15'))
+        self.assertEqual(bytes(ad.service_data(EDDYSTONE_UUID)), b'\x10\xeb\x03')
+        self.assertIsNone(ad.service_data(0x180f))
+        self.assertIsNone(ad.appearance)
+        self.assertIn(AD_TYPE_FLAGS, ad)
+
+    def test_values_are_views(self):
+        buffer = bytearray(AD)
+        ad = AdvertisingData(buffer)
+        self.assertIsInstance(ad.get(AD_TYPE_MANUFACTURER_DATA), memoryview)
+        buffer[-1] = 0x16
+        self.assertEqual(bytes(ad.manufacturer_data[1]), b'\x02\x16')
+
+    def test_has_service_uuid(self):
+        ad = AdvertisingData(AD)
+        self.assertTrue(ad.has_service_uuid(EDDYSTONE_UUID))
+        self.assertTrue(ad.has_service_uuid(0x180f))
+        self.assertFalse(ad.has_service_uuid(0x180a))
+        self.assertFalse(ad.has_service_uuid(NORDIC_UART_UUID))
+
+        # only in the service data
+        ad = AdvertisingData(b'\x05\x16\x0a\x18\x01\x02')
+        self.assertTrue(ad.has_service_uuid(0x180a))
+
+    def test_128bit_uuids(self):
+        data = bytearray([17, AD_TYPE_COMPLETE_128BIT_UUIDS]) + bytearray(NORDIC_UART_UUID.bytes[::-1])
+        ad = AdvertisingData(data)
+        self.assertEqual(ad.service_uuids, [NORDIC_UART_UUID])
+        self.assertTrue(ad.has_service_uuid(NORDIC_UART_UUID))
+        self.assertFalse(ad.has_service_uuid(uuid.UUID(int=1)))
+
+    def test_malformed_data_keeps_complete_structures(self):
+        # a structure running past the end, then zero padding
+        ad = AdvertisingData(b'\x02\x01\x06\x09\x09abc')
+        self.assertEqual(ad.flags, 0x06)
+        self.assertIsNone(ad.local_name)
+        ad = AdvertisingData(b'\x02\x01\x06\x00\x00\x00')
+        self.assertEqual(ad.types(), [AD_TYPE_FLAGS])
+        self.assertEqual(AdvertisingData(b'').types(), [])
+
+    def test_complete_name_preferred(self):
+        ad = AdvertisingData(b'\x03\x08ab\x05\x09abcd')
+        self.assertEqual(ad.local_name, 'abcd')
+
+    def test_report_accessors(self):
+        address = [0xf6, 0x15, 0xb0, 0xc9, 0x3a, 0xf5]
+        packet = bytearray([HCI_EVENT_PKT, EVT_LE_META_EVENT, 0, EVT_LE_ADVERTISING_REPORT, 1, ADV_IND,
+                            LE_RANDOM_ADDRESS] + address + [len(AD)]) + AD + bytearray([0xc4])
+        packet[2] = len(packet) - 3
+
+        report = decode_event(packet).reports[0]
+        self.assertEqual(report.ad.local_name, 'hcip')
+
+        reports = AdvertisingReportBatch()
+        reports.add_event(packet)
+        self.assertEqual(reports.ad(0).manufacturer_id, 0x004c)
+        reports.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import concurrent.futures
+import struct
+import time
+import unittest
+import uuid
+
+from hcipy import *
+
+
+class FakeHCI(object):
+    # resolves every command immediately, unless told to fail
+    def __init__(self):
+        self.packets = []
+        self.fail = False
+
+    def send_command_packet(self, packet, timeout=None):
+        self.packets.append(bytes(packet))
+        future = concurrent.futures.Future()
+        if self.fail:
+            future.set_exception(IOError("failed"))
+        else:
+            future.set_result(None)
+        return future
+
+    def opcodes(self):
+        opcodes = [struct.unpack_from('<H', packet, 1)[0] for packet in self.packets]
+        del self.packets[:]
+        return opcodes
+
+
+class TestPayloads(unittest.TestCase):
+
+    def test_eddystone_url(self):
+        self.assertEqual(eddystone_url_encode('https://www.thebubbleworks.com/'), b'\x01thebubbleworks\x00')
+        self.assertEqual(eddystone_url_encode('http://a.b.org'), b'\x02a.b\x08')
+        self.assertRaises(ValueError, eddystone_url_encode, 'ftp://example.com')
+        self.assertRaises(ValueError, eddystone_url_encode, 'https://www.averyveryverylongname.com/')
+
+        data = eddystone_url_adv_data('https://www.thebubbleworks.com/')
+        self.assertIs(data, eddystone_url_adv_data('https://www.thebubbleworks.com/'))
+        ad = AdvertisingData(data)
+        self.assertEqual(ad.flags, 0x1a)
+        self.assertTrue(ad.has_service_uuid(EDDYSTONE_UUID))
+        self.assertEqual(bytes(ad.service_data(EDDYSTONE_UUID)), b'\x10\xed\x01thebubbleworks\x00')
+
+    def test_ibeacon(self):
+        proximity_uuid = uuid.UUID('b9407f30-f5f8-466e-aff9-25556b57fe6d')
+        data = ibeacon_adv_data(proximity_uuid, major=1, minor=2, tx_power=-74)
+        self.assertEqual(data, bytes(bytearray.fromhex('0201061aff4c000215b9407f30f5f8466eaff925556b57fe6d00010002b6')))
+
+
+class TestAdvertisingScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.hci = FakeHCI()
+        self.scheduler = AdvertisingScheduler(self.hci, rate=100)
+
+    def test_only_changed_commands_are_sent(self):
+        first = self.scheduler.add(eddystone_url_adv_data('https://www.thebubbleworks.com/'))
+        self.scheduler.add(eddystone_url_adv_data('https://github.com/'))
+        self.scheduler.step()
+        self.assertEqual(self.hci.opcodes(), [LE_SET_ADVERTISING_PARAMETERS_CMD, LE_SET_ADVERTISING_DATA_CMD,
+                                              LE_SET_SCAN_RESPONSE_DATA_CMD, LE_SET_ADVERTISE_ENABLE_CMD])
+        # same parameters and scan response: just the data, advertising stays enabled
+        self.scheduler.step()
+        self.assertEqual(self.hci.opcodes(), [LE_SET_ADVERTISING_DATA_CMD])
+        self.scheduler.step()
+        self.assertEqual(self.hci.opcodes(), [LE_SET_ADVERTISING_DATA_CMD])
+
+        # a single slot needs nothing at all
+        self.scheduler.remove(first)
+        self.scheduler.step()
+        self.scheduler.step()
+        self.assertEqual(self.hci.opcodes(), [LE_SET_ADVERTISING_DATA_CMD])
+        self.assertEqual(self.scheduler.commands_skipped, 3 + 3 + 3 + 4)
+
+    def test_parameter_change_restarts_advertising(self):
+        self.scheduler.add(b'\x02\x01\x06', min_interval=0x00a0, max_interval=0x00a0)
+        self.scheduler.add(b'\x02\x01\x06', min_interval=0x0100, max_interval=0x0100)
+        self.scheduler.step()
+        self.hci.opcodes()
+        self.scheduler.step()
+        self.assertEqual(self.hci.opcodes(), [LE_SET_ADVERTISE_ENABLE_CMD, LE_SET_ADVERTISING_PARAMETERS_CMD,
+                                              LE_SET_ADVERTISE_ENABLE_CMD])
+        self.assertEqual(self.hci.packets, [])
+
+    def test_failure_resends_everything(self):
+        self.scheduler.add(b'\x02\x01\x06')
+        self.hci.fail = True
+        self.assertFalse(self.scheduler._finish(self.scheduler.step(), 0))
+        self.hci.opcodes()
+        self.hci.fail = False
+        self.assertTrue(self.scheduler._finish(self.scheduler.step(), 0))
+        self.assertEqual(self.hci.opcodes(), [LE_SET_ADVERTISE_ENABLE_CMD, LE_SET_ADVERTISING_PARAMETERS_CMD,
+                                              LE_SET_ADVERTISING_DATA_CMD, LE_SET_SCAN_RESPONSE_DATA_CMD,
+                                              LE_SET_ADVERTISE_ENABLE_CMD])
+        self.assertEqual(self.scheduler.errors, 1)
+
+    def test_rotation_rate(self):
+        self.scheduler.add(b'\x02\x01\x06')
+        self.scheduler.add(b'\x02\x01\x04')
+        self.scheduler.start()
+        time.sleep(0.2)
+        self.scheduler.stop()
+        stats = self.scheduler.stats()
+        self.assertEqual(stats['requested_rate'], 100)
+        self.assertGreater(stats['completed'], 5)
+        self.assertGreater(stats['achieved_rate'], 25)
+        self.assertLessEqual(stats['achieved_rate'], 110)
+        # stop() disables advertising
+        self.assertEqual(self.hci.packets[-1], bytes(LESetAdvertiseEnableCommand().build(False)))
+
+    def test_data_size_is_checked(self):
+        self.assertRaises(ValueError, self.scheduler.add, b'\0' * 32)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import asyncio
+import socket
+import struct
+import unittest
+
+from hcipy import *
+
+
+class TestAsyncBluetoothHCI(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.controller, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.controller.setblocking(False)
+        self.hci = AsyncBluetoothHCI(sock=host)
+        await self.hci.start()
+
+    async def asyncTearDown(self):
+        self.hci.stop()
+        self.controller.close()
+
+    async def test_send_command(self):
+        loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(self.hci.send_command(LE_SET_SCAN_ENABLE_CMD, b'\x01\x00'))
+
+        cmd = await loop.sock_recv(self.controller, 64)
+        self.assertEqual(cmd, struct.pack('<BHBBB', HCI_COMMAND_PKT, LE_SET_SCAN_ENABLE_CMD, 2, 1, 0))
+
+        response = struct.pack('<BBBBHB', HCI_EVENT_PKT, EVT_CMD_COMPLETE, 4, 1, LE_SET_SCAN_ENABLE_CMD, HCI_SUCCESS)
+        await loop.sock_sendall(self.controller, response)
+        self.assertEqual(await task, bytearray(response))
+
+    async def test_command_timeout(self):
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.hci.send_command(LE_SET_SCAN_ENABLE_CMD, b'\x00\x00', timeout=0.05)
+
+    async def test_async_iteration(self):
+        events = self.hci.__aiter__()
+        packets = [struct.pack('<BBBB', HCI_EVENT_PKT, LE_META_EVENT, 1, n) for n in range(5)]
+        for packet in packets:
+            self.controller.send(packet)
+
+        received = []
+        async for data in events:
+            received.append(bytes(data))
+            if len(received) == len(packets):
+                self.hci.stop()
+        self.assertEqual(received, packets)
+
+    async def test_peer_close_is_connection_lost(self):
+        future = asyncio.ensure_future(self.hci.send_command(LE_SET_SCAN_ENABLE_CMD, b'\x00\x00', timeout=5))
+        await asyncio.sleep(0)
+        self.controller.close()
+        with self.assertRaises(ConnectionError):
+            await future
+        self.assertTrue(self.hci.transport.is_closing())
+
+
+if __name__ == '__main__':
+    unittest.main()
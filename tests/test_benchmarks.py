@@ -0,0 +1,29 @@
+import unittest
+
+from benchmarks import bench_hci
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_scenarios_run(self):
+        # keeps the benchmark suite runnable, not a performance check
+        results = bench_hci.run_benchmarks(count=300, repeat=1)
+        self.assertEqual(sorted(results['results']), sorted(scenario.name for scenario in bench_hci.SCENARIOS))
+        for result in results['results'].values():
+            self.assertGreater(result['packets_per_sec'], 0)
+
+        lines, regressions = bench_hci.compare(results, results)
+        self.assertEqual(len(lines), len(bench_hci.SCENARIOS))
+        self.assertEqual(regressions, [])
+
+    def test_compare_detects_regression(self):
+        baseline = {'format': bench_hci.BENCHMARK_FORMAT,
+                    'results': {'adv_flood': {'packets_per_sec': 1000.0, 'cpu_us_per_packet': 10.0}}}
+        current = {'format': bench_hci.BENCHMARK_FORMAT,
+                   'results': {'adv_flood': {'packets_per_sec': 800.0, 'cpu_us_per_packet': 10.0}}}
+        self.assertEqual(bench_hci.compare(baseline, current)[1], ['adv_flood'])
+        self.assertEqual(bench_hci.compare(baseline, current, threshold=0.25)[1], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
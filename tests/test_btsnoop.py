@@ -0,0 +1,85 @@
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+from hcipy import *
+
+
+class TestBTSnoop(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'capture.btsnoop')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_write_and_read(self):
+        with BTSnoopWriter(self.path) as writer:
+            writer.write_packet(b'\x01\x0c\x20\x02\x01\x00', False, timestamp=1000000)
+            writer.write_packet(b'\x04\x0e\x04\x01\x0c\x20\x00', True, timestamp=1500000)
+            writer.write_packet(b'\x02\x40\x20\x01\x00\x00', True, timestamp=2000000)
+
+        with BTSnoopReader(self.path) as reader:
+            records = [(record.timestamp, record.flags, bytes(record.data)) for record in reader]
+            self.assertEqual(records, [
+                (1000000, BTSNOOP_FLAG_COMMAND_EVENT, b'\x01\x0c\x20\x02\x01\x00'),
+                (1500000, BTSNOOP_FLAG_COMMAND_EVENT | BTSNOOP_FLAG_RECEIVED, b'\x04\x0e\x04\x01\x0c\x20\x00'),
+                (2000000, BTSNOOP_FLAG_RECEIVED, b'\x02\x40\x20\x01\x00\x00'),
+            ])
+
+            received = []
+            start = time.time()
+            self.assertEqual(reader.replay(received.append, speed=10.0), 2)
+            self.assertGreaterEqual(time.time() - start, 0.04)
+            self.assertEqual(received, [bytearray(b'\x04\x0e\x04\x01\x0c\x20\x00'), bytearray(b'\x02\x40\x20\x01\x00\x00')])
+
+            received = []
+            reader.replay(received.append, speed=None, received_only=False)
+            self.assertEqual(len(received), 3)
+
+    def test_close_with_records_in_use(self):
+        with BTSnoopWriter(self.path) as writer:
+            writer.write_packet(b'\x04\x0e\x00', True)
+        reader = BTSnoopReader(self.path)
+        record = next(iter(reader))
+        self.assertRaises(BufferError, reader.close)
+        record.data.release()
+        reader.close()
+
+    def test_bounded_buffer_drops(self):
+        writer = BTSnoopWriter(self.path, flush_interval=60, max_buffer_size=40)
+        writer.write_packet(b'\x04\x0e\x00', True)
+        writer.write_packet(b'\x04\x0e\x00', True)
+        self.assertEqual(writer.dropped, 1)
+        writer.close()
+
+    def test_capture_hci_traffic(self):
+        controller, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        hci = BluetoothHCI(provider=BluetoothHCISocketProvider(sock=host))
+        writer = BTSnoopWriter(self.path)
+        hci.capture(writer)
+        done = threading.Event()
+        hci.on_data(lambda data: done.set())
+
+        command = struct.pack('<BHBBB', HCI_COMMAND_PKT, LE_SET_SCAN_ENABLE_CMD, 2, 0, 0)
+        event = struct.pack('<BBBBHB', HCI_EVENT_PKT, EVT_CMD_COMPLETE, 4, 1, LE_SET_SCAN_ENABLE_CMD, 0)
+        hci.write(command)
+        controller.send(event)
+        self.assertTrue(done.wait(2))
+        hci.stop()
+        controller.close()
+        writer.close()
+
+        with BTSnoopReader(self.path) as reader:
+            self.assertEqual([(record.received, bytes(record.data)) for record in reader],
+                             [(False, command), (True, event)])
+
+
+if __name__ == '__main__':
+    unittest.main()
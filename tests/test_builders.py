@@ -0,0 +1,64 @@
+import struct
+import unittest
+
+from hcipy import *
+
+
+class TestCommandBuilders(unittest.TestCase):
+
+    def test_scan_commands(self):
+        self.assertEqual(bytes(LESetScanParametersCommand().build()),
+                         struct.pack("<BHBBHHBB", HCI_COMMAND_PKT, LE_SET_SCAN_PARAMETERS_CMD, 7,
+                                     SCAN_TYPE_ACTIVE, 0x0010, 0x0010, LE_PUBLIC_ADDRESS, FILTER_POLICY_NO_WHITELIST))
+        scan_enable = LESetScanEnableCommand()
+        self.assertEqual(scan_enable.build(True, filter_duplicates=True),
+                         struct.pack("<BHBBB", HCI_COMMAND_PKT, LE_SET_SCAN_ENABLE_CMD, 2, 1, 1))
+        self.assertEqual(scan_enable.build(False),
+                         struct.pack("<BHBBB", HCI_COMMAND_PKT, LE_SET_SCAN_ENABLE_CMD, 2, 0, 0))
+
+    def test_advertising_data_is_padded_and_buffer_reused(self):
+        builder = LESetAdvertisingDataCommand()
+        first = builder.build(b'\x02\x01\x06' + b'x' * 28)
+        self.assertEqual(len(first), 36)
+
+        packet = builder.build(b'\x02\x01\x06')
+        self.assertEqual(bytes(packet), struct.pack("<BHBB31s", HCI_COMMAND_PKT, LE_SET_ADVERTISING_DATA_CMD,
+                                                    32, 3, b'\x02\x01\x06'))
+        self.assertEqual(packet.obj, builder.buffer)
+        self.assertRaises(ValueError, builder.build, b'x' * 32)
+
+        self.assertEqual(bytes(LESetScanResponseDataCommand().build(b'\x01'))[:5],
+                         struct.pack("<BHBB", HCI_COMMAND_PKT, LE_SET_SCAN_RESPONSE_DATA_CMD, 32, 1))
+
+    def test_advertising_parameters_and_enable(self):
+        self.assertEqual(bytes(LESetAdvertisingParametersCommand().build()),
+                         struct.pack("<BHB" + "H H 3B 6B B B", HCI_COMMAND_PKT, LE_SET_ADVERTISING_PARAMETERS_CMD, 15,
+                                     0x00a0, 0x00a0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0x07, 0x00))
+        self.assertEqual(LESetAdvertiseEnableCommand().build(True),
+                         struct.pack("<BHBB", HCI_COMMAND_PKT, LE_SET_ADVERTISE_ENABLE_CMD, 1, 1))
+
+    def test_connection_commands(self):
+        expected = struct.pack(HCIPY_HCI_CMD_STRUCT_HEADER + "HHB B 6B B 6H", HCI_COMMAND_PKT, LE_CREATE_CONN_CMD, 0x19,
+                               0x0060, 0x0030, 0x00, LE_RANDOM_ADDRESS, 0x66, 0x55, 0x44, 0x33, 0x22, 0x11,
+                               0x00, 0x0028, 0x0038, 0x0000, 0x002a, 0x0000, 0x0000)
+        builder = LECreateConnectionCommand()
+        self.assertEqual(bytes(builder.build('11:22:33:44:55:66', LE_RANDOM_ADDRESS)), expected)
+        self.assertEqual(bytes(builder.build(0x112233445566, LE_RANDOM_ADDRESS)), expected)
+        self.assertEqual(bytes(builder.build(b'\x66\x55\x44\x33\x22\x11', LE_RANDOM_ADDRESS)), expected)
+
+        self.assertEqual(bytes(LEConnectionUpdateCommand().build(0x40, 0x0018, 0x0028, latency=4)),
+                         struct.pack(HCIPY_HCI_CMD_STRUCT_HEADER + "7H", HCI_COMMAND_PKT, LE_CONN_UPDATE_CMD, 14,
+                                     0x40, 0x0018, 0x0028, 4, 0x002a, 0, 0))
+        self.assertEqual(LE_CREATE_CONNECTION_CANCEL_PACKET,
+                         struct.pack("<BHB", HCI_COMMAND_PKT, LE_CREATE_CONN_CANCEL_CMD, 0))
+
+        self.assertEqual(bytes(DisconnectCommand().build(0x40)),
+                         struct.pack(HCIPY_HCI_CMD_STRUCT_HEADER + "HB", HCI_COMMAND_PKT, DISCONNECT_CMD, 3,
+                                     0x40, HCI_OE_USER_ENDED_CONNECTION))
+
+    def test_prebuilt(self):
+        self.assertEqual(RESET_PACKET, struct.pack("<BHB", HCI_COMMAND_PKT, RESET_CMD, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
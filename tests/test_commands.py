@@ -0,0 +1,90 @@
+import concurrent.futures
+import socket
+import struct
+import threading
+import unittest
+
+from hcipy import *
+
+
+def cmd_complete(opcode, ncmd=1, status=HCI_SUCCESS):
+    return bytearray(struct.pack('<BBBBHB', HCI_EVENT_PKT, EVT_CMD_COMPLETE, 4, ncmd, opcode, status))
+
+
+def cmd_status(opcode, ncmd=1, status=HCI_SUCCESS):
+    return bytearray(struct.pack('<BBBBBH', HCI_EVENT_PKT, EVT_CMD_STATUS, 4, status, ncmd, opcode))
+
+
+class TestHCICommandQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.written = []
+        self.commands = HCICommandQueue(self.written.append)
+
+    def tearDown(self):
+        self.commands.close()
+
+    def opcodes_written(self):
+        return [struct.unpack_from('<H', packet, 1)[0] for packet in self.written]
+
+    def test_credit_flow_control(self):
+        first = self.commands.submit(LE_SET_SCAN_ENABLE_CMD, b'\x00\x00')
+        second = self.commands.submit(LE_SET_SCAN_PARAMETERS_CMD, b'\x01\x10\x00\x10\x00\x00\x00')
+        third = self.commands.submit(LE_SET_SCAN_ENABLE_CMD, b'\x01\x00')
+        self.assertEqual(self.opcodes_written(), [LE_SET_SCAN_ENABLE_CMD])
+
+        # the controller now allows two outstanding commands
+        self.commands.on_event(cmd_complete(LE_SET_SCAN_ENABLE_CMD, ncmd=2))
+        self.assertEqual(first.result(0).opcode, LE_SET_SCAN_ENABLE_CMD)
+        self.assertEqual(self.opcodes_written(), [LE_SET_SCAN_ENABLE_CMD, LE_SET_SCAN_PARAMETERS_CMD, LE_SET_SCAN_ENABLE_CMD])
+
+        self.commands.on_event(cmd_complete(LE_SET_SCAN_PARAMETERS_CMD, ncmd=1))
+        self.commands.on_event(cmd_complete(LE_SET_SCAN_ENABLE_CMD, ncmd=1))
+        self.assertEqual(second.result(0).status, HCI_SUCCESS)
+        self.assertEqual(bytes(third.result(0).return_parameters), b'\x00')
+        self.assertEqual(len(self.commands), 0)
+
+    def test_failure_status(self):
+        future = self.commands.submit(LE_CREATE_CONN_CMD, b'')
+        self.commands.on_event(cmd_status(LE_CREATE_CONN_CMD, status=0x0c))
+        with self.assertRaises(HCICommandError) as cm:
+            future.result(0)
+        self.assertEqual(cm.exception.status, 0x0c)
+
+    def test_timeout_returns_credit(self):
+        first = self.commands.submit(LE_SET_SCAN_ENABLE_CMD, b'\x00\x00', timeout=0.05)
+        second = self.commands.submit(LE_SET_SCAN_ENABLE_CMD, b'\x01\x00', timeout=1.0)
+        with self.assertRaises(concurrent.futures.TimeoutError):
+            first.result(1.0)
+        self.commands.on_event(cmd_complete(0x0000))
+        self.assertEqual(len(self.written), 2)
+        self.assertFalse(second.done())
+
+    def test_flush(self):
+        future = self.commands.submit(LE_SET_SCAN_ENABLE_CMD, b'\x00\x00')
+        self.commands.flush()
+        self.assertRaises(IOError, future.result, 0)
+
+
+class TestBluetoothHCISendCommand(unittest.TestCase):
+
+    def test_send_command(self):
+        controller, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        hci = BluetoothHCI(provider=BluetoothHCISocketProvider(sock=host))
+        received = []
+        done = threading.Event()
+        hci.on_data(lambda data: (received.append(data), done.set()))
+        try:
+            future = hci.send_command(LE_SET_SCAN_ENABLE_CMD, b'\x01\x00')
+            self.assertEqual(controller.recv(64), struct.pack('<BHBBB', HCI_COMMAND_PKT, LE_SET_SCAN_ENABLE_CMD, 2, 1, 0))
+            controller.send(bytes(cmd_complete(LE_SET_SCAN_ENABLE_CMD)))
+            self.assertEqual(future.result(2).opcode, LE_SET_SCAN_ENABLE_CMD)
+            self.assertTrue(done.wait(2))
+            self.assertEqual(received, [cmd_complete(LE_SET_SCAN_ENABLE_CMD)])
+        finally:
+            hci.stop()
+            controller.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
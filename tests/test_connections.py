@@ -0,0 +1,165 @@
+import concurrent.futures
+import socket
+import struct
+import threading
+import unittest
+
+from hcipy import *
+
+
+def event_packet(event, params):
+    return struct.pack('<BBB', HCI_EVENT_PKT, event, len(params)) + params
+
+
+def cmd_status(opcode, status=HCI_SUCCESS):
+    return event_packet(EVT_CMD_STATUS, struct.pack('<BBH', status, 1, opcode))
+
+
+def cmd_complete(opcode, status=HCI_SUCCESS):
+    return event_packet(EVT_CMD_COMPLETE, struct.pack('<BHB', 1, opcode, status))
+
+
+def conn_complete(status, handle, address=b'\0' * 6, address_type=LE_PUBLIC_ADDRESS, role=LE_ROLE_MASTER):
+    return event_packet(EVT_LE_META_EVENT, struct.pack('<BBHBB6sHHHB', EVT_LE_CONN_COMPLETE, status, handle, role,
+                                                       address_type, address, 0x0028, 0, 0x002a, 0))
+
+
+class StandInController(object):
+    # Answers the connection commands like a controller would, connecting to the addresses in reachable
+    # (address bytes -> handle) and leaving the others pending until cancelled.
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reachable = {}
+        self.commands = []
+        self._initiating = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    def join(self):
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            packet = self.sock.recv(1024)
+            if not packet or packet[0] != HCI_COMMAND_PKT:
+                return
+            opcode = struct.unpack_from('<H', packet, 1)[0]
+            self.commands.append(opcode)
+            if opcode == LE_CREATE_CONN_CMD:
+                if self._initiating is not None:
+                    self.sock.send(cmd_status(opcode, HCI_COMMAND_DISALLOWED))
+                    continue
+                address_type, address = packet[9], packet[10:16]
+                self.sock.send(cmd_status(opcode))
+                if address in self.reachable:
+                    self.sock.send(conn_complete(HCI_SUCCESS, self.reachable[address], address, address_type))
+                else:
+                    self._initiating = address
+            elif opcode == LE_CREATE_CONN_CANCEL_CMD:
+                if self._initiating is None:
+                    self.sock.send(cmd_complete(opcode, HCI_COMMAND_DISALLOWED))
+                else:
+                    self._initiating = None
+                    self.sock.send(cmd_complete(opcode))
+                    self.sock.send(conn_complete(HCI_UNKNOWN_CONNECTION_ID, 0))
+            elif opcode == DISCONNECT_CMD:
+                handle, reason = struct.unpack_from('<HB', packet, 4)
+                self.sock.send(cmd_status(opcode))
+                self.sock.send(event_packet(EVT_DISCONN_COMPLETE, struct.pack('<BHB', HCI_SUCCESS, handle,
+                                                                              HCI_CONNECTION_TERMINATED)))
+            elif opcode == LE_CONN_UPDATE_CMD:
+                handle, min_interval, _, latency, supervision_timeout = struct.unpack_from('<HHHHH', packet, 4)
+                self.sock.send(cmd_status(opcode))
+                self.sock.send(event_packet(EVT_LE_META_EVENT, struct.pack('<BBHHHH', EVT_LE_CONN_UPDATE_COMPLETE,
+                                                                           HCI_SUCCESS, handle, min_interval,
+                                                                           latency, supervision_timeout)))
+
+
+class TestConnectionManager(unittest.TestCase):
+
+    def setUp(self):
+        controller, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.controller_socket = controller
+        self.controller = StandInController(controller)
+        self.hci = BluetoothHCI(provider=BluetoothHCISocketProvider(sock=host))
+        self.manager = ConnectionManager(self.hci, timeout=0.2)
+
+    def tearDown(self):
+        self.manager.close()
+        self.hci.stop()
+        self.controller.join()
+        self.controller_socket.close()
+
+    def test_requests_are_serialised_through_the_initiator(self):
+        addresses = ['11:22:33:44:55:{:02X}'.format(n) for n in range(5)]
+        for n, address in enumerate(addresses):
+            self.controller.reachable[BDAddress.parse(address).to_bytes()] = 0x40 + n
+        connected = []
+        self.manager.on_connection(connected.append)
+
+        futures = [self.manager.connect(address, LE_RANDOM_ADDRESS) for address in addresses]
+        connections = [future.result(2) for future in futures]
+        self.assertEqual([connection.handle for connection in connections], [0x40, 0x41, 0x42, 0x43, 0x44])
+        self.assertEqual(connections[2].address, BDAddress.parse(addresses[2], LE_RANDOM_ADDRESS))
+        self.assertEqual(connections[0].role, LE_ROLE_MASTER)
+        self.assertEqual(connected, connections)
+        self.assertEqual(len(self.manager), 5)
+        self.assertIs(self.manager[0x41], connections[1])
+        self.assertIs(self.manager.find(connections[3].address), connections[3])
+        # never more than one create in progress
+        self.assertNotIn(LE_CREATE_CONN_CANCEL_CMD, self.controller.commands)
+        self.assertEqual(self.manager.connected, 5)
+
+    def test_timeout_cancels_and_moves_on(self):
+        self.controller.reachable[BDAddress.parse('11:22:33:44:55:66').to_bytes()] = 0x40
+        unreachable = self.manager.connect('AA:BB:CC:DD:EE:FF', timeout=0.1)
+        reachable = self.manager.connect('11:22:33:44:55:66')
+        with self.assertRaises(concurrent.futures.TimeoutError):
+            unreachable.result(2)
+        self.assertEqual(reachable.result(2).handle, 0x40)
+        self.assertEqual(self.controller.commands, [LE_CREATE_CONN_CMD, LE_CREATE_CONN_CANCEL_CMD, LE_CREATE_CONN_CMD])
+        self.assertEqual((self.manager.timed_out, self.manager.connected, self.manager.pending()), (1, 1, 0))
+
+    def test_cancel(self):
+        attempt = self.manager.connect('AA:BB:CC:DD:EE:FF', timeout=10)
+        queued = self.manager.connect('AA:BB:CC:DD:EE:00', timeout=10)
+        self.assertTrue(queued.cancel())
+        self.assertTrue(attempt.cancel())
+        self.assertTrue(concurrent.futures.wait([self.manager.connect(b'\x01' * 6, timeout=0.05)], 2).done)
+        # the queued request was never attempted
+        self.assertEqual(self.controller.commands, [LE_CREATE_CONN_CMD, LE_CREATE_CONN_CANCEL_CMD, LE_CREATE_CONN_CMD,
+                                                    LE_CREATE_CONN_CANCEL_CMD])
+
+    def test_update_and_disconnect(self):
+        self.controller.reachable[b'\x01' * 6] = 0x40
+        connection = self.manager.connect(b'\x01' * 6).result(2)
+        connected_at = connection.connected_at
+        self.assertIs(self.manager.update_parameters(0x40, 0x0018, 0x0018, latency=4,
+                                                     supervision_timeout=0x0100).result(2), connection)
+        self.assertEqual((connection.interval, connection.latency, connection.supervision_timeout), (0x0018, 4, 0x0100))
+        self.assertGreaterEqual(connection.updated_at, connected_at)
+
+        disconnected = []
+        self.manager.on_disconnection(lambda connection, reason: disconnected.append(connection.handle))
+        self.assertEqual(self.manager.disconnect(0x40).result(2), HCI_CONNECTION_TERMINATED)
+        self.assertEqual(disconnected, [0x40])
+        self.assertEqual(len(self.manager), 0)
+        self.assertRaises(KeyError, self.manager.disconnect, 0x40)
+
+    def test_incoming_connections_are_tracked(self):
+        self.controller_socket.send(conn_complete(HCI_SUCCESS, 0x41, b'\x02' * 6, role=LE_ROLE_SLAVE))
+        attempt = self.manager.connect(b'\x03' * 6, timeout=0.1)
+        self.assertRaises(concurrent.futures.TimeoutError, attempt.result, 2)
+        self.assertEqual(self.manager[0x41].role, LE_ROLE_SLAVE)
+
+    def test_command_failure(self):
+        self.controller._initiating = b'busy'       # e.g. another host is using the initiator
+        with self.assertRaises(HCICommandError) as cm:
+            self.manager.connect(b'\x01' * 6).result(2)
+        self.assertEqual(cm.exception.status, HCI_COMMAND_DISALLOWED)
+        self.assertEqual(self.manager.failed, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
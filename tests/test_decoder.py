@@ -0,0 +1,90 @@
+import struct
+import unittest
+
+from hcipy import *
+
+
+def event_packet(evt, params):
+    return bytearray(struct.pack('<BBB', HCI_EVENT_PKT, evt, len(params)) + params)
+
+
+class TestDecoder(unittest.TestCase):
+
+    def test_cmd_complete(self):
+        event = decode_event(event_packet(EVT_CMD_COMPLETE, struct.pack('<BHB', 1, LE_SET_SCAN_ENABLE_CMD, HCI_SUCCESS)))
+        self.assertIsInstance(event, CommandComplete)
+        self.assertEqual((event.ncmd, event.opcode, event.status), (1, LE_SET_SCAN_ENABLE_CMD, HCI_SUCCESS))
+        self.assertEqual(bytes(event.return_parameters), b'\x00')
+
+    def test_cmd_status(self):
+        event = decode_event(event_packet(EVT_CMD_STATUS, struct.pack('<BBH', 0x0c, 1, LE_CREATE_CONN_CMD)))
+        self.assertEqual((event.status, event.ncmd, event.opcode), (0x0c, 1, LE_CREATE_CONN_CMD))
+
+    def test_disconn_complete(self):
+        event = decode_event(event_packet(EVT_DISCONN_COMPLETE, struct.pack('<BHB', 0, 0x40, HCI_OE_USER_ENDED_CONNECTION)))
+        self.assertEqual((event.status, event.handle, event.reason), (0, 0x40, HCI_OE_USER_ENDED_CONNECTION))
+
+    def test_le_conn_complete(self):
+        params = struct.pack('<BBHBB6sHHHB', EVT_LE_CONN_COMPLETE, 0, 0x41, 0, LE_RANDOM_ADDRESS,
+                             b'\x43\x7b\x30\x8e\x58\xf4', 0x28, 0, 0x2a, 1)
+        event = decode_event(event_packet(EVT_LE_META_EVENT, params))
+        self.assertIsInstance(event, LEConnectionComplete)
+        self.assertEqual(event.handle, 0x41)
+        self.assertEqual(event.peer_address, 0xf4588e307b43)
+        self.assertEqual((event.interval, event.supervision_timeout), (0x28, 0x2a))
+
+    def test_le_advertising_report_with_several_reports(self):
+        params = bytearray([EVT_LE_ADVERTISING_REPORT, 2])
+        params += struct.pack('<BB6sB', ADV_IND, LE_RANDOM_ADDRESS, b'\x06\x05\x04\x03\x02\x01', 3) + b'\x02\x01\x06' + struct.pack('<b', -60)
+        params += struct.pack('<BB6sB', ADV_SCAN_RSP, LE_PUBLIC_ADDRESS, b'\x0b\x0a\x09\x08\x07\x06', 0) + struct.pack('<b', -90)
+        event = decode_event(event_packet(EVT_LE_META_EVENT, params))
+        self.assertEqual(len(event.reports), 2)
+        first, second = event.reports
+        self.assertEqual((first.event_type, first.address, bytes(first.data), first.rssi),
+                         (ADV_IND, 0x010203040506, b'\x02\x01\x06', -60))
+        self.assertEqual((second.event_type, second.address, bytes(second.data), second.rssi),
+                         (ADV_SCAN_RSP, 0x060708090a0b, b'', -90))
+
+    def test_unknown(self):
+        self.assertIsNone(decode_event(event_packet(0x08, b'\x00\x40\x00\x01')))
+        self.assertIsNone(decode_event(bytearray([HCI_ACLDATA_PKT, 0, 0, 0, 0])))
+
+    def test_slots(self):
+        event = decode_event(event_packet(EVT_CMD_STATUS, struct.pack('<BBH', 0, 1, LE_CREATE_CONN_CMD)))
+        self.assertFalse(hasattr(event, '__dict__'))
+
+
+class TestAdvertisingReportBatch(unittest.TestCase):
+
+    def adv_report_event(self, reports):
+        params = bytearray([EVT_LE_ADVERTISING_REPORT, len(reports)])
+        for event_type, address, data, rssi in reports:
+            params += struct.pack('<BBQ', event_type, LE_RANDOM_ADDRESS, address)[:8] + bytearray([len(data)]) + data
+            params += struct.pack('<b', rssi)
+        return event_packet(EVT_LE_META_EVENT, params)
+
+    def test_columns(self):
+        batch = AdvertisingReportBatch()
+        count = batch.add_events([
+            self.adv_report_event([(ADV_IND, 0xf4588e307b43, b'\x02\x01\x06', -50),
+                                   (ADV_SCAN_RSP, 0xf4588e307b43, b'\x03\x09ab', -51)]),
+            event_packet(EVT_CMD_STATUS, struct.pack('<BBH', 0, 1, LE_CREATE_CONN_CMD)),
+            self.adv_report_event([(ADV_NONCONN_IND, 0x010203040506, b'', 127)]),
+        ])
+
+        self.assertEqual(count, 3)
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(list(batch.event_types), [ADV_IND, ADV_SCAN_RSP, ADV_NONCONN_IND])
+        self.assertEqual(list(batch.address_types), [LE_RANDOM_ADDRESS] * 3)
+        self.assertEqual(list(batch.addresses), [0xf4588e307b43, 0xf4588e307b43, 0x010203040506])
+        self.assertEqual(list(batch.rssi), [-50, -51, 127])
+        self.assertEqual([batch.data(i) for i in range(3)], [b'\x02\x01\x06', b'\x03\x09ab', b''])
+        self.assertEqual(list(batch.data_offsets), [0, 3, 7])
+
+        batch.clear()
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(len(batch.buffer), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+from hcipy import *
+
+
+class TestAdvertisingDeduplicator(unittest.TestCase):
+
+    def test_repeats_suppressed_until_refresh(self):
+        dedup = AdvertisingDeduplicator(refresh_interval=1.0, ttl=10.0)
+        self.assertTrue(dedup.accept(1, LE_RANDOM_ADDRESS, b'\x02\x01\x06', now=0.0))
+        self.assertFalse(dedup.accept(1, LE_RANDOM_ADDRESS, b'\x02\x01\x06', now=0.5))
+        self.assertTrue(dedup.accept(1, LE_RANDOM_ADDRESS, b'\x02\x01\x06', now=1.0))
+        self.assertEqual((dedup.passed, dedup.suppressed), (2, 1))
+
+    def test_payload_change_passes(self):
+        dedup = AdvertisingDeduplicator()
+        self.assertTrue(dedup.accept(1, LE_RANDOM_ADDRESS, b'\x01', now=0.0))
+        self.assertTrue(dedup.accept(1, LE_RANDOM_ADDRESS, b'\x02', now=0.1))
+        self.assertTrue(dedup.accept(1, LE_PUBLIC_ADDRESS, b'\x02', now=0.1))
+
+    def test_bounded_and_expiring(self):
+        dedup = AdvertisingDeduplicator(ttl=5.0, max_entries=3)
+        for address in range(5):
+            dedup.accept(address, LE_RANDOM_ADDRESS, b'', now=0.0)
+        self.assertEqual(len(dedup), 3)
+        self.assertEqual(dedup.evicted, 2)
+
+        dedup.accept(10, LE_RANDOM_ADDRESS, b'', now=10.0)
+        self.assertEqual(len(dedup), 1)
+
+    def test_filter_batch(self):
+        batch = AdvertisingReportBatch()
+        for address in (1, 2, 1, 1):
+            batch.addresses.append(address)
+            batch.address_types.append(LE_RANDOM_ADDRESS)
+            batch.event_types.append(ADV_IND)
+            batch.rssi.append(-40)
+            batch.data_offsets.append(0)
+            batch.data_lengths.append(0)
+        dedup = AdvertisingDeduplicator()
+        self.assertEqual(list(dedup.filter_batch(batch, now=0.0)), [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+from hcipy import *
+
+
+class TestDeviceRegistry(unittest.TestCase):
+
+    def test_update(self):
+        registry = DeviceRegistry(ewma_alpha=0.5)
+        registry.update(0xf4588e307b43, LE_RANDOM_ADDRESS, -60, b'\x01', now=1.0)
+        record = registry.update(0xf4588e307b43, LE_RANDOM_ADDRESS, -40, b'\x02', now=2.0)
+
+        self.assertIs(registry.get(0xf4588e307b43), record)
+        self.assertEqual((record.first_seen, record.last_seen, record.packet_count), (1.0, 2.0, 2))
+        self.assertEqual((record.rssi_min, record.rssi_max, record.rssi_ewma), (-60, -40, -50.0))
+        self.assertEqual(record.last_payload, b'\x02')
+
+    def test_rssi_not_available(self):
+        registry = DeviceRegistry(ewma_alpha=0.5)
+        record = registry.update(1, LE_PUBLIC_ADDRESS, RSSI_NOT_AVAILABLE, b'', now=0.0)
+        self.assertEqual((record.rssi_min, record.rssi_max, record.rssi_ewma), (None, None, None))
+        registry.update(1, LE_PUBLIC_ADDRESS, -60, b'', now=1.0)
+        registry.update(1, LE_PUBLIC_ADDRESS, RSSI_NOT_AVAILABLE, b'', now=2.0)
+        registry.update(1, LE_PUBLIC_ADDRESS, -40, b'', now=3.0)
+        self.assertEqual((record.rssi_min, record.rssi_max, record.rssi_ewma, record.packet_count),
+                         (-60, -40, -50.0, 4))
+
+    def test_eviction(self):
+        registry = DeviceRegistry(max_age=10.0, max_devices=2)
+        registry.update(1, LE_PUBLIC_ADDRESS, -50, b'', now=0.0)
+        registry.update(2, LE_PUBLIC_ADDRESS, -50, b'', now=5.0)
+        registry.update(3, LE_PUBLIC_ADDRESS, -50, b'', now=6.0)
+        self.assertNotIn(1, registry)
+
+        self.assertEqual(registry.evict(now=15.5), 1)
+        self.assertEqual([record.address for record in registry], [3])
+
+    def test_snapshot(self):
+        registry = DeviceRegistry()
+        registry.update(1, LE_PUBLIC_ADDRESS, -50, b'\x01', now=0.0)
+        snapshot = registry.snapshot()
+        self.assertEqual(len(snapshot), 1)
+        self.assertEqual(dict(zip(DeviceRegistry.SNAPSHOT_FIELDS, snapshot[0]))['last_payload'], b'\x01')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import socket
+import struct
+import threading
+import unittest
+
+from hcipy import *
+
+
+def adv_report(n, rssi=-60):
+    params = bytearray([EVT_LE_ADVERTISING_REPORT, 1, ADV_IND, LE_RANDOM_ADDRESS, n, 2, 3, 4, 5, 6, 0]) + struct.pack('<b', rssi)
+    return bytearray(struct.pack('<BBB', HCI_EVENT_PKT, LE_META_EVENT, len(params))) + params
+
+
+class TestHCIDispatchQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.handled = []
+        self.queue = None
+
+    def tearDown(self):
+        self.release.set()
+        if self.queue:
+            self.queue.close()
+
+    def slow_callback(self, packet):
+        self.started.set()
+        self.release.wait(2)
+        self.handled.append(packet)
+
+    def fill(self, policy, count, key=None):
+        # the first packet is taken by the (blocked) worker, the rest queue up
+        self.queue = HCIDispatchQueue(self.slow_callback, max_size=2, overflow=policy, key=key)
+        results = []
+        for n in range(count):
+            results.append(self.queue.put(adv_report(n)))
+            if n == 0:
+                self.assertTrue(self.started.wait(2))
+        return results
+
+    def test_drop_newest(self):
+        self.assertEqual(self.fill(DISPATCH_DROP_NEWEST, 5), [True, True, True, False, False])
+        self.release.set()
+        self.queue.close()
+        self.assertEqual([packet[7] for packet in self.handled], [0, 1, 2])
+        self.assertEqual(self.queue.stats()['dropped'], 2)
+        self.assertEqual(self.queue.processed, 3)
+
+    def test_drop_oldest(self):
+        self.fill(DISPATCH_DROP_OLDEST, 5)
+        self.release.set()
+        self.queue.close()
+        self.assertEqual([packet[7] for packet in self.handled], [0, 3, 4])
+        self.assertEqual(self.queue.dropped, 2)
+
+    def test_coalesce(self):
+        self.fill(DISPATCH_COALESCE, 2, key=advertiser_key)
+        self.queue.put(adv_report(1, rssi=-40))        # same advertiser, replaces the queued report
+        self.queue.put(adv_report(2))
+        self.release.set()
+        self.queue.close()
+        self.assertEqual([(packet[7], struct.unpack_from('<b', packet, 14)[0]) for packet in self.handled],
+                         [(0, -60), (1, -40), (2, -60)])
+        self.assertEqual(self.queue.coalesced, 1)
+        self.assertEqual(self.queue.dropped, 0)
+
+    def test_block(self):
+        self.fill(DISPATCH_BLOCK, 3)
+        producer = threading.Thread(target=self.queue.put, args=(adv_report(3),))
+        producer.start()
+        producer.join(0.1)
+        self.assertTrue(producer.is_alive())
+        self.release.set()
+        producer.join(2)
+        self.queue.close()
+        self.assertEqual([packet[7] for packet in self.handled], [0, 1, 2, 3])
+
+    def test_closed(self):
+        self.fill(DISPATCH_BLOCK, 3)
+        producer = threading.Thread(target=self.queue.put, args=(adv_report(3),))
+        producer.start()
+        self.release.set()
+        self.queue.close()
+        producer.join(2)
+        # blocked or not, nothing is queued once closed
+        self.assertFalse(self.queue.put(adv_report(4)))
+        self.assertEqual(self.queue.processed, len(self.handled))
+        self.assertEqual(self.queue.processed + self.queue.dropped, 5)
+
+    def test_invalid_policy(self):
+        self.assertRaises(ValueError, HCIDispatchQueue, self.slow_callback, overflow='spill')
+        self.assertRaises(ValueError, HCIDispatchQueue, self.slow_callback, overflow=DISPATCH_COALESCE)
+
+
+class TestBluetoothHCIDispatch(unittest.TestCase):
+
+    def test_on_data_runs_on_worker(self):
+        controller, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        provider = BluetoothHCISocketProvider(sock=host, receive_buffer_size=256 * 1024)
+        self.assertGreaterEqual(provider.receive_buffer_size(), 256 * 1024)
+
+        hci = BluetoothHCI(provider=provider)
+        threads = []
+        done = threading.Event()
+
+        def on_data(data):
+            threads.append(threading.current_thread().name)
+            if len(threads) == 3:
+                done.set()
+
+        hci.on_data(on_data)
+        dispatch_queue = hci.enable_dispatch(workers=2, max_size=16)
+        for n in range(3):
+            controller.send(adv_report(n))
+        self.assertTrue(done.wait(2))
+        self.assertTrue(all(name.startswith('HCIDispatch-') for name in threads))
+
+        hci.stop()
+        self.assertEqual(dispatch_queue.processed, 3)
+        self.assertFalse(any(thread.is_alive() for thread in threading.enumerate()
+                             if thread.name.startswith('HCIDispatch-')))
+        controller.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
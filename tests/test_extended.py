@@ -0,0 +1,189 @@
+import concurrent.futures
+import socket
+import struct
+import threading
+import unittest
+
+from hcipy import *
+
+
+def extended_report(data, event_type=ADV_PROP_CONNECTABLE, status=EXT_ADV_DATA_COMPLETE, address=0x112233445566,
+                    sid=1, rssi=-60):
+    report = struct.pack('<HBIHBBBbbHBIHB', event_type | (status << 5), LE_RANDOM_ADDRESS, address & 0xffffffff,
+                         address >> 32, LE_PHY_CODED, LE_PHY_CODED, sid, 127, rssi, 0, 0, 0, 0, len(data)) + bytes(data)
+    return report
+
+
+def extended_report_event(*reports):
+    params = struct.pack('<BB', EVT_LE_EXTENDED_ADVERTISING_REPORT, len(reports)) + b''.join(reports)
+    return bytearray(struct.pack('<BBB', HCI_EVENT_PKT, EVT_LE_META_EVENT, len(params)) + params)
+
+
+def cmd_complete(opcode, ncmd=1, status=HCI_SUCCESS):
+    return struct.pack('<BBBBHB', HCI_EVENT_PKT, EVT_CMD_COMPLETE, 4, ncmd, opcode, status)
+
+
+class TestExtendedBuilders(unittest.TestCase):
+
+    def test_extended_scan(self):
+        packet = LESetExtendedScanParametersCommand().build(interval=0x0020, window=0x0010)
+        self.assertEqual(bytes(packet), struct.pack('<BHB BBB BHH BHH', HCI_COMMAND_PKT, LE_SET_EXTENDED_SCAN_PARAMETERS_CMD,
+                                                    13, LE_PUBLIC_ADDRESS, FILTER_POLICY_NO_WHITELIST,
+                                                    LE_SCAN_PHY_1M | LE_SCAN_PHY_CODED,
+                                                    SCAN_TYPE_ACTIVE, 0x0020, 0x0010, SCAN_TYPE_ACTIVE, 0x0020, 0x0010))
+        self.assertEqual(len(LESetExtendedScanParametersCommand().build(phys=LE_SCAN_PHY_1M)), 4 + 8)
+        self.assertRaises(ValueError, LESetExtendedScanParametersCommand().build, phys=LE_PHY_2M)
+        self.assertEqual(bytes(LESetExtendedScanEnableCommand().build(True, duration=100)),
+                         struct.pack('<BHB BBHH', HCI_COMMAND_PKT, LE_SET_EXTENDED_SCAN_ENABLE_CMD, 6, 1, 0, 100, 0))
+
+    def test_extended_advertising_parameters(self):
+        packet = bytes(LESetExtendedAdvertisingParametersCommand().build(handle=2, properties=0, min_interval=0x012345,
+                                                                         max_interval=0x012345, sid=3))
+        self.assertEqual(len(packet), 4 + 25)
+        self.assertEqual(packet[4:12], b'\x02\x00\x00\x45\x23\x01\x45\x23')
+        self.assertEqual(packet[-3:], b'\x01\x03\x00')       # secondary PHY, SID, scan request notifications
+
+    def test_data_fragments(self):
+        builder = LESetExtendedAdvertisingDataCommand()
+        packet = builder.build(1, b'\x02\x01\x06')
+        self.assertEqual(bytes(packet), struct.pack('<BHB BBBB', HCI_COMMAND_PKT, LE_SET_EXTENDED_ADVERTISING_DATA_CMD, 7,
+                                                    1, ADV_DATA_OP_COMPLETE, 0x01, 3) + b'\x02\x01\x06')
+        data = bytes(range(256)) * 2
+        fragments = builder.fragments(1, data)
+        self.assertEqual([fragment[5] for fragment in fragments],
+                         [ADV_DATA_OP_FIRST, ADV_DATA_OP_INTERMEDIATE, ADV_DATA_OP_LAST])
+        self.assertEqual(b''.join(fragment[8:] for fragment in fragments), data)
+        self.assertEqual([fragment[3] for fragment in fragments], [255, 255, 14])
+        self.assertRaises(ValueError, builder.fragments, 1, b'\0' * 1651)
+
+    def test_enable_sets(self):
+        builder = LESetExtendedAdvertisingEnableCommand()
+        packet = builder.build(True, [0, (1, 100, 5)])
+        self.assertEqual(packet, struct.pack('<BHB BB BHB BHB', HCI_COMMAND_PKT, LE_SET_EXTENDED_ADVERTISING_ENABLE_CMD,
+                                             10, 1, 2, 0, 0, 0, 1, 100, 5))
+        # packed into the same buffer each time
+        self.assertIs(builder.build(False).obj, packet.obj)
+        self.assertEqual(builder.build(False), struct.pack('<BHB BB', HCI_COMMAND_PKT,
+                                                           LE_SET_EXTENDED_ADVERTISING_ENABLE_CMD, 2, 0, 0))
+        self.assertRaises(ValueError, builder.build, True, list(range(64)))
+
+
+class TestExtendedAdvertisingReport(unittest.TestCase):
+
+    def test_decode(self):
+        event = decode_event(extended_report_event(extended_report(b'\x02\x01\x06'),
+                                                   extended_report(b'', address=0x010203040506, rssi=-70)))
+        self.assertIsInstance(event, LEExtendedAdvertisingReport)
+        first, second = event.reports
+        self.assertEqual(first.bd_address, BDAddress(0x112233445566, LE_RANDOM_ADDRESS))
+        self.assertEqual((first.primary_phy, first.sid, first.rssi, first.tx_power), (LE_PHY_CODED, 1, -60, 127))
+        self.assertEqual(first.ad.flags, 0x06)
+        self.assertEqual(first.data_status, EXT_ADV_DATA_COMPLETE)
+        self.assertEqual((second.address, second.rssi, len(second.data)), (0x010203040506, -70, 0))
+
+    def test_reassembly(self):
+        completed = []
+        reassembler = ExtendedAdvertisingReassembler(completed.append)
+        data = bytes(range(150)) * 2
+        self.assertEqual(reassembler.add_event(extended_report_event(
+            extended_report(data[:150], status=EXT_ADV_DATA_INCOMPLETE),
+            extended_report(b'\x02\x01\x06', address=0x010203040506))), completed)
+        self.assertEqual(len(reassembler), 1)
+        # another advertiser's complete report is passed through unchanged
+        self.assertEqual(completed[0].address, 0x010203040506)
+        self.assertIsInstance(completed[0].data, memoryview)
+
+        reassembler.add_event(extended_report_event(extended_report(data[150:], rssi=-50)))
+        self.assertEqual(len(completed), 2)
+        self.assertEqual(completed[1].data, data)
+        self.assertEqual(completed[1].rssi, -50)
+        self.assertEqual(completed[1].data_status, EXT_ADV_DATA_COMPLETE)
+        self.assertEqual(len(reassembler), 0)
+
+    def test_truncated_and_scan_response_kept_apart(self):
+        reassembler = ExtendedAdvertisingReassembler()
+        self.assertIsNone(reassembler.add_report(decode_event(extended_report_event(
+            extended_report(b'ab', status=EXT_ADV_DATA_INCOMPLETE))).reports[0]))
+        response = reassembler.add_report(decode_event(extended_report_event(
+            extended_report(b'rsp', event_type=EXT_ADV_EVT_SCAN_RESPONSE | ADV_PROP_SCANNABLE))).reports[0])
+        self.assertEqual(bytes(response.data), b'rsp')
+        report = reassembler.add_report(decode_event(extended_report_event(
+            extended_report(b'cd', status=EXT_ADV_DATA_TRUNCATED))).reports[0])
+        self.assertEqual(report.data, b'abcd')
+        self.assertEqual(report.data_status, EXT_ADV_DATA_TRUNCATED)
+
+    def test_pending_is_bounded(self):
+        reassembler = ExtendedAdvertisingReassembler(max_pending=2)
+        for address in range(3):
+            reassembler.add_event(extended_report_event(extended_report(b'x', status=EXT_ADV_DATA_INCOMPLETE,
+                                                                        address=address)))
+        self.assertEqual((len(reassembler), reassembler.dropped), (2, 1))
+        self.assertEqual(reassembler.add_event(extended_report_event(extended_report(b'y', address=0)))[0].data, b'y')
+
+
+class TestExtendedAdvertisingSets(unittest.TestCase):
+    # against a stand-in controller socket, which completes every command
+
+    def setUp(self):
+        self.controller, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.hci = BluetoothHCI(provider=BluetoothHCISocketProvider(sock=host))
+        self.received = []
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run_controller)
+        self.thread.start()
+
+    def tearDown(self):
+        self.hci.stop()
+        self.thread.join()
+        self.controller.close()
+
+    def run_controller(self):
+        while True:
+            packet = self.controller.recv(1024)
+            if not packet or packet[0] != HCI_COMMAND_PKT:
+                return
+            self.received.append(packet)
+            self.controller.send(cmd_complete(struct.unpack_from('<H', packet, 1)[0]))
+
+    def opcodes(self):
+        return [struct.unpack_from('<H', packet, 1)[0] for packet in self.received]
+
+    def test_sets_share_one_enable(self):
+        sets = ExtendedAdvertisingSets(self.hci)
+        first, futures = sets.add(b'\x02\x01\x06' + b'\0' * 300)
+        second, more = sets.add(b'\x02\x01\x04', scan_response=b'\x03\x09hi', random_address='C0:11:22:33:44:55')
+        futures += more + sets.enable()
+        self.assertEqual(len(concurrent.futures.wait(futures, 2).done), len(futures))
+        for future in futures:
+            future.result()
+
+        self.assertEqual((first.handle, second.handle), (0, 1))
+        self.assertEqual(self.opcodes(), [
+            LE_SET_EXTENDED_ADVERTISING_PARAMETERS_CMD, LE_SET_EXTENDED_ADVERTISING_DATA_CMD,
+            LE_SET_EXTENDED_ADVERTISING_DATA_CMD,
+            LE_SET_EXTENDED_ADVERTISING_PARAMETERS_CMD, LE_SET_ADVERTISING_SET_RANDOM_ADDRESS_CMD,
+            LE_SET_EXTENDED_ADVERTISING_DATA_CMD, LE_SET_EXTENDED_SCAN_RESPONSE_DATA_CMD,
+            LE_SET_EXTENDED_ADVERTISING_ENABLE_CMD])
+        self.assertEqual(self.received[-1][4:], b'\x01\x02' + b'\x00\x00\x00\x00' + b'\x01\x00\x00\x00')
+        self.assertEqual(self.received[3][5:7], struct.pack('<H', ADV_PROP_LEGACY | ADV_PROP_SCANNABLE))
+        self.assertRaises(ValueError, sets.add, b'\x02\x01\x04', scan_response=b'\x03\x09hi',
+                          properties=ADV_PROP_SCANNABLE)
+        self.assertRaises(ValueError, sets.add, b'\0' * 32, scan_response=b'\x03\x09hi')
+        self.assertRaises(ValueError, sets.set_data, 1, scan_response=b'\0' * 32)
+
+        # unchanged data isn't sent again
+        del self.received[:]
+        futures = sets.set_data(1, data=b'\x02\x01\x04', scan_response=b'\x03\x09ho')
+        concurrent.futures.wait(futures, 2)
+        self.assertEqual(self.opcodes(), [LE_SET_EXTENDED_SCAN_RESPONSE_DATA_CMD])
+
+        del self.received[:]
+        concurrent.futures.wait(sets.disable() + sets.remove(0), 2)
+        self.assertEqual(self.opcodes(), [LE_SET_EXTENDED_ADVERTISING_ENABLE_CMD, LE_REMOVE_ADVERTISING_SET_CMD])
+        self.assertEqual(self.received[0][4:], b'\x00\x00')
+        self.assertEqual(list(sets.sets), [1])
+        self.assertEqual(sets.add(b'')[0].handle, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import struct
+import unittest
+
+from hcipy import *
+
+
+class RecordingProvider(BluetoothHCIProvider):
+
+    def __init__(self, device_id=0):
+        super(RecordingProvider, self).__init__(device_id)
+        self.filters = []
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def set_filter(self, data):
+        self.filters.append(struct.unpack(HCIPY_HCI_FILTER_STRUCT, data))
+
+    def on_data_batch(self, callback):
+        pass
+
+
+class TestHCIFilter(unittest.TestCase):
+
+    def test_masks(self):
+        hci_filter = HCIFilter()
+        hci_filter.add(HCI_EVENT_PKT, EVT_LE_META_EVENT)
+        hci_filter.add(HCI_EVENT_PKT, EVT_CMD_COMPLETE, LE_SET_SCAN_ENABLE_CMD)
+        self.assertEqual(hci_filter.masks(), (1 << HCI_EVENT_PKT,
+                                              1 << EVT_CMD_COMPLETE,
+                                              1 << (EVT_LE_META_EVENT - 32),
+                                              LE_SET_SCAN_ENABLE_CMD))
+
+        # a second opcode (or any opcode) can't be expressed, so the opcode filter is dropped
+        hci_filter.add(HCI_EVENT_PKT, EVT_CMD_STATUS)
+        self.assertEqual(hci_filter.masks()[3], 0)
+        hci_filter.remove(HCI_EVENT_PKT, EVT_CMD_STATUS)
+        self.assertEqual(hci_filter.masks()[3], LE_SET_SCAN_ENABLE_CMD)
+
+    def test_reference_counting(self):
+        hci_filter = HCIFilter()
+        hci_filter.add(HCI_ACLDATA_PKT)
+        hci_filter.add(HCI_ACLDATA_PKT)
+        hci_filter.remove(HCI_ACLDATA_PKT)
+        self.assertEqual(hci_filter.masks()[0], 1 << HCI_ACLDATA_PKT)
+        hci_filter.remove(HCI_ACLDATA_PKT)
+        self.assertEqual(hci_filter.masks(), (0, 0, 0, 0))
+
+    def test_wildcards(self):
+        hci_filter = HCIFilter()
+        hci_filter.add(HCI_EVENT_PKT)
+        self.assertEqual(hci_filter.masks(), (1 << HCI_EVENT_PKT, 0xffffffff, 0xffffffff, 0))
+        hci_filter.add()
+        self.assertEqual(hci_filter.masks()[0], 0xffffffff)
+
+
+class TestAutoFilter(unittest.TestCase):
+
+    def test_filter_follows_subscriptions(self):
+        provider = RecordingProvider()
+        hci = BluetoothHCI(provider=provider, auto_filter=True)
+        command_events = (1 << EVT_CMD_COMPLETE) | (1 << EVT_CMD_STATUS)
+        self.assertEqual(provider.filters, [(1 << HCI_EVENT_PKT, command_events, 0, 0)])
+
+        def on_data(data):
+            pass
+
+        hci.on_data(on_data, [(HCI_EVENT_PKT, EVT_LE_META_EVENT)])
+        acl = ACLManager(hci)
+        self.assertEqual(provider.filters[-1], ((1 << HCI_EVENT_PKT) | (1 << HCI_ACLDATA_PKT),
+                                                command_events | (1 << EVT_DISCONN_COMPLETE) | (1 << EVT_NUM_COMP_PKTS),
+                                                1 << (EVT_LE_META_EVENT - 32),
+                                                0))
+
+        acl.close()
+        hci.on_data(None)
+        self.assertEqual(provider.filters[-1], (1 << HCI_EVENT_PKT, command_events, 0, 0))
+
+        # unchanged filters aren't pushed again
+        count = len(provider.filters)
+        hci.on_data(on_data, [])
+        self.assertEqual(len(provider.filters), count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+import struct
+import threading
+import time
+import unittest
+import uuid
+
+from hcipy import *
+
+
+SERVICE_UUID = uuid.UUID('6e400001-b5a3-f393-e0a9-e50e24dcca9e')
+CHARACTERISTIC_UUID = uuid.UUID('6e400002-b5a3-f393-e0a9-e50e24dcca9e')
+LONG_VALUE = bytes(range(150))
+
+
+class FakeHCI(object):
+
+    def __init__(self):
+        self.written = []
+        self.listeners = []
+
+    def add_listener(self, callback, interests=None):
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self.listeners.remove(callback)
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+    def receive(self, packet):
+        for listener in self.listeners:
+            listener(memoryview(packet))
+
+
+class FakeGATTServer(object):
+    # Answers the ATT requests written to a FakeHCI, one attribute per response to exercise paging
+
+    def __init__(self, hci):
+        self.hci = hci
+        self.mtu = ATT_DEFAULT_LE_MTU
+        self.requests = []
+        self.writes = []
+        self.done = 0
+        self.attributes = [
+            (0x0001, GATT_PRIM_SVC_UUID, struct.pack('<H', 0x180f)),
+            (0x0002, GATT_CHARAC_UUID, struct.pack('<BHH', GATT_CHR_PROP_READ | GATT_CHR_PROP_NOTIFY, 0x0003, 0x2a19)),
+            (0x0003, 0x2a19, b'\x64'),
+            (0x0004, GATT_CLIENT_CHARAC_CFG_UUID, b'\x00\x00'),
+            (0x0005, GATT_PRIM_SVC_UUID, SERVICE_UUID.bytes[::-1]),
+            (0x0006, GATT_CHARAC_UUID, struct.pack('<BH', GATT_CHR_PROP_READ | GATT_CHR_PROP_WRITE |
+                                                   GATT_CHR_PROP_WRITE_WITHOUT_RESP, 0x0007) +
+             CHARACTERISTIC_UUID.bytes[::-1]),
+            (0x0007, None, LONG_VALUE),
+        ]
+
+    def pump(self):
+        # handle everything written so far, returning the controller buffers
+        while self.done < len(self.hci.written):
+            packet = self.hci.written[self.done]
+            self.done += 1
+            handle = struct.unpack_from('<H', packet, 1)[0] & 0x0fff
+            pdu = packet[HCI_ACL_HDR_SIZE + L2CAP_HDR_SIZE:]
+            self.hci.receive(struct.pack('<BBBBHH', HCI_EVENT_PKT, EVT_NUM_COMP_PKTS, 5, 1, handle, 1))
+            response = self.respond(pdu)
+            if response is not None:
+                self.send(handle, response)
+
+    def send(self, handle, pdu):
+        self.hci.receive(struct.pack('<BHHHH', HCI_ACLDATA_PKT, acl_handle_pack(handle, ACL_START), len(pdu) + 4,
+                                     len(pdu), ATT_CID) + pdu)
+
+    def error(self, opcode, handle, error):
+        return struct.pack('<BBHB', ATT_OP_ERROR_RSP, opcode, handle, error)
+
+    def respond(self, pdu):
+        opcode = pdu[0]
+        if opcode != ATT_OP_WRITE_CMD:
+            self.requests.append(opcode)
+        if opcode == ATT_OP_MTU_REQ:
+            self.mtu = min(struct.unpack_from('<H', pdu, 1)[0], 100)
+            return struct.pack('<BH', ATT_OP_MTU_RSP, 100)
+        if opcode in (ATT_OP_READ_BY_GROUP_REQ, ATT_OP_READ_BY_TYPE_REQ, ATT_OP_FIND_INFO_REQ):
+            start, end = struct.unpack_from('<HH', pdu, 1)
+            wanted = struct.unpack_from('<H', pdu, 5)[0] if opcode != ATT_OP_FIND_INFO_REQ else None
+            for index, (handle, attribute_type, value) in enumerate(self.attributes):
+                if not start <= handle <= end:
+                    continue
+                if opcode == ATT_OP_FIND_INFO_REQ:
+                    if attribute_type is None:
+                        continue
+                    return struct.pack('<BBHH', ATT_OP_FIND_INFO_RSP, 0x01, handle, attribute_type)
+                if attribute_type != wanted:
+                    continue
+                if opcode == ATT_OP_READ_BY_TYPE_REQ:
+                    return struct.pack('<BBH', ATT_OP_READ_BY_TYPE_RSP, 2 + len(value), handle) + value
+                group_end = next((other[0] - 1 for other in self.attributes[index + 1:]
+                                  if other[1] == GATT_PRIM_SVC_UUID), 0xffff)
+                return struct.pack('<BBHH', ATT_OP_READ_BY_GROUP_RSP, 4 + len(value), handle, group_end) + value
+            return self.error(opcode, start, ATT_ECODE_ATTR_NOT_FOUND)
+        handle = struct.unpack_from('<H', pdu, 1)[0]
+        attribute = next((attribute for attribute in self.attributes if attribute[0] == handle), None)
+        if attribute is None:
+            return self.error(opcode, handle, ATT_ECODE_INVALID_HANDLE)
+        if opcode == ATT_OP_READ_REQ:
+            return bytes(bytearray([ATT_OP_READ_RSP])) + attribute[2][:self.mtu - 1]
+        if opcode == ATT_OP_READ_BLOB_REQ:
+            offset = struct.unpack_from('<H', pdu, 3)[0]
+            return bytes(bytearray([ATT_OP_READ_BLOB_RSP])) + attribute[2][offset:offset + self.mtu - 1]
+        if opcode in (ATT_OP_WRITE_REQ, ATT_OP_WRITE_CMD):
+            self.writes.append((handle, pdu[3:]))
+            if opcode == ATT_OP_WRITE_REQ:
+                return bytes(bytearray([ATT_OP_WRITE_RSP]))
+        return None
+
+
+def disconnection_complete(handle):
+    return struct.pack('<BBBBHB', HCI_EVENT_PKT, EVT_DISCONN_COMPLETE, 4, HCI_SUCCESS, handle,
+                       HCI_OE_USER_ENDED_CONNECTION)
+
+
+class TestGATTClient(unittest.TestCase):
+
+    def setUp(self):
+        self.hci = FakeHCI()
+        self.acl = ACLManager(self.hci)
+        self.acl.set_buffer_size(251, 4)
+        self.server = FakeGATTServer(self.hci)
+        self.gatt = GATTClientManager(self.acl)
+        self.address = BDAddress('11:22:33:44:55:66')
+        self.client = self.gatt.client(0x40, self.address)
+
+    def tearDown(self):
+        self.gatt.close()
+
+    def complete(self, future):
+        self.server.pump()
+        return future.result(0)
+
+    def discover(self):
+        self.assertEqual(self.complete(self.client.exchange_mtu()), 100)
+        return self.complete(self.client.discover())
+
+    def test_discovery_is_cached_across_reconnects(self):
+        services = self.discover()
+        self.assertEqual([service.uuid for service in services], [0x180f, SERVICE_UUID])
+        self.assertEqual((services[0].start_handle, services[0].end_handle), (0x0001, 0x0004))
+        self.assertEqual((services[1].start_handle, services[1].end_handle), (0x0005, 0xffff))
+        battery, = services[0].characteristics
+        self.assertEqual((battery.uuid, battery.value_handle, battery.end_handle), (0x2a19, 0x0003, 0x0004))
+        self.assertEqual(self.client.characteristic(CHARACTERISTIC_UUID).value_handle, 0x0007)
+
+        self.hci.receive(disconnection_complete(0x40))
+        requests = len(self.server.requests)
+        client = self.gatt.client(0x41, self.address)
+        self.assertIsNot(client, self.client)
+        self.assertIs(client.discover().result(0), services)
+        self.server.pump()
+        self.assertEqual(len(self.server.requests), requests)
+
+    def test_read_write(self):
+        self.discover()
+        self.assertEqual(self.complete(self.client.read(0x0003)), b'\x64')
+        self.assertEqual(self.complete(self.client.read(self.client.characteristic(CHARACTERISTIC_UUID))),
+                         LONG_VALUE)
+        self.assertEqual(self.server.requests[-2:], [ATT_OP_READ_REQ, ATT_OP_READ_BLOB_REQ])
+
+        self.complete(self.client.write(0x0007, b'hello'))
+        self.assertEqual(self.server.writes, [(0x0007, b'hello')])
+        future = self.client.write(0x0099, b'!')
+        self.server.pump()
+        self.assertRaises(ATTError, future.result, 0)
+        self.assertEqual(future.exception().error, ATT_ECODE_INVALID_HANDLE)
+
+    def test_requests_are_queued_one_at_a_time(self):
+        futures = [self.client.read(0x0003) for _ in range(3)]
+        self.assertEqual(len(self.hci.written), 1)
+        self.server.pump()
+        self.assertEqual([future.result(0) for future in futures], [b'\x64'] * 3)
+
+    def test_subscribe(self):
+        self.discover()
+        values = []
+        battery = self.client.characteristic(0x2a19)
+        self.complete(self.client.subscribe(battery, lambda value: values.append(bytes(value))))
+        self.assertEqual(battery.cccd_handle, 0x0004)
+        self.assertEqual(self.server.writes, [(0x0004, b'\x01\x00')])
+
+        self.server.send(0x40, struct.pack('<BH', ATT_OP_HANDLE_NOTIFY, 0x0003) + b'\x63')
+        self.server.send(0x40, struct.pack('<BH', ATT_OP_HANDLE_IND, 0x0003) + b'\x62')
+        self.assertEqual(values, [b'\x63', b'\x62'])
+        self.assertEqual(self.hci.written[-1][-1], ATT_OP_HANDLE_CNF)
+
+    def test_disconnection_fails_requests(self):
+        futures = [self.client.read(0x0003) for _ in range(2)]
+        self.hci.receive(disconnection_complete(0x40))
+        for future in futures:
+            self.assertRaises(IOError, future.result, 0)
+        self.assertRaises(IOError, self.client.read(0x0003).result, 0)
+
+    def test_stream(self):
+        self.discover()
+        self.acl.set_buffer_size(251, 2)
+        values = [bytes(bytearray([i])) * 20 for i in range(50)]
+        thread = threading.Thread(target=self.client.stream, args=(0x0007, values, 5.0))
+        thread.start()
+        while thread.is_alive():
+            self.server.pump()
+            self.assertLessEqual(self.acl.pending(0x40), 2)
+            time.sleep(0.001)
+        thread.join()
+        self.server.pump()
+        self.assertEqual(self.server.writes, [(0x0007, value) for value in values])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,240 @@
+import contextlib
+import io
+import struct
+import unittest
+import uuid
+
+from hcipy import *
+
+
+SERVICE_UUID = uuid.UUID('6e400001-b5a3-f393-e0a9-e50e24dcca9e')
+RX_UUID = uuid.UUID('6e400002-b5a3-f393-e0a9-e50e24dcca9e')
+
+
+class FakeHCI(object):
+
+    def __init__(self):
+        self.written = []
+        self.listeners = []
+
+    def add_listener(self, callback, interests=None):
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self.listeners.remove(callback)
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+    def receive(self, packet):
+        for listener in self.listeners:
+            listener(memoryview(packet))
+
+
+def num_comp_pkts(handle, count=1):
+    return struct.pack('<BBBBHH', HCI_EVENT_PKT, EVT_NUM_COMP_PKTS, 5, 1, handle, count)
+
+
+class Link(object):
+    # Carries the ACL packets written on either side to the other, as one connection handle
+
+    def __init__(self, a, b):
+        self.sides = [[a, b, 0], [b, a, 0]]
+
+    def pump(self):
+        moved = True
+        while moved:
+            moved = False
+            for side in self.sides:
+                source, destination, done = side
+                while done < len(source.written):
+                    packet = source.written[done]
+                    done += 1
+                    side[2] = done
+                    handle = struct.unpack_from('<H', packet, 1)[0] & 0x0fff
+                    source.receive(num_comp_pkts(handle))
+                    destination.receive(packet)
+                    moved = True
+
+
+def build_database():
+    database = GATTDatabase()
+    database.add_service(0x180f)
+    battery = database.add_characteristic(0x2a19, GATT_CHR_PROP_READ | GATT_CHR_PROP_NOTIFY | GATT_CHR_PROP_INDICATE,
+                                          b'\x64')
+    database.add_descriptor(GATT_CHARAC_USER_DESC_UUID, b'Battery level')
+    database.add_service(SERVICE_UUID)
+    rx = database.add_characteristic(RX_UUID, GATT_CHR_PROP_WRITE | GATT_CHR_PROP_WRITE_WITHOUT_RESP)
+    return database, battery, rx
+
+
+class TestGATTDatabase(unittest.TestCase):
+
+    def test_layout(self):
+        database, battery, rx = build_database()
+        self.assertEqual(list(database.handles), list(range(1, 9)))
+        self.assertEqual((battery.handle, battery.value_handle, battery.cccd_handle, battery.end_handle), (2, 3, 4, 5))
+        self.assertEqual(list(database.group_ends[:1]), [5])
+        self.assertEqual(database.group_ends[5], 8)
+        self.assertEqual(database.range(2, 4), (1, 4))
+        self.assertEqual(database.range(1, 0xffff, GATT_CHARAC_UUID), (0, 2))
+        self.assertEqual(database.range(3, 0xffff, GATT_CHARAC_UUID), (1, 2))
+
+    def test_fixed_handles(self):
+        database = GATTDatabase()
+        database.add_service(0x1800)
+        database.add_characteristic(0x2a00, GATT_CHR_PROP_READ, b'hcipy')
+        self.assertEqual(database.add_service(0x180f, handle=0x0010), 0x0010)
+        self.assertEqual(database.range(0x0004, 0x000f), (3, 3))
+        self.assertRaises(ValueError, database.add_service, 0x180a, handle=0x0008)
+        self.assertRaises(KeyError, database.get_value, 0x0009)
+
+
+class TestGATTServer(unittest.TestCase):
+
+    def setUp(self):
+        self.database, self.battery, self.rx = build_database()
+        self.hci = FakeHCI()
+        self.acl = ACLManager(self.hci)
+        self.acl.set_buffer_size(251, 4)
+        self.server = GATTServer(self.acl, self.database)
+
+        self.client_hci = FakeHCI()
+        self.client_acl = ACLManager(self.client_hci)
+        self.client_acl.set_buffer_size(251, 4)
+        self.gatt = GATTClientManager(self.client_acl)
+        self.client = self.gatt.client(0x40)
+        self.link = Link(self.hci, self.client_hci)
+
+    def tearDown(self):
+        self.gatt.close()
+        self.server.close()
+
+    def complete(self, future):
+        self.link.pump()
+        return future.result(0)
+
+    def request(self, pdu):
+        # raw request, returns the response PDU
+        frames = []
+        self.client_acl.on_frame(lambda handle, cid, payload: frames.append(bytes(payload)))
+        self.client_acl.send(0x40, pdu)
+        self.link.pump()
+        self.client_acl.on_frame(None)
+        return frames[-1]
+
+    def test_discovery_and_access(self):
+        self.assertEqual(self.complete(self.client.exchange_mtu(100)), 100)
+        services = self.complete(self.client.discover())
+        self.assertEqual([(service.uuid, service.start_handle, service.end_handle) for service in services],
+                         [(0x180f, 1, 5), (SERVICE_UUID, 6, 8)])
+        self.assertEqual([characteristic.value_handle for characteristic in services[1].characteristics], [8])
+        self.assertEqual(self.complete(self.client.read(3)), b'\x64')
+
+        written = []
+        self.database._on_write[8] = lambda handle, value: written.append((handle, value))
+        self.complete(self.client.write(8, b'hello'))
+        self.client.write_without_response(8, b'world')
+        self.link.pump()
+        self.assertEqual(written, [(0x40, b'hello'), (0x40, b'world')])
+        self.assertEqual(self.database.get_value(8), b'world')
+
+        future = self.client.write(3, b'\x00')
+        self.link.pump()
+        self.assertEqual(future.exception().error, ATT_ECODE_WRITE_NOT_PERM)
+
+    def test_long_read(self):
+        long_value = bytes(range(200))
+        self.database.set_value(self.battery, long_value)
+        self.assertEqual(self.complete(self.client.read(3)), long_value)
+
+    def test_responses_fill_the_mtu(self):
+        database = GATTDatabase()
+        database.add_service(0x180a)
+        for i in range(20):
+            database.add_characteristic(0x2a23 + i, GATT_CHR_PROP_READ, b'')
+        self.server.database = database
+
+        # 23 byte MTU: 2 + 3 * 7 byte characteristic declarations
+        response = self.request(struct.pack('<BHHH', ATT_OP_READ_BY_TYPE_REQ, 1, 0xffff, GATT_CHARAC_UUID))
+        self.assertEqual(response[:2], b'\x09\x07')
+        self.assertEqual(len(response), 23)
+        # (handle, 16-bit type) pairs
+        response = self.request(struct.pack('<BHH', ATT_OP_FIND_INFO_REQ, 10, 0xffff))
+        self.assertEqual(response[:2], b'\x05\x01')
+        self.assertEqual(struct.unpack_from('<HH', response, 2), (10, GATT_CHARAC_UUID))
+        self.assertEqual(len(response), 22)
+
+        response = self.request(struct.pack('<BHH', ATT_OP_FIND_INFO_REQ, 100, 0xffff))
+        self.assertEqual(response, struct.pack('<BBHB', ATT_OP_ERROR_RSP, ATT_OP_FIND_INFO_REQ, 100,
+                                               ATT_ECODE_ATTR_NOT_FOUND))
+
+    def test_find_by_type_value_and_unsupported(self):
+        response = self.request(struct.pack('<BHHH', ATT_OP_FIND_BY_TYPE_REQ, 1, 0xffff, GATT_PRIM_SVC_UUID) +
+                                SERVICE_UUID.bytes[::-1])
+        self.assertEqual(response, struct.pack('<BHH', ATT_OP_FIND_BY_TYPE_RSP, 6, 8))
+        response = self.request(struct.pack('<BH', ATT_OP_PREP_WRITE_REQ, 8))
+        self.assertEqual(response, struct.pack('<BBHB', ATT_OP_ERROR_RSP, ATT_OP_PREP_WRITE_REQ, 0,
+                                               ATT_ECODE_REQ_NOT_SUPP))
+
+    def test_malformed_type_is_an_invalid_pdu(self):
+        for opcode in (ATT_OP_READ_BY_TYPE_REQ, ATT_OP_READ_BY_GROUP_REQ):
+            for attribute_type in (b'', b'\x00\x28\x00'):
+                response = self.request(struct.pack('<BHH', opcode, 1, 0xffff) + attribute_type)
+                self.assertEqual(response, struct.pack('<BBHB', ATT_OP_ERROR_RSP, opcode, 0, ATT_ECODE_INVALID_PDU))
+
+    def test_raising_callbacks_are_answered(self):
+        def fail(*args):
+            raise RuntimeError("application bug")
+
+        self.database._on_read[3] = fail
+        self.database._on_write[8] = fail
+        with contextlib.redirect_stderr(io.StringIO()):
+            read = self.request(struct.pack('<BH', ATT_OP_READ_REQ, 3))
+            write = self.request(struct.pack('<BH', ATT_OP_WRITE_REQ, 8) + b'hi')
+        self.assertEqual(read, struct.pack('<BBHB', ATT_OP_ERROR_RSP, ATT_OP_READ_REQ, 3, ATT_ECODE_UNLIKELY))
+        self.assertEqual(write, struct.pack('<BBHB', ATT_OP_ERROR_RSP, ATT_OP_WRITE_REQ, 8, ATT_ECODE_UNLIKELY))
+
+    def test_notifications_are_batched(self):
+        self.complete(self.client.discover())
+        battery = self.client.characteristic(0x2a19)
+        values = []
+        self.complete(self.client.subscribe(battery, lambda value: values.append(bytes(value))))
+        self.assertEqual(self.server.subscribers(self.battery), [0x40])
+
+        # two controller buffers: two notifications sent, two queued in the ACL layer, the rest wait for the
+        # controller to report completed packets
+        self.acl.set_buffer_size(251, 2)
+        written = len(self.hci.written)
+        for level in range(6):
+            self.assertEqual(self.server.notify(self.battery, bytearray([level])), 1)
+        self.assertEqual(len(self.hci.written), written + 2)
+        self.assertEqual(len(self.server.bearers[0x40].notifications), 2)
+
+        self.hci.receive(num_comp_pkts(0x40, 2))
+        self.assertEqual(len(self.hci.written), written + 4)
+        self.assertEqual(len(self.server.bearers[0x40].notifications), 0)
+        self.link.pump()
+        self.assertEqual(values, [bytes(bytearray([level])) for level in range(6)])
+        self.assertGreater(self.server.batches, 0)
+
+    def test_indications(self):
+        self.complete(self.client.discover())
+        values = []
+        self.complete(self.client.subscribe(self.client.characteristic(0x2a19), values.append, indicate=True))
+        futures = [self.server.indicate(self.battery, b'\x01'), self.server.indicate(self.battery, b'\x02')]
+        self.assertEqual(len(self.server.bearers[0x40].indications), 1)
+        self.link.pump()
+        for future in futures:
+            self.assertIsNone(future[0x40].result(0))
+        self.assertEqual(self.server.notify(self.battery, b'\x03'), 0)
+
+        future = self.server.indicate(self.battery, b'\x04')[0x40]
+        self.hci.receive(struct.pack('<BBBBHB', HCI_EVENT_PKT, EVT_DISCONN_COMPLETE, 4, HCI_SUCCESS, 0x40,
+                                     HCI_OE_USER_ENDED_CONNECTION))
+        self.assertRaises(IOError, future.result, 0)
+        self.assertEqual(self.server.bearers, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
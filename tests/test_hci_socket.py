@@ -0,0 +1,204 @@
+import errno
+import socket
+import struct
+import threading
+import time
+import unittest
+from threading import Event
+
+from hcipy import *
+
+
+def adv_report(n):
+    params = bytearray([EVT_LE_ADVERTISING_REPORT, 1, ADV_IND, LE_RANDOM_ADDRESS, n, 2, 3, 4, 5, 6, 0, 0xc0])
+    return struct.pack('<BBB', HCI_EVENT_PKT, LE_META_EVENT, len(params)) + bytes(params)
+
+
+class TestSocketProviderBatching(unittest.TestCase):
+
+    def setUp(self):
+        self.controller, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.hci = BluetoothHCI(provider=BluetoothHCISocketProvider(sock=host), auto_start=False)
+        self.batches = []
+        self.packets = []
+        self.done = Event()
+
+    def tearDown(self):
+        self.hci.stop()
+        self.controller.close()
+
+    def on_data_batch(self, batch):
+        self.batches.append([bytes(packet) for packet in batch])
+
+    def on_data(self, data):
+        self.packets.append(data)
+        if len(self.packets) == 20:
+            self.done.set()
+
+    def test_queued_packets_are_delivered_as_one_batch(self):
+        self.hci.on_data_batch(self.on_data_batch)
+        self.hci.on_data(self.on_data)
+        expected = [adv_report(n) for n in range(20)]
+        for packet in expected:
+            self.controller.send(packet)
+
+        self.hci.start()
+
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(self.batches, [expected])
+        self.assertEqual(self.packets, [bytearray(packet) for packet in expected])
+        self.assertTrue(all(isinstance(packet, bytearray) for packet in self.packets))
+
+    def test_largest_acl_packet_is_not_truncated(self):
+        self.hci.on_data_batch(self.on_data_batch)
+        packet = struct.pack('<BHH', HCI_ACLDATA_PKT, 0x0040, 1021) + bytes(range(256)) * 3 + bytes(253)
+        self.controller.send(packet)
+        self.controller.send(adv_report(1))
+        self.hci.start()
+        deadline = time.time() + 2
+        while sum(len(batch) for batch in self.batches) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([packet for batch in self.batches for packet in batch], [packet, adv_report(1)])
+
+    def test_batch_is_bounded_by_buffer_pool(self):
+        self.hci = BluetoothHCI(provider=BluetoothHCISocketProvider(sock=self.hci.hci._socket,
+                                                                    buffer_pool_size=HCI_MAX_PACKET_SIZE + 40),
+                                auto_start=False)
+        self.hci.on_data(self.on_data)
+        self.hci.on_data_batch(self.on_data_batch)
+        for n in range(20):
+            self.controller.send(adv_report(n))
+
+        self.hci.start()
+
+        self.assertTrue(self.done.wait(2))
+        self.assertTrue(len(self.batches) > 1)
+        self.assertEqual(sum(len(batch) for batch in self.batches), 20)
+
+
+    def test_read_errors_are_raised(self):
+        controller, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        provider = BluetoothHCISocketProvider(sock=host, poller=False)
+        provider.on_data_batch(self.on_data_batch)
+        provider.open()
+        controller.send(adv_report(1))
+
+        try:
+            self.assertEqual(provider.read_ready(), 1)
+            self.assertEqual(provider.read_ready(), 0)      # nothing queued isn't an error
+            controller.send(adv_report(2))
+            provider._socket = FailingSocket(host)
+            with self.assertRaises(OSError) as raised:
+                provider.read_ready()
+            self.assertEqual(raised.exception.errno, errno.ENETDOWN)
+            self.assertEqual(self.batches, [[adv_report(1)], [adv_report(2)]])
+        finally:
+            provider._socket = host
+            provider.close()
+            controller.close()
+
+
+class FailingSocket(object):
+    # receives what is queued, then fails as a socket of an adapter that went away
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def recv_into(self, buffer, nbytes, flags):
+        try:
+            return self.sock.recv_into(buffer, nbytes, flags)
+        except (IOError, OSError):
+            raise OSError(errno.ENETDOWN, "Network is down")
+
+
+class SocketPairProvider(BluetoothHCISocketProvider):
+    # a new socketpair each time the provider is (re)opened, the controller ends are kept
+
+    def __init__(self):
+        self.controllers = []
+        super(SocketPairProvider, self).__init__(sock=self._create_socket())
+
+    def _create_socket(self):
+        controller, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.controllers.append(controller)
+        return host
+
+
+class TestSocketProviderShutdown(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = SocketPairProvider()
+        self.hci = BluetoothHCI(provider=self.provider, auto_start=False)
+        self.packets = []
+        self.received = Event()
+        self.hci.on_data(self.on_data)
+
+    def tearDown(self):
+        self.hci.stop()
+        for controller in self.provider.controllers:
+            controller.close()
+
+    def on_data(self, data):
+        self.packets.append(bytes(data))
+        self.received.set()
+
+    def test_stop_wakes_and_joins_the_poller(self):
+        self.hci.start()
+        thread = self.provider._socket_poll_thread
+        started = time.time()
+        self.hci.stop()
+        self.assertLess(time.time() - started, 0.5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.provider.fileno(), -1)
+
+    def test_restart(self):
+        self.hci.start()
+        pending = self.hci.send_command(LE_SET_SCAN_ENABLE_CMD, b'\x00\x00')
+        threads = threading.active_count()
+
+        elapsed = self.hci.restart()
+        self.assertRaises(IOError, pending.result, 0)
+        self.assertEqual(self.hci.last_restart_time, elapsed)
+        self.assertLessEqual(threading.active_count(), threads)
+
+        self.provider.controllers[-1].send(adv_report(1))
+        self.assertTrue(self.received.wait(2))
+        self.assertEqual(self.packets, [adv_report(1)])
+        self.assertEqual(len(self.provider.controllers), 2)
+
+    def test_restart_from_a_callback(self):
+        threads = []
+
+        def on_data(data):
+            threads.append(threading.current_thread())
+            if len(threads) == 1:
+                # e.g. recovering from an error event, from the receive thread itself
+                self.hci.restart()
+                self.provider.controllers[-1].send(adv_report(3))
+            else:
+                self.received.set()
+
+        self.hci.on_data(on_data)
+        self.hci.start()
+        self.provider.controllers[0].send(adv_report(1))
+        self.assertTrue(self.received.wait(2))
+        first, second = threads
+        self.assertIsNot(first, second)
+        self.assertFalse(first.is_alive())
+        self.assertEqual(len([thread for thread in threading.enumerate() if thread.name == 'HCISocketPoller']), 1)
+
+        self.hci.stop()
+        self.assertFalse(second.is_alive())
+
+    def test_peer_closed(self):
+        errors = []
+        self.hci.on_data_batch(lambda batch: errors.extend(packet for packet in batch if not len(packet)))
+        self.hci.start()
+        self.provider.controllers[0].close()
+        self.provider._socket_poll_thread.join(2)
+        self.assertFalse(self.provider._socket_poll_thread.is_alive())
+        self.assertEqual(errors, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
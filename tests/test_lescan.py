@@ -1,10 +1,12 @@
 import unittest
 from time import sleep
 
-MICROBIT1_BD_ADDR='0xf5:0x3a:0xc9:0xb0:0x15:0xf6'
+MICROBIT1_BD_ADDR='F5:3A:C9:B0:15:F6'
 
 SCANTIME = 5            # seconds
 
+from hcipy import BDAddress, LE_RANDOM_ADDRESS
+
 from .le_scan_test import BluetoothLEScanTest
 
 class TestLEScan(unittest.TestCase):
@@ -21,6 +23,6 @@ class TestLEScan(unittest.TestCase):
 
         ble_scan_test.set_scan_enable(False)
 
-        self.assertTrue(MICROBIT1_BD_ADDR in ble_scan_test.found_bd_addrs)
+        self.assertTrue(BDAddress.parse(MICROBIT1_BD_ADDR, LE_RANDOM_ADDRESS) in ble_scan_test.found_bd_addrs)
 
 
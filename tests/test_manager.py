@@ -0,0 +1,110 @@
+import socket
+import threading
+import unittest
+
+from hcipy import *
+
+
+class TestBluetoothHCIAdapterManager(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = BluetoothHCIAdapterManager()
+        self.controllers = {}
+        for device_id in (0, 1, 2):
+            controller, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            self.controllers[device_id] = controller
+            self.manager.add_adapter(device_id, BluetoothHCISocketProvider(device_id, sock=host, poller=False))
+
+    def tearDown(self):
+        self.manager.close()
+        for controller in self.controllers.values():
+            controller.close()
+
+    def test_single_thread_tagged_events(self):
+        received = []
+        threads = set()
+        done = threading.Event()
+
+        def on_data(device_id, data):
+            received.append((device_id, bytes(data)))
+            threads.add(threading.current_thread().name)
+            if len(received) == 6:
+                done.set()
+
+        self.manager.on_data(on_data)
+        self.manager.start()
+        for device_id, controller in self.controllers.items():
+            controller.send(bytes([HCI_EVENT_PKT, LE_META_EVENT, 1, device_id]))
+            controller.send(bytes([HCI_EVENT_PKT, LE_META_EVENT + 1, 1, device_id]))
+
+        self.assertTrue(done.wait(2))
+        self.assertEqual(sorted(received), sorted((device_id, bytes([HCI_EVENT_PKT, evt, 1, device_id]))
+                                                  for device_id in (0, 1, 2)
+                                                  for evt in (LE_META_EVENT, LE_META_EVENT + 1)))
+        self.assertEqual(threads, {'HCIAdapterManager'})
+        self.assertEqual(dict(self.manager.packets_received), {0: 2, 1: 2, 2: 2})
+
+    def test_failed_adapter_is_removed(self):
+        errors = []
+        received = []
+        failed = threading.Event()
+        done = threading.Event()
+
+        def on_error(device_id, exc):
+            errors.append((device_id, exc))
+            failed.set()
+
+        def on_data(device_id, data):
+            received.append(device_id)
+            done.set()
+
+        self.manager.on_error(on_error)
+        self.manager.on_data(on_data)
+        self.manager.start()
+        self.controllers[0].close()
+        self.controllers[1].send(bytes([HCI_EVENT_PKT, LE_META_EVENT, 1, 1]))
+
+        self.assertTrue(failed.wait(2))
+        self.assertTrue(done.wait(2))
+        self.assertEqual([device_id for device_id, exc in errors], [0])
+        self.assertIsInstance(errors[0][1], IOError)
+        self.assertEqual(list(self.manager.adapters), [1, 2])
+
+        done.clear()
+        self.controllers[2].send(bytes([HCI_EVENT_PKT, LE_META_EVENT, 1, 2]))
+        self.assertTrue(done.wait(2))
+        self.assertEqual(received, [1, 2])
+
+    def test_raising_callback_keeps_the_adapter(self):
+        errors = []
+        received = []
+        done = threading.Event()
+
+        def on_data(device_id, data):
+            received.append(device_id)
+            if len(received) == 1:
+                raise IOError("callback bug")
+            done.set()
+
+        self.manager.on_error(lambda device_id, exc: errors.append((device_id, str(exc))))
+        self.manager.on_data(on_data)
+        self.manager.start()
+        self.controllers[0].send(bytes([HCI_EVENT_PKT, LE_META_EVENT, 1, 0]))
+        self.controllers[0].send(bytes([HCI_EVENT_PKT, LE_META_EVENT, 1, 1]))
+
+        self.assertTrue(done.wait(2))
+        self.assertEqual(errors, [(0, 'callback bug')])
+        self.assertEqual(list(self.manager.adapters), [0, 1, 2])
+
+    def test_placement(self):
+        placement = self.manager.spread(['a', 'b', 'c', 'd'], 'connections')
+        self.assertEqual(sorted(len(items) for items in placement.values()), [1, 1, 2])
+
+        self.manager.release(0, 'connections')
+        self.manager.release(1, 'connections')
+        self.assertIn(self.manager.least_loaded('connections'), (0, 1))
+        self.assertEqual(self.manager.load(2, 'scans'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
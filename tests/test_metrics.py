@@ -0,0 +1,93 @@
+import socket
+import struct
+import threading
+import unittest
+
+from hcipy import *
+
+
+def adv_report(n):
+    params = bytearray([EVT_LE_ADVERTISING_REPORT, 1, ADV_IND, LE_RANDOM_ADDRESS, n, 2, 3, 4, 5, 6, 0, 0xc0])
+    return struct.pack('<BBB', HCI_EVENT_PKT, LE_META_EVENT, len(params)) + bytes(params)
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_buckets(self):
+        histogram = Histogram()
+        for value in (0.5, 3, 3, 100, 5000):
+            histogram.add(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 5)
+        self.assertEqual(snapshot['min'], 0.5)
+        self.assertEqual(snapshot['max'], 5000)
+        self.assertEqual(snapshot['buckets'], {1: 1, 4: 2, 128: 1, 8192: 1})
+        self.assertEqual(snapshot['p50'], 4)
+        self.assertEqual(snapshot['p99'], 5000)
+        self.assertIsNone(Histogram().percentile(0.5))
+
+
+class TestHCIMetrics(unittest.TestCase):
+
+    def test_transport_drops(self):
+        metrics = HCIMetrics()
+        for queued, dropped in ((0, 5), (2048, 5), (None, 8), (0, 2), (None, None)):
+            metrics.count_queue(queued, dropped)
+        # the first reading is the baseline, then +3, and 2 on a new socket
+        self.assertEqual(metrics.transport_dropped, 5)
+        self.assertEqual(metrics.backlogged, 1)
+        self.assertEqual(metrics.queue_bytes.count, 3)
+
+
+class TestBluetoothHCIMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.controller, host = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.provider = BluetoothHCISocketProvider(sock=host)
+        self.done = threading.Event()
+        self.received = []
+
+    def tearDown(self):
+        self.hci.stop()
+        self.controller.close()
+
+    def on_data(self, data):
+        self.received.append(data)
+        if len(self.received) == 3:
+            self.done.set()
+
+    def test_disabled_by_default(self):
+        self.hci = BluetoothHCI(provider=self.provider)
+        self.assertIsNone(self.hci.metrics)
+        self.assertIsNone(self.hci.stats())
+        self.assertIsNone(self.hci.commands.metrics)
+
+    def test_packets_callbacks_and_command_latency(self):
+        self.hci = BluetoothHCI(provider=self.provider, metrics=True)
+        self.hci.on_data(self.on_data)
+
+        future = self.hci.send_command(LE_SET_SCAN_ENABLE_CMD, b'\x00\x00')
+        self.controller.recv(64)
+        self.controller.send(struct.pack('<BBBBHB', HCI_EVENT_PKT, EVT_CMD_COMPLETE, 4, 1, LE_SET_SCAN_ENABLE_CMD, 0))
+        self.controller.send(adv_report(1))
+        self.controller.send(adv_report(2))
+        future.result(2)
+        self.assertTrue(self.done.wait(2))
+
+        stats = self.hci.stats()
+        self.assertEqual(stats['packets']['0x04/0x3e/0x02'], dict(packets=2, bytes=2 * len(adv_report(1))))
+        self.assertEqual(stats['packets']['0x04/0x0e'], dict(packets=1, bytes=7))
+        self.assertEqual(stats['packets_total'], 3)
+        self.assertEqual(stats['commands_sent'], 1)
+        self.assertEqual(stats['command_latency_us']['0x{:04x}'.format(LE_SET_SCAN_ENABLE_CMD)]['count'], 1)
+        self.assertIn('commands', stats['callback_time_us'])
+        self.assertIn('on_data', stats['callback_time_us'])
+        self.assertGreaterEqual(stats['dispatch_time_us']['count'], 1)
+        self.assertEqual(stats['transport_dropped'], 0)
+
+        self.hci.enable_metrics(False)
+        self.assertIsNone(self.hci.stats())
+
+
+if __name__ == '__main__':
+    unittest.main()
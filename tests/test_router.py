@@ -0,0 +1,115 @@
+import struct
+import unittest
+
+from hcipy import *
+
+
+def cmd_complete(opcode):
+    return bytearray(struct.pack('<BBBBHB', HCI_EVENT_PKT, EVT_CMD_COMPLETE, 4, 1, opcode, 0))
+
+
+def cmd_status(opcode):
+    return bytearray(struct.pack('<BBBBBH', HCI_EVENT_PKT, EVT_CMD_STATUS, 4, 0, 1, opcode))
+
+
+def disconn_complete(handle):
+    return bytearray(struct.pack('<BBBBHB', HCI_EVENT_PKT, EVT_DISCONN_COMPLETE, 4, 0, handle, HCI_OE_USER_ENDED_CONNECTION))
+
+
+def le_meta(subevent, *params):
+    return bytearray(struct.pack('<BBBB', HCI_EVENT_PKT, EVT_LE_META_EVENT, 1 + len(params), subevent)) + bytearray(params)
+
+
+def acl(handle):
+    return bytearray(struct.pack('<BHH', HCI_ACLDATA_PKT, handle | (ACL_START << 12), 0))
+
+
+class RecordingProvider(BluetoothHCIProvider):
+
+    def __init__(self):
+        super(RecordingProvider, self).__init__()
+        self.filters = []
+        self.batch_callback = None
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write_buffer(self, data):
+        pass
+
+    def set_filter(self, data):
+        self.filters.append(data)
+
+    def on_data_batch(self, callback):
+        self.batch_callback = callback
+
+    def receive(self, *packets):
+        self.batch_callback([memoryview(packet) for packet in packets])
+
+
+class TestHCIRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.router = HCIRouter()
+        self.received = []
+
+    def recorder(self, name):
+        return lambda packet: self.received.append((name, bytes(packet)))
+
+    def test_routing_keys(self):
+        router = self.router
+        router.subscribe(self.recorder('events'), packet_type=HCI_EVENT_PKT)
+        router.subscribe(self.recorder('disconn'), event=EVT_DISCONN_COMPLETE)
+        router.subscribe(self.recorder('conn'), subevent=EVT_LE_CONN_COMPLETE)
+        router.subscribe(self.recorder('scan'), opcode=LE_SET_SCAN_ENABLE_CMD)
+        router.subscribe(self.recorder('link'), handle=0x40)
+
+        packets = [cmd_complete(LE_SET_SCAN_ENABLE_CMD), cmd_status(LE_SET_SCAN_ENABLE_CMD), cmd_complete(RESET_CMD),
+                   disconn_complete(0x40), disconn_complete(0x41),
+                   le_meta(EVT_LE_CONN_COMPLETE, 0, 0x40, 0x00), acl(0x40), acl(0x41)]
+        for packet in packets:
+            router.route(memoryview(packet))
+
+        routed = {}
+        for name, packet in self.received:
+            routed.setdefault(name, []).append(packet)
+        self.assertEqual(routed['scan'], [bytes(packets[0]), bytes(packets[1])])
+        self.assertEqual(routed['disconn'], [bytes(packets[3]), bytes(packets[4])])
+        self.assertEqual(routed['conn'], [bytes(packets[5])])
+        self.assertEqual(routed['link'], [bytes(packets[3]), bytes(packets[5]), bytes(packets[6])])
+        self.assertEqual(len(routed['events']), 6)
+
+    def test_unsubscribe_and_invalid_criteria(self):
+        subscription = self.router.subscribe(self.recorder('acl'), packet_type=HCI_ACLDATA_PKT)
+        self.router.unsubscribe(subscription)
+        self.router.route(acl(0x40))
+        self.assertEqual(self.received, [])
+        self.assertEqual(len(self.router), 0)
+
+        self.assertRaises(ValueError, self.router.subscribe, None)
+        self.assertRaises(ValueError, self.router.subscribe, None, opcode=RESET_CMD, handle=1)
+        self.assertRaises(ValueError, self.router.subscribe, None, event=EVT_CMD_COMPLETE, subevent=1)
+
+
+class TestBluetoothHCISubscribe(unittest.TestCase):
+
+    def test_subscriptions_drive_the_filter(self):
+        provider = RecordingProvider()
+        hci = BluetoothHCI(provider=provider, auto_filter=True)
+        received = []
+        subscription = hci.subscribe(lambda packet: received.append(bytes(packet)), subevent=EVT_LE_CONN_COMPLETE)
+        self.assertEqual(hci.filter.masks()[2], 1 << (EVT_LE_META_EVENT - 32))
+
+        provider.receive(le_meta(EVT_LE_CONN_COMPLETE, 0, 0x40, 0x00), le_meta(EVT_LE_ADVERTISING_REPORT, 0))
+        self.assertEqual(received, [bytes(le_meta(EVT_LE_CONN_COMPLETE, 0, 0x40, 0x00))])
+
+        hci.unsubscribe(subscription)
+        self.assertEqual(hci.filter.masks()[2], 0)
+        self.assertEqual(hci._listeners, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
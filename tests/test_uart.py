@@ -0,0 +1,123 @@
+import errno
+import os
+import struct
+import unittest
+from threading import Event
+
+from hcipy import *
+
+
+def event_packet(evt, params):
+    return bytearray(struct.pack('<BBB', HCI_EVENT_PKT, evt, len(params)) + params)
+
+
+CMD_COMPLETE = event_packet(EVT_CMD_COMPLETE, struct.pack('<BHB', 1, LE_SET_SCAN_ENABLE_CMD, HCI_SUCCESS))
+ADV_REPORT = event_packet(LE_META_EVENT, bytearray([EVT_LE_ADVERTISING_REPORT, 1, 0, 1, 1, 2, 3, 4, 5, 6, 3, 2, 1, 6, 0xc0]))
+ACL_DATA = bytearray(struct.pack('<BHH', HCI_ACLDATA_PKT, 0x2040, 3) + b'\x01\x02\x03')
+
+
+class TestH4Framer(unittest.TestCase):
+
+    def test_many_packets_in_one_chunk(self):
+        framer = H4Framer()
+        packets = framer.feed(CMD_COMPLETE + ADV_REPORT + ACL_DATA)
+        self.assertEqual(packets, [CMD_COMPLETE, ADV_REPORT, ACL_DATA])
+
+    def test_reassembly_byte_by_byte(self):
+        framer = H4Framer()
+        stream = ADV_REPORT + ACL_DATA
+        packets = []
+        for i in range(len(stream)):
+            packets += framer.feed(stream[i:i + 1])
+        self.assertEqual(packets, [ADV_REPORT, ACL_DATA])
+
+    def test_resync_on_garbage(self):
+        framer = H4Framer()
+        packets = framer.feed(b'\x00\xff' + CMD_COMPLETE)
+        self.assertEqual(packets, [CMD_COMPLETE])
+        self.assertEqual(framer.dropped_bytes, 2)
+
+
+class TestHCISoftwareFilter(unittest.TestCase):
+
+    def test_event_mask(self):
+        hci_filter = HCISoftwareFilter(struct.pack(HCIPY_HCI_FILTER_STRUCT,
+                                                   1 << HCI_EVENT_PKT,
+                                                   1 << EVT_CMD_COMPLETE,
+                                                   0,
+                                                   0))
+        self.assertTrue(hci_filter.accept(CMD_COMPLETE))
+        self.assertFalse(hci_filter.accept(ADV_REPORT))
+        self.assertFalse(hci_filter.accept(ACL_DATA))
+
+    def test_opcode(self):
+        hci_filter = HCISoftwareFilter(struct.pack(HCIPY_HCI_FILTER_STRUCT,
+                                                   1 << HCI_EVENT_PKT,
+                                                   1 << EVT_CMD_COMPLETE,
+                                                   0,
+                                                   LE_SET_SCAN_PARAMETERS_CMD))
+        self.assertFalse(hci_filter.accept(CMD_COMPLETE))
+
+
+class TestUARTProvider(unittest.TestCase):
+
+    def setUp(self):
+        self.master, self.slave = os.openpty()
+        self.hci = BluetoothHCI(transport='uart', port=os.ttyname(self.slave), auto_start=False)
+        self.received = []
+        self.done = Event()
+        self.hci.on_data(self.on_data)
+        self.hci.start()
+
+    def tearDown(self):
+        self.hci.stop()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def on_data(self, data):
+        self.received.append(data)
+        if len(self.received) == 3:
+            self.done.set()
+
+    def test_receive(self):
+        stream = CMD_COMPLETE + ADV_REPORT + ACL_DATA
+        os.write(self.master, bytes(stream[:7]))
+        os.write(self.master, bytes(stream[7:]))
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(self.received, [CMD_COMPLETE, ADV_REPORT, ACL_DATA])
+
+    def test_write(self):
+        cmd = struct.pack('<BHBBB', HCI_COMMAND_PKT, LE_SET_SCAN_ENABLE_CMD, 2, 1, 0)
+        self.hci.write(cmd)
+        self.assertEqual(os.read(self.master, 64), cmd)
+
+    def test_device_up_resets_controller(self):
+        self.hci.device_up()
+        self.assertEqual(os.read(self.master, 64), struct.pack('<BHB', HCI_COMMAND_PKT, RESET_CMD, 0))
+
+    def test_ioctls(self):
+        self.hci.device_down()
+        self.hci.set_filter(struct.pack(HCIPY_HCI_FILTER_STRUCT, 1 << HCI_EVENT_PKT, 1 << EVT_CMD_COMPLETE, 0, 0))
+        with self.assertRaises(IOError) as raised:
+            self.hci.send_cmd_value(0x400448cb, 0)      # HCIDEVRESET
+        self.assertEqual(raised.exception.errno, errno.ENOTTY)
+
+        fd = self.hci.hci.fileno()
+        self.hci.hci.open()
+        self.assertEqual(self.hci.hci.fileno(), fd)
+
+        os.write(self.master, bytes(ADV_REPORT + CMD_COMPLETE + ACL_DATA + CMD_COMPLETE + CMD_COMPLETE))
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(self.received, [CMD_COMPLETE] * 3)
+
+    def test_restart(self):
+        thread = self.hci.hci._uart_poll_thread
+        self.hci.restart()
+        self.assertFalse(thread.is_alive())
+        os.write(self.master, bytes(CMD_COMPLETE + ADV_REPORT + ACL_DATA))
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(self.received, [CMD_COMPLETE, ADV_REPORT, ACL_DATA])
+
+
+if __name__ == '__main__':
+    unittest.main()